@@ -1,7 +1,5 @@
 #!/usr/bin/python
-import os, sys, getopt, time
-import boto3
-from botocore import exceptions
+import os, sys, getopt, time, json, random, hashlib, threading, re
 
 #########################################################
 VERSION="1.0"
@@ -9,17 +7,197 @@ VERSION="1.0"
 ## Begin Function Definitions
 #########################################################
 # Define Global defaults
+# The AWS SDK is imported by ImportAwsSdk() once AWS work starts, so --help,
+# --version and argument validation do not pay for importing it
+boto3 = None
+exceptions = None
 DEBUG=False
 DebugLevel = 0
-TestRun=False
-AwsSession = None
-Ec2Client = None
+##### Logging
+# --log-format=json writes one JSON object per line with the build id and phase
+# of the thread that logged it. Log files are buffered, flushed every
+# UpdateAMI_LogFlushInterval seconds and on errors, and reopened when rotated.
+UpdateAMI_LogFormat = 'text'
+UpdateAMI_LogFlushInterval = 1
+LogOutput = None
+# Build id and pipeline phase of the current thread, for log records and API metrics
+BuildContext = threading.local()
+# Kept-alive HTTP connections per client, shared by every build and poller using it
+UpdateAMI_MaxPoolConnections = 50
 DefaultProfileName = None
 DefaultAwsConfigFile=None
 DefaultAwsRegion = "us-east-1"
 UpdateAMI_SourceLaunchPermissions = []
 UpdateAMI_UserDataFile = "userdata.txt"
 UpdateAMI_Ec2UserData = ""
+UpdateAMI_BatchMaxWorkers = 4
+UpdateAMI_InstanceType = "t2.micro"
+##### Builder instance type selection (--instance-type=auto)
+# Candidate builder types by source architecture: [InstanceType, on-demand USD per
+# hour (us-east-1 Linux), relative build speed]. Speeds are starting estimates for
+# package update workloads; once a family has baked on a type its recorded bake
+# durations are used instead, and scale the estimates for the types it has not.
+UpdateAMI_InstanceTypeCandidates = {
+    'x86_64': [['t3.medium', 0.0416, 1.0], ['m5.large', 0.096, 1.2], ['c5.large', 0.085, 1.4], ['c5.xlarge', 0.17, 2.2], ['c5.2xlarge', 0.34, 3.0], ],
+    'x86_64-xen': [['t2.medium', 0.0464, 0.9], ['m4.large', 0.1, 1.1], ['c4.large', 0.1, 1.3], ['c4.xlarge', 0.199, 2.1], ['c4.2xlarge', 0.398, 2.9], ],
+    'arm64': [['t4g.medium', 0.0336, 1.0], ['m6g.large', 0.077, 1.2], ['c6g.large', 0.068, 1.4], ['c6g.xlarge', 0.136, 2.2], ['c6g.2xlarge', 0.272, 3.0], ],
+    'i386': [['t2.medium', 0.0464, 0.9], ['c4.large', 0.1, 1.3], ['c4.xlarge', 0.199, 2.1], ],
+    'paravirtual': [['m3.medium', 0.067, 0.8], ['c3.large', 0.105, 1.2], ['c3.xlarge', 0.21, 2.0], ],
+}
+# Expected bake at speed 1.0 for a family with no recorded bakes
+UpdateAMI_BakeReferenceDuration = 900
+UpdateAMI_MaxBakeCost = 0.10
+UpdateAMI_StateDir = os.path.join(os.path.expanduser('~'), '.aws-ami-update')
+##### Credential and identity cache
+# The credential probe and caller identity are looked up once per credential
+# lifetime and remembered by the builder and on disk, keyed by a credential fingerprint
+UpdateAMI_IdentityCacheFile = os.path.join(UpdateAMI_StateDir, 'identity-cache.json')
+UpdateAMI_IdentityCacheTTL = 3600
+UpdateAMI_CredentialCacheDir = os.path.join(UpdateAMI_StateDir, 'credential-cache')
+##### API rate limiting
+# Token buckets per account, region and API family, shared by every build in the
+# process. [refill per second, capacity] follow the EC2 request token buckets.
+UpdateAMI_ApiRateLimits = {
+    'ec2:non-mutating': [20, 100],
+    'ec2:mutating': [5, 50],
+    'default': [5, 20],
+}
+UpdateAMI_ApiMaxAttempts = 10
+UpdateAMI_ApiThrottleCodes = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'RequestThrottled', 'TooManyRequestsException', 'SlowDown']
+ApiRateLimiters = {}
+ApiRateLimitersLock = threading.Lock()
+##### API call accounting
+# Calls, retries, throttles, errors and latency per pipeline phase, service and
+# operation, summarised at exit and optionally written to --api-metrics
+UpdateAMI_ApiMetricsFile = None
+UpdateAMI_ApiLatencyBuckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+ApiMetrics = {}
+ApiMetricsLock = threading.Lock()
+ApiMetricsReported = False
+##### State polling
+# --wait-interval caps the poll interval, --wait-timeout overrides the per step timeouts
+UpdateAMI_WaitInterval = None
+UpdateAMI_WaitTimeout = None
+# Confirming the builder terminated is off the critical path, only wait for it on request
+UpdateAMI_WaitTerminate = False
+UpdateAMI_WaitMinInterval = 5
+UpdateAMI_WaitBackoff = 1.5
+# Fraction of the historical phase duration to sleep before the first check
+UpdateAMI_WaitHistoryLead = 0.8
+UpdateAMI_PhaseHistoryFile = os.path.join(UpdateAMI_StateDir, 'phase-history.json')
+UpdateAMI_PhaseHistorySamples = 20
+PhaseHistoryLock = threading.Lock()
+# Requests due within the window are answered by the same describe call
+UpdateAMI_CopyTimeout = 3600
+##### Bake cache
+# AMIs are tagged with a digest of their build inputs and reused when the inputs repeat
+UpdateAMI_BakeCache = True
+UpdateAMI_BakeDigestTag = 'AwsAmiUpdate:BakeDigest'
+# Ami name a builder or image was made for, without the instance suffix
+UpdateAMI_FamilyTag = 'AwsAmiUpdate:Family'
+UpdateAMI_BakeCacheFile = os.path.join(UpdateAMI_StateDir, 'bake-cache.json')
+UpdateAMI_BakeCacheTTL = 86400
+BakeCacheLock = threading.Lock()
+##### Warm builder pool
+# Builders are kept stopped after a bake and restarted for the next bake of the same image
+UpdateAMI_WarmPool = False
+UpdateAMI_WarmMaxGenerations = 5
+UpdateAMI_WarmSourceTag = 'AwsAmiUpdate:SourceAmiId'
+UpdateAMI_WarmGenerationTag = 'AwsAmiUpdate:Generation'
+UpdateAMI_WarmClaimTag = 'AwsAmiUpdate:ClaimedBy'
+WarmPoolLock = threading.Lock()
+##### Retention (--gc)
+# Images this tool made are grouped by their family tag, or for older images by
+# their '<name> <instance suffix>' name. In each family and region the newest
+# UpdateAMI_GcKeepLatest, those younger than UpdateAMI_GcKeepDays and those still
+# used by instances or launch templates are kept; the rest are deregistered and
+# their snapshots deleted.
+UpdateAMI_GcKeepLatest = 3
+UpdateAMI_GcKeepDays = 0
+UpdateAMI_GcMaxWorkers = 8
+UpdateAMI_GcSnapshotRetries = 5
+##### Orphaned builder reaping (--reap)
+# Transient instances are tagged with the build that launched them. One paginated
+# query per region finds those launched more than UpdateAMI_ReapMinAge seconds ago
+# whose build journal here is not running and recently written, and terminates
+# them in batches. A failed build reaps its own builder and its region's orphans.
+UpdateAMI_BuildIdTag = 'AwsAmiUpdate:BuildId'
+UpdateAMI_ReapMinAge = 21600
+UpdateAMI_ReapOnFailure = True
+UpdateAMI_ReapBatchSize = 100
+UpdateAMI_ReapMaxWorkers = 16
+##### Source resolution and watching (--source, --watch)
+# --source=ssm:<parameter> takes the source Ami id from an SSM parameter, such as
+# the public /aws/service/ami-amazon-linux-latest ones, name:<pattern> the newest
+# available image of the SourceOwners setting named like the pattern. Once a pattern
+# has resolved, later lookups only ask for images created since that one's day.
+# --watch resolves the source every UpdateAMI_WatchInterval seconds with one
+# builder and bakes when it changed or the last bake is older than UpdateAMI_WatchMaxAge.
+UpdateAMI_SourceOwners = ['self']
+UpdateAMI_SourceLookbackDays = 31
+UpdateAMI_WatchInterval = 300
+UpdateAMI_WatchMaxAge = 0
+# A source whose bake failed is retried after this long rather than every interval
+UpdateAMI_WatchRetryDelay = 3600
+UpdateAMI_WatchStateFile = os.path.join(UpdateAMI_StateDir, 'watch-state.json')
+WatchStopped = threading.Event()
+##### Launch permission distribution
+# With --share-accounts/--share-ous the new Ami and its snapshots, copies
+# included, are brought to exactly the listed accounts and organizational units
+# plus any mirrored from the source. Only the difference to what they already
+# allow is sent, in batches, with the Ami and each snapshot changed concurrently.
+# A public source makes the new Ami public, but its snapshots only become public
+# with --share-snapshots-public.
+UpdateAMI_ShareAccounts = []
+UpdateAMI_ShareOrganizationalUnits = []
+UpdateAMI_ShareSnapshotsPublic = False
+UpdateAMI_ShareBatchSize = 100
+UpdateAMI_ShareMaxWorkers = 8
+UpdateAMI_BuildJournalDir = os.path.join(UpdateAMI_StateDir, 'builds')
+# JSON build result for orchestration, '-' writes it to stdout
+UpdateAMI_ResultFile = None
+BuildJournalLock = threading.RLock()
+UpdateAMI_PollCoalesceWindow = 5
+UpdateAMI_PollBatchSize = 200
+StatusPollers = {}
+StatusPollersLock = threading.Lock()
+##### Console tailing
+# With --tail-console the builder console is followed while the bake runs and
+# appended to builds/<Build Id>.console.log. Userdata printing the done marker
+# to the console has the stop check made right away, the fail marker aborts.
+UpdateAMI_ConsoleTail = False
+UpdateAMI_ConsoleTailInterval = 15
+UpdateAMI_ConsoleDoneMarker = 'AWS-AMI-UPDATE-DONE'
+UpdateAMI_ConsoleFailMarker = 'AWS-AMI-UPDATE-FAILED'
+# Trailing characters of the last fetch used to line up the next one
+UpdateAMI_ConsoleAnchorSize = 256
+##### Completion signalling
+# With --completion-signal the userdata runs inside a wrapper that reports its exit
+# status, by tagging the builder or sending to an SQS queue, instead of halting.
+# The image is created as soon as success is reported, a failure aborts the build.
+# Reporting needs --instance-profile, a role allowed ec2:CreateTags or sqs:SendMessage.
+UpdateAMI_CompletionSignal = None
+UpdateAMI_InstanceProfile = None
+UpdateAMI_CompletionTag = 'AwsAmiUpdate:Completion'
+UpdateAMI_CompletionPollInterval = 20
+CompletionListeners = {}
+CompletionListenersLock = threading.Lock()
+##### Userdata assembly
+# -u takes a comma separated list of fragments. '#include <file>' lines are replaced
+# by that file, relative to the one including it, and {{ Name }} by --userdata-var
+# values or the build's AmiName, SourceAmiId and AwsRegion. Bash fragments make up
+# the build script; cloud-config, boothooks and other interpreters become parts of
+# a cloud-init multipart. Userdata over UpdateAMI_UserDataGzipMin bytes is gzip
+# compressed when that makes it smaller; cloud-init unpacks it on the builder.
+UpdateAMI_UserDataVars = {}
+UpdateAMI_UserDataGzipMin = 4096
+UpdateAMI_UserDataMaxSize = 16384
+UpdateAMI_UserDataIncludeDepth = 16
+UserDataCache = {}
+# Rendered fragments by fragment list and variables, kept while none of the files
+# read for them, includes too, has changed size, mtime or inode
+UserDataFileCache = {}
+UserDataCacheLock = threading.Lock()
 ##### Default Shutdown commands
 # Immediate Shutdown
 UpdateAMI_ShutdownCMD = """/sbin/halt -n"""
@@ -29,23 +207,59 @@ UpdateAMI_ShutdownCMD = """/sbin/halt -n"""
 def show_usage():
     print("""
 Usage: aws-ami-update.py [options] -a <Source Ami Id> -n <Ami Name>
+       aws-ami-update.py [options] --manifest=<Manifest File>
+       aws-ami-update.py [options] --resume=<Build Id>
+       aws-ami-update.py [options] --reap
+       aws-ami-update.py [options] --watch --source=<Source> -n <Ami Name>
   -h --help                             Show this help
   -v --version                          Show version
   -a --aws-id=<Ami Id>                  Specify Ami Id for source image (i.e. ami-14c5486b)                 [REQUIRED]
   -n --name=<Ami Name>                  Specify Name of new Ami                                             [REQUIRED]
+     --source=<ssm:param|name:pattern>  Resolve the source Ami from an SSM parameter or as the newest image named like pattern
+     --source-owners=<owners>           Owners --source=name: images may have (comma separated)             [Default: self]
+     --watch                            Keep running and bake whenever the source Ami changes
+     --watch-interval=<seconds>         Time between source checks in --watch mode                          [Default: 300]
+     --max-age=<hours>                  Rebake in --watch mode once the last bake is this old, 0 never      [Default: 0]
   -p --profile-name=<profile name>      Specify alternate aws authentication profile                        [Default: default]
   -c --config=<config file>             Specify alternate aws client config file                            [Default: ~/.aws/config]
-  -l --log-file                         Specify file location to write log                                  [NOT IMPLEMENTED]`
+  -l --log-file=<log file>              Specify file location to write log                                  [Default: stdout]
   -r --region=<Aws Region>              Specify Aws Region (i.e. us-west-2)                                 [Default: us-east-1]
-  -u --userdata-file=<UserData File>    Specify Userdata file to execute on ami
+  -u --userdata-file=<UserData Files>   Specify Userdata files to execute on ami (comma separated)
+     --userdata-var=<name=value>        Value of {{ name }} in Userdata files, may be repeated
   -m --mirror-launchpermissions         Mirror source AMI launch permissions
-  -i --instance-type                    Specify Aws instance type (i.e. t2-micro)                           [NOT IMPLEMENTED]
+  -i --instance-type=<type|auto>        Specify Aws builder instance type, auto picks fastest affordable    [Default: t2.micro]
+     --max-bake-cost=<usd>              Highest expected builder cost of one bake for --instance-type=auto  [Default: 0.10]
   -d --debug                            Enable Debug logging or increase debug level
   -t --testrun                          Enable TestRun mode (AWS DryRun, takes no action)
      --no-shutdown                      Skip addition of shutdown command to Userdata
      --log-instance-console             Output transient ec2 console to log
-     --wait-interval                    Interval between checking AMI/Instance status during provisioning   [NOT IMPLEMENTED]
-     --wait-timeout                     Maximum time to wait for AMI/Instance steps during provisioning     [NOT IMPLEMENTED]
+     --completion-signal=<tag|Sqs Url>  Builder reports its userdata exit status by tag or to an SQS queue
+     --instance-profile=<name|arn>      Iam instance profile of the builder, required by --completion-signal
+     --tail-console                     Follow the transient ec2 console into the build's console log
+     --console-done-marker=<text>       Console text marking userdata done, stop is checked at once         [Default: AWS-AMI-UPDATE-DONE]
+     --console-fail-marker=<text>       Console text marking userdata failed, the build aborts              [Default: AWS-AMI-UPDATE-FAILED]
+     --wait-interval=<seconds>          Maximum interval between checking AMI/Instance status               [Default: 60/30]
+     --wait-timeout=<seconds>           Maximum time to wait for AMI/Instance steps during provisioning     [Default: 900/600]
+     --wait-terminate                   Wait for the transient instance to finish terminating before exiting
+     --warm-pool                        Keep the builder stopped and reuse it for the next bake of this name
+     --warm-max-generations=<count>     Bakes a warm builder may serve before it is rebuilt from source     [Default: 5]
+     --resume=<Build Id>                Resume an interrupted build from its last completed phase
+     --no-cache                         Rebuild even when an Ami baked from identical inputs exists
+     --target-regions=<Aws Regions>     Copy the new Ami to a comma separated list of regions
+     --gc                               Deregister superseded Amis of -n (or every family) in -r and --target-regions
+     --keep-latest=<count>              Newest Amis of a family --gc keeps in each region                   [Default: 3]
+     --keep-days=<days>                 Amis younger than this --gc keeps regardless of count               [Default: 0]
+     --reap                             Terminate transient instances of failed or killed builds in every region
+     --reap-age=<hours>                 Transient instances younger than this --reap leaves alone           [Default: 6]
+     --keep-failed                      Leave the transient instance of a failed build for inspection
+     --share-accounts=<Account Ids>     Share the new Ami and its snapshots with only these accounts (comma separated or @file)
+     --share-ous=<OU Arns>              Share the new Ami with only these organizational units (comma separated or @file)
+     --share-snapshots-public           Make the snapshots of a public Ami public too, not only the Ami
+     --manifest=<Manifest File>         Bake every image listed in a YAML/JSON manifest concurrently
+     --max-workers=<count>              Maximum concurrent builds in manifest mode                          [Default: 4]
+     --log-format=<text|json>           Write log lines as text or as JSON objects with build id and phase  [Default: text]
+     --result-file=<file>               Write the build result, new Ami id and phase durations as JSON ('-' for stdout)
+     --api-metrics=<file>               Write Aws API call counts and latencies as JSON, or Prometheus text for *.prom
      --mail-to=<Email Address>          Send email notification to listed email addresses                   [NOT IMPLEMENTED]
 
 """)
@@ -55,17 +269,96 @@ def show_version():
     print('aws-ami-update.py version {0}'.format(VERSION))
     sys.exit(411)
 
-def LOGMSG(LogMsg,LogLvl='INFO',DebugMsgLvl=1):
-    if (LogLvl == 'DEBUG' and DEBUG):
-        if DebugLevel >= DebugMsgLvl:
-            print(":{0}:{1}:{2}:{3}".format(Timestamp(),LogLvl,DebugMsgLvl,LogMsg))
-    elif (LogLvl == 'INFO'):
-        print(":{0}:{1}::{2}".format(Timestamp(),LogLvl,LogMsg))
-    elif (LogLvl == 'ERROR'):
-        print(":{0}:{1}::{2}".format(Timestamp(),LogLvl,LogMsg))
+def LOGMSG(LogMsg,LogLvl='INFO',DebugMsgLvl=1,*LogArgs):
+    # LogArgs are formatted into LogMsg only once the message is known to be
+    # written, a disabled debug message costs a comparison
+    if (LogLvl == 'DEBUG'):
+        if (CurrentDebugLevel() < DebugMsgLvl):
+            return 0
+    elif (LogLvl in ('INFO', 'WARN', 'ERROR')):
+        DebugMsgLvl = ''
     else:
         return 0
+    if (len(LogArgs) > 0):
+        LogMsg = LogMsg.format(*LogArgs)
+    WriteLogRecord(LogLvl, DebugMsgLvl, LogMsg)
+    return 0
+
+def CurrentDebugLevel():
+    # Debug level of the build or builder on this thread, or of the command line
+    BuildSettings = getattr(BuildContext, 'Settings', None)
+    if (BuildSettings is None):
+        Builder = getattr(BuildContext, 'Builder', None)
+        if (Builder is None):
+            return DebugLevel if DEBUG else 0
+        BuildSettings = Builder.Settings
+    return BuildSettings['DebugLevel']
+
+def LOGBLOCK(LogText):
+    # Multi line output (userdata, result tables) between >>> and <<<END markers
+    WriteLogRecord('INFO', '', LogText, Raw=True)
+    return 0
+
+def WriteLogRecord(LogLvl,DebugMsgLvl,LogMsg,Raw=False):
+    if (UpdateAMI_LogFormat == 'json'):
+        LogRecord = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'level': LogLvl, 'message': str(LogMsg)}
+        if (DebugMsgLvl != ''):
+            LogRecord['debug_level'] = DebugMsgLvl
+        if (getattr(BuildContext, 'BuildId', None) is not None):
+            LogRecord['build_id'] = BuildContext.BuildId
+        if (getattr(BuildContext, 'Phase', None) is not None):
+            LogRecord['phase'] = BuildContext.Phase
+        LogLine = json.dumps(LogRecord)
+    elif (Raw):
+        LogLine = str(LogMsg)
+    else:
+        LogLine = ":{0}:{1}:{2}:{3}".format(Timestamp(),LogLvl,DebugMsgLvl,LogMsg)
+    if (LogOutput is None):
+        # One write per record, so records of concurrent workers do not interleave
+        sys.stdout.write(LogLine + '\n')
+    else:
+        LogOutput.Write(LogLine, LogLvl == 'ERROR')
     return 0
+
+class LogFileWriter(object):
+    # Appends to LogFile through a large buffer. Every flush checks whether the
+    # path still names the open file, so after logrotate moves it away the next
+    # lines go to a fresh file without needing copytruncate or a signal.
+    def __init__(self,LogFile):
+        self.LogFile = LogFile
+        self.Lock = threading.Lock()
+        self.Open()
+        import atexit
+        atexit.register(self.Close)
+
+    def Open(self):
+        self.Stream = open(self.LogFile, 'a', buffering=65536)
+        LogFileStat = os.fstat(self.Stream.fileno())
+        self.StreamId = (LogFileStat.st_dev, LogFileStat.st_ino)
+        self.Flushed = time.monotonic()
+
+    def Write(self,LogLine,Flush=False):
+        with self.Lock:
+            self.Stream.write(LogLine + '\n')
+            if (Flush or time.monotonic() - self.Flushed >= UpdateAMI_LogFlushInterval):
+                self.Flush()
+
+    def Flush(self):
+        self.Stream.flush()
+        self.Flushed = time.monotonic()
+        try:
+            LogFileStat = os.stat(self.LogFile)
+            LogFileRotated = ((LogFileStat.st_dev, LogFileStat.st_ino) != self.StreamId)
+        except OSError:
+            LogFileRotated = True
+        if (LogFileRotated):
+            self.Stream.close()
+            self.Open()
+
+    def Close(self):
+        with self.Lock:
+            self.Stream.close()
+
 def DEBUG1MSG(DebugMsg,DebugMsgLvl=1):
     print(":{0}:{1}:DEBUG:{2}".format(Timestamp(),DebugMsgLvl,DebugMsg))
     return 0
@@ -82,45 +375,149 @@ def ValidateRegion(AwsRegion):
         return False
     return None
 
-def InitAwsSession(AwsConfigFile=DefaultAwsConfigFile,ProfileName=DefaultProfileName,AwsRegion=DefaultAwsRegion,AKID=None,SAK=None):
-    if (AwsConfigFile is not None):
-        os.environ["AWS_CONFIG_FILE"] = AwsConfigFile
-        os.environ["AWS_SHARED_CREDENTIALS_FILE"] = ""
+def ValidateInstanceType(InstanceType):
+    # Family, generation and attributes, a dot, then the size (i.e. c5.xlarge)
+    if (InstanceType == 'auto'):
+        return True
+    InstanceTypeParts = str(InstanceType).split('.')
+    return len(InstanceTypeParts) == 2 and InstanceTypeParts[0].isalnum() and InstanceTypeParts[0][0].isalpha() and InstanceTypeParts[1].isalnum()
 
-    
-    LOGMSG('InitAwsSession.AwsConfigFile: {0}'.format(AwsConfigFile),'DEBUG',1)
-    LOGMSG('InitAwsSession.ProfileName: {0}'.format(ProfileName),'DEBUG',1)
-    LOGMSG('InitAwsSession.AwsRegion: {0}'.format(AwsRegion),'DEBUG',1)
+class AmiUpdateError(Exception):
+    # Raised by the pipeline instead of exiting; the command line exits with ExitCode.
+    # BuildId is the build that failed, None if it failed before getting one.
+    ExitCode = 1
+    def __init__(self,ErrorMessage,ExitCode=None):
+        Exception.__init__(self, ErrorMessage)
+        if (ExitCode is not None):
+            self.ExitCode = ExitCode
+        self.BuildId = getattr(BuildContext, 'BuildId', None)
+
+class AwsAuthError(AmiUpdateError):
+    pass
+
+class BuildInputError(AmiUpdateError):
+    pass
+
+class SourceAmiError(AmiUpdateError):
+    pass
+
+class InstanceError(AmiUpdateError):
+    pass
+
+class UserDataError(AmiUpdateError):
+    pass
+
+class ImageError(AmiUpdateError):
+    pass
 
+def ImportAwsSdk():
+    global boto3, exceptions
+    if (boto3 is None):
+        import boto3
+        from botocore import exceptions
+    return boto3
+
+def InitAwsSession(Builder,AwsConfigFile=DefaultAwsConfigFile,ProfileName=DefaultProfileName,AwsRegion=DefaultAwsRegion,AKID=None,SAK=None):
+    LOGMSG('InitAwsSession.AwsConfigFile: {0}','DEBUG',1,AwsConfigFile)
+    LOGMSG('InitAwsSession.ProfileName: {0}','DEBUG',1,ProfileName)
+    LOGMSG('InitAwsSession.AwsRegion: {0}','DEBUG',1,AwsRegion)
+
+    ImportAwsSdk()
+    import botocore.session
+    AwsCoreSession = botocore.session.Session()
+    if (AwsConfigFile is not None):
+        # Set on the session, not the environment, builders may use different files
+        AwsCoreSession.set_config_variable('config_file', AwsConfigFile)
+        AwsCoreSession.set_config_variable('credentials_file', '')
     aws = boto3.Session (
         aws_access_key_id=AKID,
         aws_secret_access_key=SAK,
         region_name=AwsRegion,
-        profile_name=ProfileName
+        profile_name=ProfileName,
+        botocore_session=AwsCoreSession
     )
+    Builder.Session = aws
+    InstrumentAwsSession(aws)
+    # Reuse assumed role credentials between runs until they expire
     try:
-        ec2 = aws.client('ec2')
-        TestResponse = ec2.describe_account_attributes(
+        from botocore.credentials import JSONFileCache
+        aws._session.get_component('credential_provider').get_provider('assume-role').cache = JSONFileCache(UpdateAMI_CredentialCacheDir)
+    except Exception as err:
+        LOGMSG('InitAwsSession.CredentialCache: {0}','DEBUG',2,err)
+    try:
+        LoadAwsIdentity(Builder, ProfileName)
+        if (Builder.Identity.get('Probed')):
+            LOGMSG('InitAwsSession: credentials verified by an earlier run','DEBUG',1)
+            return aws
+        TestResponse = Builder.Client('ec2', AwsRegion).describe_account_attributes(
             AttributeNames=[
                 'default-vpc',
             ],
             DryRun=False
         )
-        LOGMSG('InitAwsSession.TestResponse: {0}'.format(TestResponse),DEBUG,3)
+        LOGMSG('InitAwsSession.TestResponse: {0}','DEBUG',3,TestResponse)
+        SaveAwsIdentity(Builder, Probed=True)
     except exceptions.NoCredentialsError:
         LOGMSG('Unable to locate valid credentials','ERROR')
-        sys.exit(1)
+        raise AwsAuthError('Unable to locate valid credentials', 1)
     except exceptions.ClientError as err:
         ExceptionReturn = BotoExceptionHandling(err)
         if (ExceptionReturn == 1):
-            sys.exit(2)
+            raise AwsAuthError(str(err), 2)
         elif (ExceptionReturn == 2):
             LOGMSG('Authentication Failure','ERROR')
-            sys.exit(2)
+            raise AwsAuthError('Authentication Failure', 2)
         else:
             raise err
-    return [aws, ec2]
-    
+    return aws
+
+def LoadAwsIdentity(Builder,ProfileName=None):
+    # Fingerprint the resolved credentials and load whatever an earlier run with
+    # the same credentials learned about them, as long as they are still valid
+    Credentials = Builder.Session.get_credentials()
+    if (Credentials is None):
+        raise exceptions.NoCredentialsError()
+    FrozenCredentials = Credentials.get_frozen_credentials()
+    Builder.CredentialKey = hashlib.sha256('{0}:{1}'.format(ProfileName, FrozenCredentials.access_key).encode('utf-8')).hexdigest()
+    Builder.CredentialExpiry = time.time() + UpdateAMI_IdentityCacheTTL
+    # Temporary credentials carry their own expiry
+    CredentialExpiry = getattr(Credentials, '_expiry_time', None)
+    if (CredentialExpiry is not None):
+        Builder.CredentialExpiry = min(Builder.CredentialExpiry, CredentialExpiry.timestamp())
+    with Builder.IdentityLock:
+        Builder.Identity.clear()
+        try:
+            with open(UpdateAMI_IdentityCacheFile) as IdentityCache_fh:
+                IdentityCacheEntry = json.load(IdentityCache_fh).get(Builder.CredentialKey, {})
+        except (IOError, ValueError):
+            IdentityCacheEntry = {}
+        if (IdentityCacheEntry.get('Expires', 0) > time.time()):
+            Builder.Identity.update(IdentityCacheEntry)
+    LOGMSG('LoadAwsIdentity.AwsIdentity: {0}','DEBUG',2,Builder.Identity)
+    return Builder.Identity
+
+def SaveAwsIdentity(Builder,**IdentityFields):
+    with Builder.IdentityLock:
+        Builder.Identity.update(IdentityFields)
+        Builder.Identity['Expires'] = Builder.CredentialExpiry
+        if (Builder.CredentialKey is None):
+            return 0
+        try:
+            with open(UpdateAMI_IdentityCacheFile) as IdentityCache_fh:
+                IdentityCache = json.load(IdentityCache_fh)
+        except (IOError, ValueError):
+            IdentityCache = {}
+        IdentityCache = dict((CacheKey, CacheEntry) for CacheKey, CacheEntry in IdentityCache.items() if CacheEntry.get('Expires', 0) > time.time())
+        IdentityCache[Builder.CredentialKey] = dict(Builder.Identity)
+        try:
+            if (not os.path.isdir(UpdateAMI_StateDir)):
+                os.makedirs(UpdateAMI_StateDir)
+            with os.fdopen(os.open(UpdateAMI_IdentityCacheFile + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as IdentityCache_fh:
+                json.dump(IdentityCache, IdentityCache_fh)
+            os.rename(UpdateAMI_IdentityCacheFile + '.tmp', UpdateAMI_IdentityCacheFile)
+        except (IOError, OSError) as err:
+            LOGMSG('Unable to record identity cache: {0}','DEBUG',1,err)
+    return 0
 
 def BotoExceptionHandling(err):
     if err.response['Error']['Code'] == 'DryRunOperation':
@@ -130,106 +527,581 @@ def BotoExceptionHandling(err):
         return 1
     elif err.response['Error']['Code'] == 'AuthFailure':
         return 2
+    elif err.response['Error']['Code'] in UpdateAMI_ApiThrottleCodes:
+        LOGMSG('Aws API rate limit still exceeded after {0} attempts.'.format(UpdateAMI_ApiMaxAttempts),'ERROR')
+        raise err
     else:
         raise err
     return 99
 
+class ApiRateLimiter(object):
+    # Token bucket shared by every caller of one account, region and API family.
+    # The refill rate halves whenever AWS throttles a call and recovers a little
+    # with every call that gets through, so concurrent builds settle at the
+    # account's rate limit instead of failing.
+    def __init__(self,RefillRate,Capacity):
+        self.MaxRate = float(RefillRate)
+        self.Rate = float(RefillRate)
+        self.Capacity = float(Capacity)
+        self.Tokens = float(Capacity)
+        self.Updated = time.monotonic()
+        self.Lock = threading.Lock()
+
+    def Acquire(self):
+        while True:
+            with self.Lock:
+                Now = time.monotonic()
+                self.Tokens = min(self.Capacity, self.Tokens + (Now - self.Updated) * self.Rate)
+                self.Updated = Now
+                if (self.Tokens >= 1):
+                    self.Tokens -= 1
+                    return 0
+                AcquireDelay = (1 - self.Tokens) / self.Rate
+            time.sleep(AcquireDelay)
+
+    def Throttled(self):
+        with self.Lock:
+            self.Rate = max(self.MaxRate / 64, self.Rate / 2)
+            self.Tokens = min(self.Tokens, 0)
+        LOGMSG('ApiRateLimiter.Throttled: rate now {0:.2f}/s','DEBUG',1,self.Rate)
+
+    def Succeeded(self):
+        if (self.Rate < self.MaxRate):
+            with self.Lock:
+                self.Rate = min(self.MaxRate, self.Rate + self.MaxRate / 20)
+
+def AwsClientConfig(MaxPoolConnections=UpdateAMI_MaxPoolConnections):
+    # Standard retry mode retries throttling and transient errors with jittered
+    # exponential backoff, ApiRateLimiter paces the attempts themselves. The
+    # connection pool is sized for every thread sharing the client, with TCP
+    # keep-alive so idle connections survive long waits between polls.
+    from botocore.config import Config
+    return Config(retries={'max_attempts': UpdateAMI_ApiMaxAttempts, 'mode': 'standard'}, max_pool_connections=MaxPoolConnections, tcp_keepalive=True)
+
+def GetApiRateLimiter(CredentialKey,ServiceName,AwsRegion,OperationName):
+    ApiFamily = 'mutating'
+    if (OperationName.startswith(('Describe', 'Get', 'List'))):
+        ApiFamily = 'non-mutating'
+    RateLimitKey = (CredentialKey, AwsRegion, ServiceName, ApiFamily)
+    with ApiRateLimitersLock:
+        if (RateLimitKey not in ApiRateLimiters):
+            RefillRate, Capacity = UpdateAMI_ApiRateLimits.get('{0}:{1}'.format(ServiceName, ApiFamily), UpdateAMI_ApiRateLimits['default'])
+            ApiRateLimiters[RateLimitKey] = ApiRateLimiter(RefillRate, Capacity)
+        return ApiRateLimiters[RateLimitKey]
+
+def ConfigureAwsClient(Client,AwsRegion,CredentialKey=None):
+    # Every HTTP attempt, retries included, takes a token from the shared limiter
+    ServiceName = Client.meta.service_model.endpoint_prefix
+    def ApiRateLimitBeforeSend(event_name=None,**kwargs):
+        GetApiRateLimiter(CredentialKey, ServiceName, AwsRegion, event_name.split('.')[-1]).Acquire()
+    def ApiRateLimitNeedsRetry(event_name=None,response=None,**kwargs):
+        if (response is None):
+            return None
+        ApiRateLimit = GetApiRateLimiter(CredentialKey, ServiceName, AwsRegion, event_name.split('.')[-1])
+        if (response[1].get('Error', {}).get('Code') in UpdateAMI_ApiThrottleCodes):
+            ApiRateLimit.Throttled()
+        elif (response[0].status_code < 400):
+            ApiRateLimit.Succeeded()
+        return None
+    Client.meta.events.register('before-send.{0}'.format(Client.meta.service_model.service_id.hyphenize()), ApiRateLimitBeforeSend)
+    Client.meta.events.register_first('needs-retry.{0}'.format(Client.meta.service_model.service_id.hyphenize()), ApiRateLimitNeedsRetry)
+    return Client
+
+def SetBuildPhase(PhaseName,BuildId=False):
+    # Log records and API calls of this thread are attributed to PhaseName
+    BuildContext.Phase = PhaseName
+    if (BuildId is not False):
+        BuildContext.BuildId = BuildId
+    return 0
+
+def ApiMetricsEntry(ServiceName,OperationName):
+    MetricsKey = (getattr(BuildContext, 'Phase', None) or 'session', ServiceName, OperationName)
+    if (MetricsKey not in ApiMetrics):
+        ApiMetrics[MetricsKey] = {'Calls': 0, 'Retries': 0, 'Throttles': 0, 'Errors': 0, 'Latency': 0.0, 'LatencyBuckets': [0] * (len(UpdateAMI_ApiLatencyBuckets) + 1)}
+    return ApiMetrics[MetricsKey]
+
+def InstrumentAwsSession(aws):
+    # Hooks on the session are copied to every client created from it
+    def ApiMetricsBeforeCall(context=None,**kwargs):
+        context['AwsAmiUpdateCallStart'] = time.monotonic()
+    def ApiMetricsAfterCall(event_name=None,parsed=None,context=None,**kwargs):
+        ServiceName, OperationName = event_name.split('.')[1:3]
+        CallLatency = time.monotonic() - context.get('AwsAmiUpdateCallStart', time.monotonic())
+        with ApiMetricsLock:
+            ApiCall = ApiMetricsEntry(ServiceName, OperationName)
+            ApiCall['Calls'] += 1
+            ApiCall['Retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            ApiCall['Errors'] += int('Error' in parsed)
+            ApiCall['Latency'] += CallLatency
+            ApiCall['LatencyBuckets'][len([LatencyBucket for LatencyBucket in UpdateAMI_ApiLatencyBuckets if CallLatency > LatencyBucket])] += 1
+    def ApiMetricsAfterCallError(event_name=None,**kwargs):
+        with ApiMetricsLock:
+            ApiCall = ApiMetricsEntry(*event_name.split('.')[1:3])
+            ApiCall['Calls'] += 1
+            ApiCall['Errors'] += 1
+    def ApiMetricsNeedsRetry(event_name=None,response=None,**kwargs):
+        if (response is not None and response[1].get('Error', {}).get('Code') in UpdateAMI_ApiThrottleCodes):
+            with ApiMetricsLock:
+                ApiMetricsEntry(*event_name.split('.')[1:3])['Throttles'] += 1
+        return None
+    aws.events.register('before-call', ApiMetricsBeforeCall)
+    aws.events.register('after-call', ApiMetricsAfterCall)
+    aws.events.register('after-call-error', ApiMetricsAfterCallError)
+    aws.events.register_first('needs-retry', ApiMetricsNeedsRetry)
+    global ApiMetricsReported
+    if (not ApiMetricsReported):
+        import atexit
+        atexit.register(ReportApiMetrics)
+        ApiMetricsReported = True
+    return 0
+
+def ReportApiMetrics():
+    with ApiMetricsLock:
+        MetricsSnapshot = dict((MetricsKey, dict(ApiCall, LatencyBuckets=list(ApiCall['LatencyBuckets']))) for MetricsKey, ApiCall in ApiMetrics.items())
+    if (len(MetricsSnapshot) == 0):
+        return 0
+    Totals = dict((MetricName, sum(ApiCall[MetricName] for ApiCall in MetricsSnapshot.values())) for MetricName in ('Calls', 'Retries', 'Throttles', 'Errors', 'Latency'))
+    LOGMSG('Aws API calls: {0} ({1} retries, {2} throttled, {3} errors, {4:.1f}s in calls)'.format(Totals['Calls'], Totals['Retries'], Totals['Throttles'], Totals['Errors'], Totals['Latency']))
+    for (PhaseName, ServiceName, OperationName), ApiCall in sorted(MetricsSnapshot.items()):
+        LOGMSG('ApiMetrics.{0}: {1}.{2} calls={3} retries={4} throttles={5} errors={6} avg={7:.3f}s','DEBUG',1,PhaseName, ServiceName, OperationName, ApiCall['Calls'], ApiCall['Retries'], ApiCall['Throttles'], ApiCall['Errors'], ApiCall['Latency'] / max(ApiCall['Calls'], 1))
+    if (UpdateAMI_ApiMetricsFile is None):
+        return 0
+    try:
+        with open(UpdateAMI_ApiMetricsFile + '.tmp', 'w') as ApiMetricsFile:
+            if (UpdateAMI_ApiMetricsFile.endswith('.prom')):
+                WritePrometheusMetrics(ApiMetricsFile, MetricsSnapshot)
+            else:
+                json.dump({
+                    'Totals': Totals,
+                    'LatencyBuckets': UpdateAMI_ApiLatencyBuckets,
+                    'Calls': [dict(ApiCall, Phase=PhaseName, Service=ServiceName, Operation=OperationName) for (PhaseName, ServiceName, OperationName), ApiCall in sorted(MetricsSnapshot.items())],
+                }, ApiMetricsFile, indent=2)
+        # Renamed into place so a textfile collector never reads a partial file
+        os.replace(UpdateAMI_ApiMetricsFile + '.tmp', UpdateAMI_ApiMetricsFile)
+    except (IOError, OSError) as err:
+        LOGMSG('Unable to write Aws API metrics: {0}'.format(err),'ERROR')
+    return 0
+
+def WritePrometheusMetrics(MetricsFile,MetricsSnapshot):
+    for MetricName, MetricField, MetricHelp in [
+        ['aws_ami_update_api_calls_total', 'Calls', 'Aws API calls made'],
+        ['aws_ami_update_api_retries_total', 'Retries', 'Aws API call attempts retried'],
+        ['aws_ami_update_api_throttles_total', 'Throttles', 'Aws API call attempts throttled'],
+        ['aws_ami_update_api_errors_total', 'Errors', 'Aws API calls failed'],
+    ]:
+        MetricsFile.write('# HELP {0} {1}\n# TYPE {0} counter\n'.format(MetricName, MetricHelp))
+        for (PhaseName, ServiceName, OperationName), ApiCall in sorted(MetricsSnapshot.items()):
+            MetricsFile.write('{0}{{phase="{1}",service="{2}",operation="{3}"}} {4}\n'.format(MetricName, PhaseName, ServiceName, OperationName, ApiCall[MetricField]))
+    MetricsFile.write('# HELP aws_ami_update_api_latency_seconds Aws API call latency, retries included\n# TYPE aws_ami_update_api_latency_seconds histogram\n')
+    for (PhaseName, ServiceName, OperationName), ApiCall in sorted(MetricsSnapshot.items()):
+        MetricLabels = 'phase="{0}",service="{1}",operation="{2}"'.format(PhaseName, ServiceName, OperationName)
+        BucketCount = 0
+        for LatencyBucket, LatencyCount in zip(UpdateAMI_ApiLatencyBuckets + ['+Inf'], ApiCall['LatencyBuckets']):
+            BucketCount += LatencyCount
+            MetricsFile.write('aws_ami_update_api_latency_seconds_bucket{{{0},le="{1}"}} {2}\n'.format(MetricLabels, LatencyBucket, BucketCount))
+        MetricsFile.write('aws_ami_update_api_latency_seconds_sum{{{0}}} {1:.6f}\n'.format(MetricLabels, ApiCall['Latency']))
+        MetricsFile.write('aws_ami_update_api_latency_seconds_count{{{0}}} {1}\n'.format(MetricLabels, ApiCall['Calls']))
+    return 0
+
+def DefaultBuildSettings():
+    # Settings a new builder starts from, taken from the UpdateAMI_* defaults
+    return {
+        'InstanceType': UpdateAMI_InstanceType,
+        'MaxBakeCost': UpdateAMI_MaxBakeCost,
+        'WaitInterval': UpdateAMI_WaitInterval,
+        'WaitTimeout': UpdateAMI_WaitTimeout,
+        'WaitTerminate': UpdateAMI_WaitTerminate,
+        'BakeCache': UpdateAMI_BakeCache,
+        'WarmPool': UpdateAMI_WarmPool,
+        'WarmMaxGenerations': UpdateAMI_WarmMaxGenerations,
+        'ReapOnFailure': UpdateAMI_ReapOnFailure,
+        'ShareAccounts': list(UpdateAMI_ShareAccounts),
+        'ShareOrganizationalUnits': list(UpdateAMI_ShareOrganizationalUnits),
+        'ShareSnapshotsPublic': UpdateAMI_ShareSnapshotsPublic,
+        'SourceOwners': list(UpdateAMI_SourceOwners),
+        'ConsoleTail': UpdateAMI_ConsoleTail,
+        'ConsoleDoneMarker': UpdateAMI_ConsoleDoneMarker,
+        'ConsoleFailMarker': UpdateAMI_ConsoleFailMarker,
+        'CompletionSignal': UpdateAMI_CompletionSignal,
+        'InstanceProfile': UpdateAMI_InstanceProfile,
+        'UserDataVars': dict(UpdateAMI_UserDataVars),
+        'ShutdownCMD': UpdateAMI_ShutdownCMD,
+        'DebugLevel': DebugLevel if DEBUG else 0,
+    }
+
+def JournalBuildSettings():
+    # Settings that decide how a build runs, journalled so that --resume carries
+    # on the same way. Wait times and debug level are left to the resuming run,
+    # and an in process completion queue cannot be restored by another process.
+    JournalSettings = dict((SettingName, BuildSetting(SettingName)) for SettingName in (
+        'MaxBakeCost', 'WaitTerminate', 'BakeCache', 'WarmPool', 'WarmMaxGenerations', 'ReapOnFailure',
+        'ShareAccounts', 'ShareOrganizationalUnits', 'ShareSnapshotsPublic', 'ConsoleTail', 'ConsoleDoneMarker', 'ConsoleFailMarker',
+        'InstanceProfile', 'UserDataVars', 'ShutdownCMD',
+    ))
+    if (BuildSetting('CompletionSignal') is None or isinstance(BuildSetting('CompletionSignal'), str)):
+        JournalSettings['CompletionSignal'] = BuildSetting('CompletionSignal')
+    return JournalSettings
+
+def CheckBuildSettings(BuildSettings):
+    UnknownSettings = sorted(SettingName for SettingName in BuildSettings if SettingName not in DefaultBuildSettings())
+    if (len(UnknownSettings) > 0):
+        raise BuildInputError('Unknown build settings: {0}'.format(', '.join(UnknownSettings)))
+    return BuildSettings
+
+def BuildSetting(SettingName):
+    # Setting of the build running on this thread, or of its builder outside a build
+    BuildSettings = getattr(BuildContext, 'Settings', None)
+    if (BuildSettings is None):
+        BuildSettings = CurrentBuilder().Settings
+    return BuildSettings[SettingName]
+
+class AmiBuilder(object):
+    # Library entry point. A builder carries its own Aws session, per-region
+    # clients, credential identity, TestRun and build settings. The settings
+    # (see DefaultBuildSettings) start from the UpdateAMI_* defaults, may be
+    # given as keywords here and overridden per Build(). Builds may run on many
+    # threads of one builder, or of several builders, at once; failures raise
+    # AmiUpdateError subclasses rather than exiting.
+    #
+    #   Builder = AmiBuilder(ProfileName='images', AwsRegion='us-west-2', WarmPool=True)
+    #   BuildResult = Builder.Build('ami-14c5486b', 'base-centos7', 'centos7.txt', WaitTimeout=1800)
+    def __init__(self,ProfileName=DefaultProfileName,AwsRegion=DefaultAwsRegion,AwsConfigFile=DefaultAwsConfigFile,AccessKeyId=None,SecretAccessKey=None,TestRun=False,ShutdownCMD=None,MaxPoolConnections=UpdateAMI_MaxPoolConnections,**BuildSettings):
+        self.AwsRegion = AwsRegion
+        self.TestRun = TestRun
+        self.Settings = DefaultBuildSettings()
+        if (ShutdownCMD is not None):
+            self.Settings['ShutdownCMD'] = ShutdownCMD
+        self.Settings.update(CheckBuildSettings(BuildSettings))
+        self.MaxPoolConnections = MaxPoolConnections
+        self.Clients = {}
+        self.ClientsLock = threading.Lock()
+        self.CredentialKey = None
+        self.CredentialExpiry = None
+        self.Identity = {}
+        self.IdentityLock = threading.Lock()
+        self.Session = None
+        InitAwsSession(self, AwsConfigFile, ProfileName, AwsRegion, AccessKeyId, SecretAccessKey)
+
+    def Client(self,ServiceName,AwsRegion=None):
+        # boto3 sessions are not thread safe, clients are. Create each client once
+        # under a lock and share it between builds running in the same region.
+        if (AwsRegion is None):
+            AwsRegion = self.AwsRegion
+        with self.ClientsLock:
+            if (ServiceName,AwsRegion) not in self.Clients:
+                LOGMSG('AmiBuilder.Client.ServiceName: {0} AwsRegion: {1}','DEBUG',3,ServiceName, AwsRegion)
+                self.Clients[(ServiceName,AwsRegion)] = ConfigureAwsClient(self.Session.client(ServiceName,region_name=AwsRegion,config=AwsClientConfig(self.MaxPoolConnections)), AwsRegion, self.CredentialKey)
+            return self.Clients[(ServiceName,AwsRegion)]
+
+    def Run(self,BuildFunction,*args,BuildSettings=None,**kwargs):
+        # Runs BuildFunction with this builder active on the calling thread, and
+        # BuildSettings over the builder's own settings
+        PreviousBuilder = getattr(BuildContext, 'Builder', None)
+        PreviousSettings = getattr(BuildContext, 'Settings', None)
+        BuildContext.Builder = self
+        BuildContext.Settings = dict(self.Settings, **CheckBuildSettings(BuildSettings or {}))
+        try:
+            return BuildFunction(*args, **kwargs)
+        finally:
+            BuildContext.Builder = PreviousBuilder
+            BuildContext.Settings = PreviousSettings
+
+    def Build(self,AwsAmiId,AwsAmiName,UserDataFile=UpdateAMI_UserDataFile,MirrorLaunchPermissions=False,PreserveLog=False,TargetRegions=(),AwsRegion=None,InstanceType=None,**BuildSettings):
+        if (not AwsAmiId.startswith("ami-")):
+            raise SourceAmiError('Invalid AMI id {0}, AMI Ids begin with ami- prefix.'.format(AwsAmiId))
+        AwsRegion = AwsRegion or self.AwsRegion
+        if (InstanceType is not None and not ValidateInstanceType(InstanceType)):
+            raise BuildInputError('Invalid instance type {0}'.format(InstanceType))
+        return self.Run(UpdateAMI, AwsAmiId, AwsAmiName, AwsRegion, UserDataFile, MirrorLaunchPermissions, PreserveLog, ParseTargetRegions(TargetRegions, AwsRegion), InstanceType=InstanceType, BuildSettings=BuildSettings)
+
+    def Resume(self,BuildId,**BuildSettings):
+        # The build carries on with its journalled settings, those given here take precedence
+        BuildInputs = dict(LoadBuildJournal(BuildId)['Inputs'])
+        BuildSettings = dict(BuildInputs.pop('Settings', {}), **BuildSettings)
+        return self.Run(UpdateAMI, BuildId=BuildId, BuildSettings=BuildSettings, **BuildInputs)
+
+    def BuildBatch(self,BatchEntries,MaxWorkers=UpdateAMI_BatchMaxWorkers,PreserveLog=False,**BuildSettings):
+        # Returns one result per entry, failed entries carry their ExitCode
+        return self.Run(RunBatch, BatchEntries, MaxWorkers, PreserveLog, BuildSettings=BuildSettings)
+
+    def CollectGarbage(self,AmiFamilies=None,AwsRegions=None,KeepLatest=UpdateAMI_GcKeepLatest,KeepDays=UpdateAMI_GcKeepDays):
+        # Returns one result per removed (or, with TestRun, removable) Ami
+        return self.Run(CollectImages, AwsRegions or [self.AwsRegion], AmiFamilies, KeepLatest, KeepDays)
+
+    def ResolveSource(self,SourceSpec,AwsRegion=None,**BuildSettings):
+        # Returns the Ami id an ami-, ssm: or name: source currently stands for
+        return self.Run(Resolve_SourceAmi, SourceSpec, AwsRegion or self.AwsRegion, BuildSettings=BuildSettings)['AmiId']
+
+    def Watch(self,SourceSpec,AwsAmiName,UserDataFile=UpdateAMI_UserDataFile,MirrorLaunchPermissions=False,PreserveLog=False,TargetRegions=(),AwsRegion=None,InstanceType=None,WatchInterval=UpdateAMI_WatchInterval,MaxAge=UpdateAMI_WatchMaxAge,MaxCycles=None,**BuildSettings):
+        # Runs until WatchStopped is set or MaxCycles source checks were made
+        AwsRegion = AwsRegion or self.AwsRegion
+        if (InstanceType is not None and not ValidateInstanceType(InstanceType)):
+            raise BuildInputError('Invalid instance type {0}'.format(InstanceType))
+        BuildInputs = {
+            'AwsAmiName': AwsAmiName,
+            'AwsRegion': AwsRegion,
+            'UserDataFile': UserDataFile,
+            'MirrorLaunchPermissions': MirrorLaunchPermissions,
+            'PreserveLog': PreserveLog,
+            'TargetRegions': ParseTargetRegions(TargetRegions, AwsRegion),
+            'InstanceType': InstanceType,
+        }
+        return self.Run(WatchSource, SourceSpec, BuildInputs, WatchInterval, MaxAge, MaxCycles, BuildSettings=BuildSettings)
+
+    def ReapInstances(self,AwsRegions=None,MinAge=UpdateAMI_ReapMinAge,CaptureConsole=False):
+        # Returns one result per orphaned transient instance, in every enabled region by default
+        return self.Run(ReapTransientInstances, AwsRegions, MinAge, CaptureConsole)
+
+def CurrentBuilder():
+    Builder = getattr(BuildContext, 'Builder', None)
+    if (Builder is None):
+        raise AmiUpdateError('No AmiBuilder is active on thread {0}'.format(threading.current_thread().name), 99)
+    return Builder
+
+def BuildContextThread(ThreadFunction):
+    # Wraps ThreadFunction to run on another thread with the calling thread's
+    # builder, build settings, build id and phase
+    Builder = CurrentBuilder()
+    BuildSettings = getattr(BuildContext, 'Settings', None)
+    BuildId = getattr(BuildContext, 'BuildId', None)
+    PhaseName = getattr(BuildContext, 'Phase', None)
+    def ContextThreadFunction(*args,**kwargs):
+        BuildContext.Builder = Builder
+        BuildContext.Settings = BuildSettings
+        SetBuildPhase(PhaseName, BuildId)
+        return ThreadFunction(*args, **kwargs)
+    return ContextThreadFunction
+
+def GetAwsClient(ServiceName,AwsRegion=None):
+    return CurrentBuilder().Client(ServiceName, AwsRegion)
+
 def GetIAM_CurrentUser():
-    global AwsSession
-    iam = AwsSession.client('iam')
+    Builder = CurrentBuilder()
+    if ('UserName' in Builder.Identity):
+        return Builder.Identity['UserName']
+    iam = GetAwsClient('iam')
     response = iam.get_user()
-    LOGMSG('GetIAM_CurrentUser.reponse[User][UserName]: {0}'.format(response['User']['UserName']),'DEBUG',2)
+    LOGMSG('GetIAM_CurrentUser.reponse[User][UserName]: {0}','DEBUG',2,response['User']['UserName'])
+    SaveAwsIdentity(Builder, UserName=response['User']['UserName'])
     return response['User']['UserName']
 
-def ReadUserDataFile(UserDataFile="userdata.txt"):
-    Ec2UserData = ""
-    
+def UserDataFileList(UserDataFile):
+    if (isinstance(UserDataFile, str)):
+        UserDataFile = UserDataFile.split(',')
+    return [UserDataFragment.strip() for UserDataFragment in UserDataFile if UserDataFragment.strip() != '']
+
+def UserDataFileStat(UserDataFile):
+    # What tells a userdata file has changed without reading it, None if it is gone
     try:
-        Ec2UserData_fh = open(UserDataFile)
-        Ec2UserData_lines = ["#!/bin/bash"]
-        for Ec2UserData_line in Ec2UserData_fh:
-            if Ec2UserData_line != "":
-                Ec2UserData_lines.append(Ec2UserData_line)
-        Ec2UserData_lines.append(UpdateAMI_ShutdownCMD)
-    finally:
-        Ec2UserData_fh.close()
+        FileStat = os.stat(UserDataFile)
+    except OSError:
+        return None
+    return [FileStat.st_mtime_ns, FileStat.st_size, FileStat.st_ino]
+
+def ReadUserDataFragment(UserDataFile,IncludeStack=(),FragmentFiles=None):
+    # Returns the lines of UserDataFile, without line endings, with each
+    # '#include <file>' line replaced by the lines of that file. Every file read
+    # is added to FragmentFiles as [path, UserDataFileStat] taken before reading.
+    UserDataFile = os.path.abspath(UserDataFile)
+    if (UserDataFile in IncludeStack or len(IncludeStack) >= UpdateAMI_UserDataIncludeDepth):
+        LOGMSG('Userdata include loop: {0}'.format(' -> '.join(IncludeStack + (UserDataFile,))),'ERROR')
+        raise UserDataError('Userdata include loop: {0}'.format(' -> '.join(IncludeStack + (UserDataFile,))))
+    if (FragmentFiles is not None):
+        FragmentFiles.append([UserDataFile, UserDataFileStat(UserDataFile)])
+    try:
+        with open(UserDataFile) as UserData_fh:
+            FragmentLines = UserData_fh.read().splitlines()
+    except IOError as err:
+        LOGMSG('Unable to read userdata file {0}: {1}'.format(UserDataFile, err),'ERROR')
+        raise UserDataError('Unable to read userdata file {0}: {1}'.format(UserDataFile, err))
+    UserDataLines = []
+    for FragmentLine in FragmentLines:
+        IncludeMatch = re.match(r'#include\s+(\S+)\s*$', FragmentLine)
+        if (IncludeMatch is None):
+            UserDataLines.append(FragmentLine)
+            continue
+        LOGMSG('ReadUserDataFragment.{0}: including {1}','DEBUG',2,UserDataFile, IncludeMatch.group(1))
+        UserDataLines.extend(ReadUserDataFragment(os.path.join(os.path.dirname(UserDataFile), IncludeMatch.group(1)), IncludeStack + (UserDataFile,), FragmentFiles))
+    return UserDataLines
+
+def RenderUserData(UserDataText,UserDataVars):
+    def UserDataVar(VarMatch):
+        if (VarMatch.group(1) not in UserDataVars):
+            LOGMSG('Userdata variable {0} is not set'.format(VarMatch.group(1)),'ERROR')
+            raise UserDataError('Userdata variable {0} is not set, use --userdata-var={0}=<value>'.format(VarMatch.group(1)))
+        return str(UserDataVars[VarMatch.group(1)])
+    return re.sub(r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}', UserDataVar, UserDataText)
+
+def UserDataPartType(UserDataText):
+    # MIME subtype of a fragment that cannot be part of the build script, or None
+    FirstLine = UserDataText.split('\n', 1)[0].strip()
+    if (FirstLine == '#cloud-config'):
+        return 'cloud-config'
+    if (FirstLine == '#cloud-boothook'):
+        return 'cloud-boothook'
+    if (FirstLine.startswith('#!') and FirstLine not in ('#!/bin/bash', '#!/bin/sh', '#!/usr/bin/env bash')):
+        return 'x-shellscript'
+    return None
+
+def ReadUserDataFile(UserDataFile="userdata.txt",UserDataVars=None):
+    # Returns [Ec2UserData, UserDataParts]: the build script made of the bash
+    # fragments, and [MIME subtype, text] of every other fragment. A repeated
+    # bake of unchanged files only stats them, nothing is read or rendered.
+    FragmentKey = json.dumps([
+        [os.path.abspath(UserDataFragment) for UserDataFragment in UserDataFileList(UserDataFile)],
+        UserDataVars or {},
+        BuildSetting('ShutdownCMD') if BuildSetting('CompletionSignal') is None else None,
+    ], sort_keys=True, default=str)
+    with UserDataCacheLock:
+        CachedUserData = UserDataFileCache.get(FragmentKey)
+    if (CachedUserData is not None and all(UserDataFileStat(FragmentFile) == FragmentStat for FragmentFile, FragmentStat in CachedUserData[0])):
+        LOGMSG('ReadUserDataFile: {0} fragment files unchanged','DEBUG',2,len(CachedUserData[0]))
+        return [CachedUserData[1], [list(UserDataPart) for UserDataPart in CachedUserData[2]]]
+    FragmentFiles = []
+    Ec2UserData_lines = ["#!/bin/bash"]
+    UserDataParts = []
+    for UserDataFragment in UserDataFileList(UserDataFile):
+        FragmentText = RenderUserData('\n'.join(ReadUserDataFragment(UserDataFragment, (), FragmentFiles)), UserDataVars or {})
+        FragmentType = UserDataPartType(FragmentText)
+        if (FragmentType is not None):
+            UserDataParts.append([FragmentType, FragmentText])
+            continue
+        FragmentLines = FragmentText.split('\n')
+        if (FragmentLines[0].startswith('#!')):
+            FragmentLines = FragmentLines[1:]
+        Ec2UserData_lines.extend(FragmentLines)
+    # A signalling builder stays up until the image is taken
+    if (BuildSetting('CompletionSignal') is None):
+        Ec2UserData_lines.append(BuildSetting('ShutdownCMD'))
     
     Ec2UserData = '\n'.join(Ec2UserData_lines)
-    LOGMSG('ReadUserDataFile.Ec2UserData: >>>\n{0}'.format(Ec2UserData),'DEBUG',2)
+    LOGMSG('ReadUserDataFile.Ec2UserData: >>>\n{0}','DEBUG',2,Ec2UserData)
     LOGMSG('ReadUserDataFile.Ec2UserData: <<<END','DEBUG',2)
-    return Ec2UserData
+    with UserDataCacheLock:
+        UserDataFileCache[FragmentKey] = [FragmentFiles, Ec2UserData, [list(UserDataPart) for UserDataPart in UserDataParts]]
+    return [Ec2UserData, UserDataParts]
+
+def EncodeUserData(Ec2UserData,UserDataParts=(),RunAlways=False):
+    # Returns the userdata to launch with, the script alone or a cloud-init
+    # multipart ending with it. Results are kept by content, so repeated bakes
+    # of the same fragments skip the assembly and compression.
+    UserDataKey = hashlib.sha256(json.dumps([Ec2UserData, list(UserDataParts), RunAlways]).encode('utf-8')).hexdigest()
+    with UserDataCacheLock:
+        if (UserDataKey in UserDataCache):
+            return UserDataCache[UserDataKey]
+    if (len(UserDataParts) == 0 and not RunAlways):
+        UserDataText = Ec2UserData
+    else:
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        # A boundary taken from the content keeps the userdata the same from bake to bake
+        MultipartUserData = MIMEMultipart(boundary='==AwsAmiUpdate{0}=='.format(UserDataKey[:32]))
+        if (RunAlways):
+            # cloud-init only runs user scripts on the first boot of an instance, ask it
+            # to run them on every boot so a restarted builder executes the new script.
+            MultipartUserData.attach(MIMEText('#cloud-config\ncloud_final_modules:\n- [scripts-user, always]\n', 'cloud-config'))
+        for PartType, PartText in UserDataParts:
+            MultipartUserData.attach(MIMEText(PartText, PartType))
+        MultipartUserData.attach(MIMEText(Ec2UserData, 'x-shellscript'))
+        UserDataText = MultipartUserData.as_string()
+    UserData = UserDataText.encode('utf-8')
+    if (len(UserData) > UpdateAMI_UserDataGzipMin):
+        import gzip
+        CompressedUserData = gzip.compress(UserData, 9, mtime=0)
+        if (len(CompressedUserData) < len(UserData)):
+            LOGMSG('Userdata of {0} bytes compressed to {1} bytes'.format(len(UserData), len(CompressedUserData)))
+            UserData = CompressedUserData
+    if (len(UserData) > UpdateAMI_UserDataMaxSize):
+        LOGMSG('Userdata is {0} bytes, more than the {1} bytes Ec2 accepts'.format(len(UserData), UpdateAMI_UserDataMaxSize),'ERROR')
+        raise UserDataError('Userdata is {0} bytes, more than the {1} bytes Ec2 accepts'.format(len(UserData), UpdateAMI_UserDataMaxSize))
+    with UserDataCacheLock:
+        UserDataCache[UserDataKey] = UserData
+    return UserData
+
+def BuilderLaunchOptions():
+    # run_instances arguments the build settings add to every builder launch
+    LaunchOptions = {}
+    InstanceProfile = BuildSetting('InstanceProfile')
+    if (InstanceProfile is not None):
+        LaunchOptions['IamInstanceProfile'] = {'Arn': InstanceProfile} if InstanceProfile.startswith('arn:') else {'Name': InstanceProfile}
+    return LaunchOptions
+
+def SourceLaunchPermissions(AwsAmiId,AwsRegion):
+    # Launch permissions of the source Ami to mirror, None when they cannot be read
+    try:
+        AmiAttributes = GetAwsClient('ec2',AwsRegion).describe_image_attribute(
+            Attribute='launchPermission',
+            ImageId=AwsAmiId,
+            DryRun=False,
+        )
+        # Read image launcPermissions
+        LaunchPermissions = AmiAttributes['LaunchPermissions']
+        LOGMSG('SourceLaunchPermissions.LaunchPermissions: {0}','DEBUG',2,LaunchPermissions)
+        return LaunchPermissions
+    except exceptions.ClientError as err:
+        ExceptionReturn = BotoExceptionHandling(err)
+        if (ExceptionReturn == 1):
+            raise SourceAmiError(str(err))
+        elif (ExceptionReturn == 2):
+            #LaunchPemission access denied can be caused by using AWS provided image as source
+            LOGMSG('Unable to mirror Launch Permissions. Access Denied.','WARN')
+            return None
+        else:
+            raise SourceAmiError(str(err), ExceptionReturn)
 
-def Verify_AMI(AwsAmiId,AwsRegion=DefaultAwsRegion,MirrorLaunchPermissions=False):
+def Verify_AMI(AwsAmiId,AwsRegion=DefaultAwsRegion,MirrorLaunchPermissions=False,InstanceType=UpdateAMI_InstanceType):
     LaunchPermissions=None
     if(not AwsAmiId.startswith("ami-")):
         LOGMSG('Invalid AMI id, AMI Ids begin with ami- prefix.','ERROR')
-        show_usage()
-    LOGMSG('Verify_AMI.AwsAmiId: {0}'.format(AwsAmiId),'DEBUG',3)
-    LOGMSG('Verify_AMI.AwsRegion: {0}'.format(AwsRegion),'DEBUG',3)
+        raise SourceAmiError('Invalid AMI id {0}'.format(AwsAmiId))
+    LOGMSG('Verify_AMI.AwsAmiId: {0}','DEBUG',3,AwsAmiId)
+    LOGMSG('Verify_AMI.AwsRegion: {0}','DEBUG',3,AwsRegion)
     #ec2_udata = UpdateAMI_Ec2UserData
 
     # Retrieve image launchPermissions
     if (MirrorLaunchPermissions):
-        try:
-            AmiAttributes = Ec2Client.describe_image_attribute(
-                Attribute='launchPermission',
-                ImageId=AwsAmiId,
-                DryRun=False,
-            )
-            # Read image launcPermissions
-            #global UpdateAMI_SourceLaunchPermissions
-            #UpdateAMI_SourceLaunchPermissions = AmiAttributes['LaunchPermissions']
-            LaunchPermissions = AmiAttributes['LaunchPermissions']
-            LOGMSG('Verify_AMI.UpdateAMI_SourceLaunchPermissions: {0}'.format(LaunchPermissions),'DEBUG',2)
-        except exceptions.ClientError as err:
-            ExceptionReturn = BotoExceptionHandling(err)
-            if (ExceptionReturn is 1):
-                sys.exit(1)
-            elif (ExceptionReturn is 2):
-                #LaunchPemission access denied can be caused by using AWS provided image as source
-                LOGMSG('Unable to mirror Launch Permissions. Access Denied.','WARN')
-            else:
-                sys.exit(ExceptionReturn)
+        LaunchPermissions = SourceLaunchPermissions(AwsAmiId, AwsRegion)
 
     # DryRun of Ec2 Launch
     try:
-        response = Ec2Client.run_instances(
+        response = GetAwsClient('ec2',AwsRegion).run_instances(
             ImageId=AwsAmiId,
-            InstanceType='t2.micro',
+            InstanceType=InstanceType,
             DryRun=True,
             InstanceInitiatedShutdownBehavior='stop',
             MinCount=1,
             MaxCount=1,
+            **BuilderLaunchOptions()
         )
     except exceptions.ClientError as err:
         ExceptionReturn = BotoExceptionHandling(err)
-        if (ExceptionReturn is 0):
+        if (ExceptionReturn == 0):
             response = 0
             return [response, LaunchPermissions]
-        elif (ExceptionReturn is 1):
-            sys.exit(1)
-        elif (ExceptionReturn is 2):
+        elif (ExceptionReturn == 1):
+            raise SourceAmiError(str(err))
+        elif (ExceptionReturn == 2):
             LOGMSG('Authentication Failure','ERROR')
-            sys.exit(1)
+            raise AwsAuthError('Authentication Failure')
         else:
-            sys.exit(ExceptionReturn)
+            raise SourceAmiError(str(err), ExceptionReturn)
     return [98, None]
 
-def Create_Ec2(AwsAmiId,AwsRegion=DefaultAwsRegion,Ec2UserData=UpdateAMI_Ec2UserData,TestRun=True):
-    LOGMSG('Create_Ec2.AwsAmiId: {0}'.format(AwsAmiId),'DEBUG',3)
-    LOGMSG('Create_Ec2.AwsRegion: {0}'.format(AwsRegion),'DEBUG',3)
+def Create_Ec2(AwsAmiId,AwsRegion=DefaultAwsRegion,Ec2UserData=UpdateAMI_Ec2UserData,TestRun=True,ExtraTags=(),InstanceType=UpdateAMI_InstanceType):
+    LOGMSG('Create_Ec2.AwsAmiId: {0}','DEBUG',3,AwsAmiId)
+    LOGMSG('Create_Ec2.AwsRegion: {0}','DEBUG',3,AwsRegion)
     
     debug_Ec2UserData = """#!/bin/bash
 /usr/bin/yum -y update
 echo "/sbin/halt -n" | /usr/bin/at now + 1 minute"""
-    LOGMSG('Create_Ec2.Ec2UserData: >>>\n{0}'.format(Ec2UserData),'DEBUG',3)
+    LOGMSG('Create_Ec2.Ec2UserData: >>>\n{0}','DEBUG',3,Ec2UserData)
     LOGMSG('Create_Ec2.Ec2UserData: <<<END','DEBUG',3)
     try:
         AwsCurrentUserName = GetIAM_CurrentUser()
-        LOGMSG('Create_Ec2.AwsCurrentUserName: {0}'.format(AwsCurrentUserName),'DEBUG',3)
-        response = Ec2Client.run_instances(
+        LOGMSG('Create_Ec2.AwsCurrentUserName: {0}','DEBUG',3,AwsCurrentUserName)
+        response = GetAwsClient('ec2',AwsRegion).run_instances(
             ImageId=AwsAmiId,
-            InstanceType='t2.micro',
+            InstanceType=InstanceType,
             DryRun=TestRun,
             InstanceInitiatedShutdownBehavior='stop',
             MinCount=1,
@@ -246,28 +1118,29 @@ echo "/sbin/halt -n" | /usr/bin/at now + 1 minute"""
                             'Key': 'Name',
                             'Value': 'Aws-Ami-Update Transient Instance',
                         },
-                    ]
+                    ] + list(ExtraTags)
                 },
             ],
             UserData=Ec2UserData,
+            **BuilderLaunchOptions()
         )
     except exceptions.ClientError as err:
         ExceptionReturn = BotoExceptionHandling(err)
         if (ExceptionReturn == 1):
-            sys.exit(2)
+            raise InstanceError(str(err), 2)
         elif (ExceptionReturn == 2):
             LOGMSG('Authentication Failure','ERROR')
-            sys.exit(2)
+            raise AwsAuthError('Authentication Failure', 2)
     if (TestRun is False):
         LOGMSG(response,'DEBUG',4)
         Ec2InstanceState = response['Instances'][0]['State']['Code']
         Ec2InstanceStateDesc = response['Instances'][0]['State']['Name']
         Ec2InstanceId = response['Instances'][0]['InstanceId']
-        LOGMSG('Create_Ec2.Ec2InstanceVpcId: {0}'.format(response['Instances'][0]['VpcId']),'DEBUG',2)
-        LOGMSG('Create_Ec2.Ec2InstanceSubnetId: {0}'.format(response['Instances'][0]['SubnetId']),'DEBUG',2)
-        LOGMSG('Create_Ec2.Ec2InstanceState: {0}'.format(str(Ec2InstanceState)),'DEBUG',1)
-        LOGMSG('Create_Ec2.Ec2InstanceStateDesc: {0}'.format(Ec2InstanceStateDesc),'DEBUG',1)
-        LOGMSG('Create_Ec2.Ec2InstanceId: {0}'.format(Ec2InstanceId),'DEBUG',1)
+        LOGMSG('Create_Ec2.Ec2InstanceVpcId: {0}','DEBUG',2,response['Instances'][0]['VpcId'])
+        LOGMSG('Create_Ec2.Ec2InstanceSubnetId: {0}','DEBUG',2,response['Instances'][0]['SubnetId'])
+        LOGMSG('Create_Ec2.Ec2InstanceState: {0}','DEBUG',1,str(Ec2InstanceState))
+        LOGMSG('Create_Ec2.Ec2InstanceStateDesc: {0}','DEBUG',1,Ec2InstanceStateDesc)
+        LOGMSG('Create_Ec2.Ec2InstanceId: {0}','DEBUG',1,Ec2InstanceId)
 #        LOGMSG('Create_Ec2.Ec2InstancePublicDnsName: {0}'.format(response['Instances'][0]['PublicDnsName'])
 #        LOGMSG('Create_Ec2.Ec2InstancePublicIpAddress: {0}'.format(response['Instances'][0]['PublicIpAddress'])
         return {'Ec2InstanceState':str(Ec2InstanceState), 'Ec2InstanceId':str(Ec2InstanceId), }
@@ -275,27 +1148,119 @@ echo "/sbin/halt -n" | /usr/bin/at now + 1 minute"""
         return {'Ec2InstanceState':str('1'), 'Ec2InstanceId':str(0), }
     return {'Ec2InstanceState':str(99), 'Ec2InstanceId':str(0), }
 
+def Get_Ec2ConsoleLog(Ec2InstanceId, AwsRegion):
+    try:
+        response = GetAwsClient('ec2',AwsRegion).get_console_output(
+            InstanceId=Ec2InstanceId,
+            DryRun=False
+        )
+    except exceptions.ClientError as err:
+        ExceptionReturn = BotoExceptionHandling(err)
+        if (ExceptionReturn == 1):
+            raise InstanceError(str(err), 2)
+        elif (ExceptionReturn == 2):
+            LOGMSG('Authentication Failure','ERROR')
+            raise AwsAuthError('Authentication Failure', 2)
+    ConsoleLog=response.get('Output', '')
+    LOGMSG('Get_Ec2ConsoleLog.ConsoleLog.Ouput: <<<\n{0}'.format(ConsoleLog))
+    LOGMSG('Get_Ec2ConsoleLog.ConsoleLog.Output: <<<END')
+    return ConsoleLog
+
+class ConsoleTailer(object):
+    # Fetches the console of a running builder every UpdateAMI_ConsoleTailInterval
+    # seconds and appends only what is new to the build's console log. Once the
+    # done marker shows the instance is polled at the minimum interval until the
+    # stop is seen, the fail marker fails the wait immediately.
+    def __init__(self,Ec2InstanceId,AwsRegion,BuildId):
+        self.Ec2InstanceId = Ec2InstanceId
+        self.AwsRegion = AwsRegion
+        self.BuildId = BuildId
+        self.ConsoleLogFile = os.path.join(UpdateAMI_BuildJournalDir, '{0}.console.log'.format(BuildId))
+        self.ConsoleSeen = ''
+        self.ConsoleLatest = True
+        self.DoneSeen = False
+        self.Stopped = threading.Event()
+        self.TailThread = None
+
+    def Start(self):
+        LOGMSG('Following console of {0} in {1}'.format(self.Ec2InstanceId, self.ConsoleLogFile))
+        self.TailThread = threading.Thread(target=BuildContextThread(self.TailLoop), name='ConsoleTailer-{0}'.format(self.Ec2InstanceId))
+        self.TailThread.daemon = True
+        self.TailThread.start()
+        return self
+
+    def Stop(self):
+        self.Stopped.set()
+        self.TailThread.join()
+        return 0
+
+    def TailLoop(self):
+        SetBuildPhase('console-tail', self.BuildId)
+        TailInterval = UpdateAMI_ConsoleTailInterval
+        while True:
+            Stopping = self.Stopped.wait(TailInterval)
+            try:
+                self.Tail()
+            except Exception as err:
+                LOGMSG('ConsoleTailer.{0}: {1}','DEBUG',1,self.Ec2InstanceId,err)
+            if (Stopping or self.Stopped.is_set()):
+                return 0
+            if (self.DoneSeen):
+                TailInterval = UpdateAMI_WaitMinInterval
+                GetStatusPoller(self.AwsRegion).Interrupt('instance', self.Ec2InstanceId)
+
+    def FetchConsole(self):
+        Ec2 = GetAwsClient('ec2',self.AwsRegion)
+        if (self.ConsoleLatest):
+            # Only Nitro instances serve the live console, others answer with the last snapshot
+            try:
+                return Ec2.get_console_output(InstanceId=self.Ec2InstanceId, Latest=True).get('Output', '')
+            except exceptions.ClientError as err:
+                LOGMSG('ConsoleTailer.{0}.Latest: {1}','DEBUG',2,self.Ec2InstanceId,err)
+                self.ConsoleLatest = False
+        return Ec2.get_console_output(InstanceId=self.Ec2InstanceId).get('Output', '')
+
+    def Tail(self):
+        ConsoleOutput = self.FetchConsole()
+        ConsoleNew = NewConsoleOutput(self.ConsoleSeen, ConsoleOutput)
+        if (len(ConsoleNew) == 0):
+            return 0
+        ConsoleDoneMarker = BuildSetting('ConsoleDoneMarker')
+        ConsoleFailMarker = BuildSetting('ConsoleFailMarker')
+        MarkerWindow = self.ConsoleSeen[-max(len(ConsoleDoneMarker), len(ConsoleFailMarker)):] + ConsoleNew
+        self.ConsoleSeen = ConsoleOutput
+        with open(self.ConsoleLogFile, 'a') as ConsoleLog_fh:
+            ConsoleLog_fh.write(ConsoleNew)
+        for ConsoleLine in ConsoleNew.splitlines():
+            LOGMSG('Console.{0}: {1}','DEBUG',1,self.Ec2InstanceId,ConsoleLine)
+        if (ConsoleFailMarker in MarkerWindow):
+            LOGMSG('Userdata on {0} reported failure, see {1}'.format(self.Ec2InstanceId, self.ConsoleLogFile),'ERROR')
+            GetStatusPoller(self.AwsRegion).Interrupt('instance', self.Ec2InstanceId, UserDataError('Userdata on {0} reported failure'.format(self.Ec2InstanceId), 10))
+            self.Stopped.set()
+        elif (ConsoleDoneMarker in MarkerWindow and not self.DoneSeen):
+            LOGMSG('Userdata on {0} finished'.format(self.Ec2InstanceId))
+            self.DoneSeen = True
+            GetStatusPoller(self.AwsRegion).Interrupt('instance', self.Ec2InstanceId)
+        return 0
+
+def NewConsoleOutput(ConsoleSeen,ConsoleOutput):
+    # The console is a window over the most recent output, find where the last
+    # fetch ended in the new one. Without overlap everything is new.
+    if (ConsoleOutput.startswith(ConsoleSeen)):
+        return ConsoleOutput[len(ConsoleSeen):]
+    ConsoleAnchor = ConsoleSeen[-UpdateAMI_ConsoleAnchorSize:]
+    AnchorPosition = ConsoleOutput.find(ConsoleAnchor)
+    if (AnchorPosition < 0):
+        return ConsoleOutput
+    return ConsoleOutput[AnchorPosition + len(ConsoleAnchor):]
+
 def Terminate_Ec2(Ec2InstanceId, AwsRegion, PreserveLog=False, TestRun=True):
-    LOGMSG('Terminate_Ec2.Ec2InstanceId: {0}'.format(Ec2InstanceId),'DEBUG',1)
-    LOGMSG('Terminate_Ec2.AwsRegion: {0}'.format(AwsRegion),'DEBUG',2)
+    LOGMSG('Terminate_Ec2.Ec2InstanceId: {0}','DEBUG',1,Ec2InstanceId)
+    LOGMSG('Terminate_Ec2.AwsRegion: {0}','DEBUG',2,AwsRegion)
     if (PreserveLog):
-        try:
-            response = Ec2Client.get_console_output(
-                InstanceId=Ec2InstanceId,
-                DryRun=False
-            )
-        except exceptions.ClientError as err:
-            ExceptionReturn = BotoExceptionHandling(err)
-            if (ExceptionReturn is 1):
-                sys.exit(2)
-            elif (ExceptionReturn is 2):
-                LOGMSG('Authentication Failure','ERROR')
-                sys.exit(2)
-        ConsoleLog=response['Output']
-        LOGMSG('Terminate_Ec2.ConsoleLog.Ouput: <<<\n{0}'.format(ConsoleLog))
-        LOGMSG('Terminate_EC2.ConsoleLog.Output: <<<END')
+        Get_Ec2ConsoleLog(Ec2InstanceId, AwsRegion)
     try:
-        response = Ec2Client.terminate_instances(
+        response = GetAwsClient('ec2',AwsRegion).terminate_instances(
             InstanceIds=[
                 Ec2InstanceId,
             ],
@@ -303,28 +1268,531 @@ def Terminate_Ec2(Ec2InstanceId, AwsRegion, PreserveLog=False, TestRun=True):
         )
     except exceptions.ClientError as err:
         ExceptionReturn = BotoExceptionHandling(err)
-        if (ExceptionReturn is 1):
-            sys.exit(2)
-        elif (ExceptionReturn is 2):
+        if (ExceptionReturn == 1):
+            raise InstanceError(str(err), 2)
+        elif (ExceptionReturn == 2):
             LOGMSG('Authentication Failure','ERROR')
-            sys.exit(2)
+            raise AwsAuthError('Authentication Failure', 2)
     if (TestRun is False):
         Ec2InstanceState = response['TerminatingInstances'][0]['CurrentState']['Code']
         Ec2InstanceStateDesc = response['TerminatingInstances'][0]['CurrentState']['Name']
         Ec2InstancePrevState = response['TerminatingInstances'][0]['PreviousState']['Code']
         Ec2InstancePrevStateDesc = response['TerminatingInstances'][0]['PreviousState']['Name']
         Ec2InstanceId = response['TerminatingInstances'][0]['InstanceId']
-        LOGMSG('Terminate_Ec2.Ec2InstancePrevState: {0}'.format(str(Ec2InstancePrevState)),'DEBUG',3)
-        LOGMSG('Terminate_Ec2.Ec2InstancePrevStateDesc: {0}'.format(Ec2InstancePrevStateDesc),'DEBUG',3)
-        LOGMSG('Terminate_Ec2.Ec2InstanceState: {0}'.format(str(Ec2InstanceState)),'DEBUG',2)
-        LOGMSG('Terminate_Ec2.Ec2InstanceStateDesc: {0}'.format(Ec2InstanceStateDesc),'DEBUG',2)
-        LOGMSG('Terminate_Ec2.Ec2InstanceId: {0}'.format(Ec2InstanceId),'DEBUG',2)
+        LOGMSG('Terminate_Ec2.Ec2InstancePrevState: {0}','DEBUG',3,str(Ec2InstancePrevState))
+        LOGMSG('Terminate_Ec2.Ec2InstancePrevStateDesc: {0}','DEBUG',3,Ec2InstancePrevStateDesc)
+        LOGMSG('Terminate_Ec2.Ec2InstanceState: {0}','DEBUG',2,str(Ec2InstanceState))
+        LOGMSG('Terminate_Ec2.Ec2InstanceStateDesc: {0}','DEBUG',2,Ec2InstanceStateDesc)
+        LOGMSG('Terminate_Ec2.Ec2InstanceId: {0}','DEBUG',2,Ec2InstanceId)
         return {'Ec2InstanceState':str(Ec2InstanceState), 'Ec2InstanceId':str(Ec2InstanceId), }
     else:
         return {'Ec2InstanceState':str('1'), 'Ec2InstanceId':str(0), }
     return {'Ec2InstanceState':str(99), 'Ec2InstanceId':str(0), }    
 
-def WaitInstanceState(Ec2InstanceId, AwsRegion, Ec2InstanceStateCode, Ec2DesiredInstanceStateCode=80, WaitInstanceStateLoopInterval=60, WaitInstanceStateTimeout=900, TestRun=False):
+def Find_WarmBuilder(AwsAmiId,AwsAmiName,AwsRegion,BuildId):
+    # Returns [InstanceId, Generation, InstanceType] of a stopped builder for this image family, or None
+    with WarmPoolLock:
+        response = GetAwsClient('ec2',AwsRegion).describe_instances(
+            Filters=[
+                {'Name': 'tag:{0}'.format(UpdateAMI_FamilyTag), 'Values': [AwsAmiName]},
+                {'Name': 'tag:{0}'.format(UpdateAMI_WarmSourceTag), 'Values': [AwsAmiId]},
+                {'Name': 'instance-state-name', 'Values': ['stopped']},
+            ],
+        )
+        WarmBuilders = []
+        for Reservation in response['Reservations']:
+            for Instance in Reservation['Instances']:
+                InstanceTags = dict((Tag['Key'], Tag['Value']) for Tag in Instance.get('Tags', []))
+                if (InstanceTags.get(UpdateAMI_WarmClaimTag, '') != ''):
+                    continue
+                WarmBuilders.append([Instance['InstanceId'], int(InstanceTags.get(UpdateAMI_WarmGenerationTag, 0)), Instance.get('InstanceType')])
+        LOGMSG('Find_WarmBuilder.WarmBuilders: {0}','DEBUG',2,WarmBuilders)
+        WarmBuilders = [WarmBuilder for WarmBuilder in WarmBuilders if WarmBuilder[1] < BuildSetting('WarmMaxGenerations')]
+        if (len(WarmBuilders) == 0):
+            return None
+        WarmBuilder = sorted(WarmBuilders, key=lambda WarmBuilder: WarmBuilder[1])[-1]
+        GetAwsClient('ec2',AwsRegion).create_tags(
+            Resources=[WarmBuilder[0]],
+            Tags=[{'Key': UpdateAMI_WarmClaimTag, 'Value': BuildId}, ],
+        )
+    return WarmBuilder
+
+def Start_WarmBuilder(Ec2InstanceId,AwsRegion,Ec2UserData,Generation,InstanceType=None):
+    LOGMSG('Reusing warm builder InstanceId {0} (generation {1})'.format(Ec2InstanceId, Generation))
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    if (InstanceType is not None):
+        # A stopped builder can be resized, keep it rather than building a new one
+        LOGMSG('Changing warm builder InstanceId {0} to {1}'.format(Ec2InstanceId, InstanceType))
+        Ec2.modify_instance_attribute(
+            InstanceId=Ec2InstanceId,
+            InstanceType={'Value': InstanceType},
+        )
+    Ec2.modify_instance_attribute(
+        InstanceId=Ec2InstanceId,
+        UserData={'Value': Ec2UserData},
+    )
+    Ec2.create_tags(
+        Resources=[Ec2InstanceId],
+        Tags=[
+            {'Key': 'Name', 'Value': 'Aws-Ami-Update Transient Instance'},
+            {'Key': UpdateAMI_WarmGenerationTag, 'Value': str(Generation + 1)},
+        ],
+    )
+    if (BuildSetting('CompletionSignal') == 'tag'):
+        # The status the builder reported for its last bake would complete this one at once
+        Ec2.delete_tags(
+            Resources=[Ec2InstanceId],
+            Tags=[{'Key': UpdateAMI_CompletionTag}],
+        )
+    response = Ec2.start_instances(InstanceIds=[Ec2InstanceId])
+    LOGMSG('Start_WarmBuilder.response: {0}','DEBUG',4,response)
+    # A just started instance can still be reported as stopped, wait until it
+    # has been seen running before waiting for the userdata to stop it again
+    if (WaitInstanceState(Ec2InstanceId, AwsRegion, None, 16) != 0):
+        return 98
+    return 0
+
+def Park_WarmBuilder(Ec2InstanceId,AwsRegion,AwsAmiId,StopBuilder=False):
+    # Keep the stopped builder for the next bake of this family instead of terminating it
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    if (StopBuilder):
+        # A builder that signalled completion never halted, and the image reboot
+        # has started its userdata again; only a stopped builder is found for reuse
+        LOGMSG('Stopping warm builder InstanceId {0}'.format(Ec2InstanceId))
+        Ec2.stop_instances(InstanceIds=[Ec2InstanceId])
+        if (WaitInstanceState(Ec2InstanceId, AwsRegion, None, 80) != 0):
+            LOGMSG('Warm builder InstanceId {0} did not stop'.format(Ec2InstanceId),'ERROR')
+            raise InstanceError('Warm builder {0} did not stop'.format(Ec2InstanceId), 7)
+    Ec2.create_tags(
+        Resources=[Ec2InstanceId],
+        Tags=[
+            {'Key': 'Name', 'Value': 'Aws-Ami-Update Warm Builder'},
+            {'Key': 'AwsAmiUpdate:LastAmiId', 'Value': AwsAmiId},
+            {'Key': UpdateAMI_WarmClaimTag, 'Value': ''},
+        ],
+    )
+    LOGMSG('Warm builder InstanceId {0} parked for reuse'.format(Ec2InstanceId))
+    return 0
+
+def PollIntervals(MaxInterval,ExpectedDuration=None,MinInterval=UpdateAMI_WaitMinInterval):
+    # Yield sleep intervals for a state wait. When previous runs give an expected
+    # duration the first check is scheduled shortly before it, after that polling
+    # starts short and backs off with jitter up to MaxInterval.
+    MinInterval = min(MinInterval, MaxInterval)
+    if (ExpectedDuration is not None and ExpectedDuration * UpdateAMI_WaitHistoryLead > MinInterval):
+        yield ExpectedDuration * UpdateAMI_WaitHistoryLead
+    PollInterval = MinInterval
+    while True:
+        yield random.uniform(PollInterval / 2.0, PollInterval)
+        PollInterval = min(MaxInterval, PollInterval * UpdateAMI_WaitBackoff)
+
+def LoadPhaseHistory():
+    try:
+        with open(UpdateAMI_PhaseHistoryFile) as PhaseHistory_fh:
+            return json.load(PhaseHistory_fh)
+    except (IOError, ValueError):
+        return {}
+
+def BakeProfileKey(AwsAmiName,InstanceType,WarmStart=False):
+    # Phase history key of the launch to stop duration of a family on one instance
+    # type. A restarted warm builder only applies updates since its last bake and
+    # is kept apart from the cold bakes SelectInstanceType plans with.
+    return '{0}:{1}:{2}'.format('bake-warm' if WarmStart else 'bake', AwsAmiName, InstanceType)
+
+def SelectInstanceType(AwsAmiId,AwsAmiName,AwsRegion):
+    # Picks the candidate builder type expected to bake AwsAmiName fastest
+    # without its expected cost exceeding UpdateAMI_MaxBakeCost, or the
+    # cheapest expected bake if none is affordable
+    try:
+        Images = GetAwsClient('ec2',AwsRegion).describe_images(ImageIds=[AwsAmiId])['Images']
+    except exceptions.ClientError as err:
+        ExceptionReturn = BotoExceptionHandling(err)
+        if (ExceptionReturn == 2):
+            LOGMSG('Authentication Failure','ERROR')
+            raise AwsAuthError('Authentication Failure')
+        raise SourceAmiError(str(err))
+    if (len(Images) == 0):
+        LOGMSG('ami id not found, verify ami id and aws region.','ERROR')
+        raise SourceAmiError('Source Ami {0} not found in {1}'.format(AwsAmiId, AwsRegion))
+    Image = Images[0]
+    CandidateKey = Image.get('Architecture')
+    if (Image.get('VirtualizationType') == 'paravirtual'):
+        CandidateKey = 'paravirtual'
+    elif (CandidateKey == 'x86_64' and not Image.get('EnaSupport', False)):
+        CandidateKey = 'x86_64-xen'
+    LOGMSG('SelectInstanceType.CandidateKey: {0}','DEBUG',1,CandidateKey)
+    if (CandidateKey not in UpdateAMI_InstanceTypeCandidates):
+        LOGMSG('No builder instance types known for {0} ({1})'.format(AwsAmiId, CandidateKey),'ERROR')
+        raise SourceAmiError('No builder instance types known for {0} ({1})'.format(AwsAmiId, CandidateKey))
+    Candidates = UpdateAMI_InstanceTypeCandidates[CandidateKey]
+    with PhaseHistoryLock:
+        PhaseHistory = LoadPhaseHistory()
+    RecordedDurations = {}
+    for InstanceType, HourlyPrice, BuildSpeed in Candidates:
+        BakeDurations = sorted(PhaseHistory.get(BakeProfileKey(AwsAmiName, InstanceType), []))
+        if (len(BakeDurations) > 0):
+            RecordedDurations[InstanceType] = BakeDurations[len(BakeDurations) // 2]
+    # Work of one bake in seconds at speed 1.0, as seen on the types already used
+    BakeWork = sorted(RecordedDurations[InstanceType] * BuildSpeed for InstanceType, HourlyPrice, BuildSpeed in Candidates if InstanceType in RecordedDurations)
+    if (len(BakeWork) > 0):
+        BakeWork = BakeWork[len(BakeWork) // 2]
+    else:
+        BakeWork = UpdateAMI_BakeReferenceDuration
+    BakeEstimates = []
+    for InstanceType, HourlyPrice, BuildSpeed in Candidates:
+        BakeDuration = RecordedDurations.get(InstanceType, BakeWork / BuildSpeed)
+        BakeCost = HourlyPrice * BakeDuration / 3600
+        LOGMSG('SelectInstanceType.{0}: {1:.0f}s ${2:.4f} recorded: {3}','DEBUG',1,InstanceType, BakeDuration, BakeCost, InstanceType in RecordedDurations)
+        BakeEstimates.append([BakeDuration, BakeCost, InstanceType])
+    AffordableEstimates = [BakeEstimate for BakeEstimate in BakeEstimates if BakeEstimate[1] <= BuildSetting('MaxBakeCost')]
+    if (len(AffordableEstimates) > 0):
+        BakeDuration, BakeCost, InstanceType = min(AffordableEstimates, key=lambda BakeEstimate: (BakeEstimate[0], BakeEstimate[1]))
+    else:
+        BakeDuration, BakeCost, InstanceType = min(BakeEstimates, key=lambda BakeEstimate: (BakeEstimate[1], BakeEstimate[0]))
+        LOGMSG('No builder type bakes {0} within ${1:.2f}, using the cheapest'.format(AwsAmiName, BuildSetting('MaxBakeCost')),'WARN')
+    LOGMSG('Builder instance type: {0} (expected bake {1:.0f}s, ${2:.4f})'.format(InstanceType, BakeDuration, BakeCost))
+    return InstanceType
+
+def ExpectedPhaseDuration(PhaseKey):
+    if (PhaseKey is None):
+        return None
+    with PhaseHistoryLock:
+        PhaseDurations = sorted(LoadPhaseHistory().get(PhaseKey, []))
+    if (len(PhaseDurations) == 0):
+        return None
+    LOGMSG('ExpectedPhaseDuration.{0}: {1}','DEBUG',3,PhaseKey, PhaseDurations)
+    return PhaseDurations[len(PhaseDurations) // 2]
+
+def RecordPhaseDuration(PhaseKey,PhaseDuration):
+    if (PhaseKey is None or CurrentBuilder().TestRun):
+        return 0
+    with PhaseHistoryLock:
+        PhaseHistory = LoadPhaseHistory()
+        PhaseHistory[PhaseKey] = (PhaseHistory.get(PhaseKey, []) + [round(PhaseDuration, 1)])[-UpdateAMI_PhaseHistorySamples:]
+        try:
+            if (not os.path.isdir(UpdateAMI_StateDir)):
+                os.makedirs(UpdateAMI_StateDir)
+            with open(UpdateAMI_PhaseHistoryFile + '.tmp', 'w') as PhaseHistory_fh:
+                json.dump(PhaseHistory, PhaseHistory_fh)
+            os.rename(UpdateAMI_PhaseHistoryFile + '.tmp', UpdateAMI_PhaseHistoryFile)
+        except (IOError, OSError) as err:
+            LOGMSG('Unable to record phase history: {0}','DEBUG',1,err)
+    return 0
+
+class Ec2StatusPoller(object):
+    # Coalesces the state checks of every build waiting in one region. Waiters
+    # register the resource they want and when they want it checked; a single
+    # thread issues one batched describe call per resource type for all of them
+    # and hands each waiter the state it asked about.
+    def __init__(self,Builder,AwsRegion):
+        self.Builder = Builder
+        self.AwsRegion = AwsRegion
+        self.Condition = threading.Condition()
+        self.Requests = []
+        self.PollThread = None
+
+    def WaitState(self,ResourceType,ResourceId,LastState,DueTime):
+        # Returns the state of ResourceId observed at or after DueTime, or earlier
+        # if a poll for another waiter sees it move away from LastState.
+        Request = {'Key': (ResourceType, ResourceId), 'LastState': LastState, 'DueTime': DueTime, 'Done': False, 'State': None, 'Error': None, }
+        with self.Condition:
+            self.Requests.append(Request)
+            if (self.PollThread is None):
+                self.PollThread = threading.Thread(target=self.PollLoop, name='Ec2StatusPoller-{0}'.format(self.AwsRegion))
+                self.PollThread.daemon = True
+                self.PollThread.start()
+            self.Condition.notify_all()
+            while (not Request['Done']):
+                self.Condition.wait()
+        if (Request['Error'] is not None):
+            raise Request['Error']
+        return Request['State']
+
+    def PollLoop(self):
+        BuildContext.Builder = self.Builder
+        SetBuildPhase('poll', None)
+        while True:
+            with self.Condition:
+                while True:
+                    if (len(self.Requests) == 0):
+                        self.Condition.wait()
+                        continue
+                    PollDelay = min(Request['DueTime'] for Request in self.Requests) - time.monotonic()
+                    if (PollDelay <= 0):
+                        break
+                    self.Condition.wait(PollDelay)
+                PollKeys = set(Request['Key'] for Request in self.Requests)
+            PollError = None
+            try:
+                PollStates = self.DescribeStates(PollKeys)
+            except Exception as err:
+                PollError = err
+            with self.Condition:
+                PollTime = time.monotonic() + UpdateAMI_PollCoalesceWindow
+                for Request in list(self.Requests):
+                    if (Request['Key'] not in PollKeys):
+                        continue
+                    if (PollError is not None):
+                        if (Request['DueTime'] > PollTime):
+                            continue
+                        Request['Error'] = PollError
+                    else:
+                        Request['State'] = PollStates.get(Request['Key'])
+                        if (Request['DueTime'] > PollTime and Request['State'] == Request['LastState']):
+                            continue
+                    Request['Done'] = True
+                    self.Requests.remove(Request)
+                self.Condition.notify_all()
+
+    def Interrupt(self,ResourceType,ResourceId,Error=None):
+        # Checks ResourceId now rather than when its waiter asked, or fails the
+        # waiter with Error
+        with self.Condition:
+            for Request in list(self.Requests):
+                if (Request['Key'] != (ResourceType, ResourceId)):
+                    continue
+                if (Error is not None):
+                    Request['Error'] = Error
+                    Request['Done'] = True
+                    self.Requests.remove(Request)
+                else:
+                    Request['DueTime'] = min(Request['DueTime'], time.monotonic())
+            self.Condition.notify_all()
+        return 0
+
+    def DescribeStates(self,PollKeys):
+        Ec2 = GetAwsClient('ec2',self.AwsRegion)
+        InstanceIds = sorted(ResourceId for ResourceType, ResourceId in PollKeys if ResourceType == 'instance')
+        ImageIds = sorted(ResourceId for ResourceType, ResourceId in PollKeys if ResourceType == 'image')
+        LOGMSG('Ec2StatusPoller.{0}.InstanceIds: {1}','DEBUG',3,self.AwsRegion, InstanceIds)
+        LOGMSG('Ec2StatusPoller.{0}.ImageIds: {1}','DEBUG',3,self.AwsRegion, ImageIds)
+        PollStates = {}
+        # Filters rather than Ids, so resources that are not visible yet do not fail the whole batch
+        for BatchStart in range(0, len(InstanceIds), UpdateAMI_PollBatchSize):
+            for response in Ec2.get_paginator('describe_instances').paginate(Filters=[{'Name': 'instance-id', 'Values': InstanceIds[BatchStart:BatchStart + UpdateAMI_PollBatchSize]}]):
+                for Reservation in response['Reservations']:
+                    for Instance in Reservation['Instances']:
+                        # The high byte of the state code is internal and should be ignored
+                        PollStates[('instance', Instance['InstanceId'])] = (Instance['State']['Code'] & 255, Instance['State']['Name'])
+        for BatchStart in range(0, len(ImageIds), UpdateAMI_PollBatchSize):
+            response = Ec2.describe_images(Filters=[{'Name': 'image-id', 'Values': ImageIds[BatchStart:BatchStart + UpdateAMI_PollBatchSize]}])
+            for Image in response['Images']:
+                PollStates[('image', Image['ImageId'])] = Image['State']
+        return PollStates
+
+def GetStatusPoller(AwsRegion):
+    # One poller per builder and region, builders may use different credentials
+    Builder = CurrentBuilder()
+    with StatusPollersLock:
+        if ((Builder,AwsRegion) not in StatusPollers):
+            StatusPollers[(Builder,AwsRegion)] = Ec2StatusPoller(Builder, AwsRegion)
+        return StatusPollers[(Builder,AwsRegion)]
+
+def CompletionSignalUserData(Ec2UserData,AwsRegion):
+    # Runs the userdata as a script of its own and reports its exit status from
+    # the builder. The instance id is part of the report rather than the
+    # userdata, so the bake digest stays the same from build to build.
+    CompletionSignal = BuildSetting('CompletionSignal')
+    if (CompletionSignal == 'tag'):
+        CompletionReport = 'aws ec2 create-tags --region {0} --resources "$InstanceId" --tags "Key={1},Value=$ExitStatus"'.format(AwsRegion, UpdateAMI_CompletionTag)
+    elif (isinstance(CompletionSignal, str)):
+        CompletionReport = 'aws sqs send-message --region {0} --queue-url {1} --message-body "{{\\"InstanceId\\": \\"$InstanceId\\", \\"ExitStatus\\": $ExitStatus}}"'.format(SqsQueueRegion(CompletionSignal), CompletionSignal)
+    else:
+        # Local stand-in queues are fed by the caller, leave a trace on the console
+        CompletionReport = 'echo "{0}: $ExitStatus" > /dev/console'.format(UpdateAMI_CompletionTag)
+    return '\n'.join([
+        '#!/bin/bash',
+        "cat > /var/tmp/aws-ami-update-userdata <<'AWS_AMI_UPDATE_USERDATA'",
+        Ec2UserData,
+        'AWS_AMI_UPDATE_USERDATA',
+        'chmod 700 /var/tmp/aws-ami-update-userdata',
+        '/var/tmp/aws-ami-update-userdata',
+        'ExitStatus=$?',
+        'rm -f /var/tmp/aws-ami-update-userdata',
+        "MetadataToken=$(curl -s -X PUT -H 'X-aws-ec2-metadata-token-ttl-seconds: 300' http://169.254.169.254/latest/api/token)",
+        'InstanceId=$(curl -s -H "X-aws-ec2-metadata-token: $MetadataToken" http://169.254.169.254/latest/meta-data/instance-id)',
+        CompletionReport,
+    ])
+
+def SqsQueueRegion(QueueUrl):
+    # https://sqs.<region>.amazonaws.com/<account>/<queue>
+    return QueueUrl.split('/')[2].split('.')[1]
+
+class TagCompletionQueue(object):
+    # Completion reported by the builder tagging itself with its exit status
+    def __init__(self,AwsRegion):
+        self.AwsRegion = AwsRegion
+
+    def Receive(self,Ec2InstanceIds,WaitSeconds):
+        time.sleep(WaitSeconds)
+        CompletionEvents = []
+        for BatchStart in range(0, len(Ec2InstanceIds), UpdateAMI_PollBatchSize):
+            response = GetAwsClient('ec2',self.AwsRegion).describe_tags(Filters=[
+                {'Name': 'resource-id', 'Values': Ec2InstanceIds[BatchStart:BatchStart + UpdateAMI_PollBatchSize]},
+                {'Name': 'key', 'Values': [UpdateAMI_CompletionTag]},
+            ])
+            for Tag in response['Tags']:
+                CompletionEvents.append([None, {'InstanceId': Tag['ResourceId'], 'ExitStatus': Tag['Value']}])
+        return CompletionEvents
+
+    def Delete(self,Receipts):
+        return 0
+
+    def Release(self,CompletionEvents):
+        return 0
+
+class SqsCompletionQueue(object):
+    # Completion reported by the builder as a JSON message on an SQS queue. The
+    # queue may be shared, messages for builders this process does not wait on
+    # are made visible again straight away.
+    def __init__(self,QueueUrl):
+        self.QueueUrl = QueueUrl
+        self.AwsRegion = SqsQueueRegion(QueueUrl)
+
+    def Receive(self,Ec2InstanceIds,WaitSeconds):
+        response = GetAwsClient('sqs',self.AwsRegion).receive_message(QueueUrl=self.QueueUrl, MaxNumberOfMessages=10, WaitTimeSeconds=min(WaitSeconds, 20))
+        CompletionEvents = []
+        for Message in response.get('Messages', []):
+            try:
+                CompletionEvents.append([Message['ReceiptHandle'], json.loads(Message['Body'])])
+            except ValueError:
+                LOGMSG('SqsCompletionQueue: ignoring message {0}','DEBUG',1,Message['Body'])
+        return CompletionEvents
+
+    def Delete(self,Receipts):
+        for BatchStart in range(0, len(Receipts), 10):
+            GetAwsClient('sqs',self.AwsRegion).delete_message_batch(QueueUrl=self.QueueUrl, Entries=[{'Id': str(ReceiptIndex), 'ReceiptHandle': Receipt} for ReceiptIndex, Receipt in enumerate(Receipts[BatchStart:BatchStart + 10])])
+        return 0
+
+    def Release(self,CompletionEvents):
+        for BatchStart in range(0, len(CompletionEvents), 10):
+            GetAwsClient('sqs',self.AwsRegion).change_message_visibility_batch(QueueUrl=self.QueueUrl, Entries=[{'Id': str(ReceiptIndex), 'ReceiptHandle': Receipt, 'VisibilityTimeout': 0} for ReceiptIndex, (Receipt, CompletionEvent) in enumerate(CompletionEvents[BatchStart:BatchStart + 10])])
+        return 0
+
+class LocalCompletionQueue(object):
+    # In process stand-in for the SQS queue; set the CompletionSignal setting to an
+    # instance and Send() the events a builder would report
+    def __init__(self):
+        import queue
+        self.Events = queue.Queue()
+        self.Deferred = []
+
+    def Send(self,CompletionEvent):
+        self.Events.put(CompletionEvent)
+        return 0
+
+    def Receive(self,Ec2InstanceIds,WaitSeconds):
+        import queue
+        CompletionEvents = self.Deferred
+        self.Deferred = []
+        try:
+            CompletionEvents.append([None, self.Events.get(timeout=WaitSeconds)])
+            while True:
+                CompletionEvents.append([None, self.Events.get_nowait()])
+        except queue.Empty:
+            pass
+        return CompletionEvents
+
+    def Delete(self,Receipts):
+        return 0
+
+    def Release(self,CompletionEvents):
+        self.Deferred.extend(CompletionEvents)
+        return 0
+
+class CompletionListener(object):
+    # One consumer per completion queue, handing each event to the build
+    # waiting on that builder
+    def __init__(self,Builder,CompletionQueue):
+        self.Builder = Builder
+        self.CompletionQueue = CompletionQueue
+        self.Condition = threading.Condition()
+        self.Waiters = {}
+        self.ListenThread = None
+
+    def Wait(self,Ec2InstanceId,Timeout):
+        # Returns the builder's completion event, or None after Timeout seconds
+        WaitDeadline = time.monotonic() + Timeout
+        with self.Condition:
+            self.Waiters[Ec2InstanceId] = None
+            if (self.ListenThread is None):
+                self.ListenThread = threading.Thread(target=self.ListenLoop, name='CompletionListener')
+                self.ListenThread.daemon = True
+                self.ListenThread.start()
+            self.Condition.notify_all()
+            while (self.Waiters[Ec2InstanceId] is None and time.monotonic() < WaitDeadline):
+                self.Condition.wait(WaitDeadline - time.monotonic())
+            return self.Waiters.pop(Ec2InstanceId)
+
+    def ListenLoop(self):
+        BuildContext.Builder = self.Builder
+        SetBuildPhase('completion-signal', None)
+        while True:
+            with self.Condition:
+                while (len(self.Waiters) == 0):
+                    self.Condition.wait()
+                Ec2InstanceIds = sorted(self.Waiters)
+            try:
+                CompletionEvents = self.CompletionQueue.Receive(Ec2InstanceIds, UpdateAMI_CompletionPollInterval)
+            except Exception as err:
+                LOGMSG('CompletionListener.Receive: {0}','DEBUG',1,err)
+                time.sleep(UpdateAMI_CompletionPollInterval)
+                continue
+            DeliveredReceipts = []
+            ReleasedEvents = []
+            with self.Condition:
+                for Receipt, CompletionEvent in CompletionEvents:
+                    if (self.Waiters.get(CompletionEvent.get('InstanceId'), False) is None):
+                        self.Waiters[CompletionEvent['InstanceId']] = CompletionEvent
+                        DeliveredReceipts.append(Receipt)
+                    else:
+                        ReleasedEvents.append([Receipt, CompletionEvent])
+                self.Condition.notify_all()
+            try:
+                self.CompletionQueue.Delete([Receipt for Receipt in DeliveredReceipts if Receipt is not None])
+                self.CompletionQueue.Release(ReleasedEvents)
+            except Exception as err:
+                LOGMSG('CompletionListener.Acknowledge: {0}','DEBUG',1,err)
+
+def GetCompletionListener(AwsRegion):
+    CompletionSignal = BuildSetting('CompletionSignal')
+    if (CompletionSignal == 'tag'):
+        ListenerKey = 'tag:{0}'.format(AwsRegion)
+    else:
+        ListenerKey = CompletionSignal
+    Builder = CurrentBuilder()
+    ListenerKey = (Builder, ListenerKey)
+    with CompletionListenersLock:
+        if (ListenerKey not in CompletionListeners):
+            if (CompletionSignal == 'tag'):
+                CompletionQueue = TagCompletionQueue(AwsRegion)
+            elif (isinstance(CompletionSignal, str)):
+                CompletionQueue = SqsCompletionQueue(CompletionSignal)
+            else:
+                CompletionQueue = CompletionSignal
+            CompletionListeners[ListenerKey] = CompletionListener(Builder, CompletionQueue)
+        return CompletionListeners[ListenerKey]
+
+def WaitCompletionSignal(Ec2InstanceId,AwsRegion,WaitCompletionTimeout=None):
+    if (WaitCompletionTimeout is None):
+        WaitCompletionTimeout = BuildSetting('WaitTimeout') or 900
+    LOGMSG('Waiting for InstanceId {0} to report completion...'.format(Ec2InstanceId))
+    CompletionEvent = GetCompletionListener(AwsRegion).Wait(Ec2InstanceId, WaitCompletionTimeout)
+    LOGMSG('WaitCompletionSignal.CompletionEvent: {0}','DEBUG',1,CompletionEvent)
+    if (CompletionEvent is None):
+        LOGMSG('Timeout exceeded waiting for completion signal','ERROR')
+        raise InstanceError('Timeout exceeded waiting for completion signal from {0}'.format(Ec2InstanceId), 3)
+    try:
+        ExitStatus = int(CompletionEvent.get('ExitStatus'))
+    except (TypeError, ValueError):
+        ExitStatus = None
+    if (ExitStatus != 0):
+        LOGMSG('Userdata on InstanceId {0} failed with exit status {1}'.format(Ec2InstanceId, CompletionEvent.get('ExitStatus')),'ERROR')
+        raise UserDataError('Userdata on {0} failed with exit status {1}'.format(Ec2InstanceId, CompletionEvent.get('ExitStatus')), 11)
+    LOGMSG('Userdata on InstanceId {0} completed'.format(Ec2InstanceId))
+    return 0
+
+def WaitInstanceState(Ec2InstanceId, AwsRegion, Ec2InstanceStateCode, Ec2DesiredInstanceStateCode=80, WaitInstanceStateLoopInterval=None, WaitInstanceStateTimeout=None, TestRun=False, PhaseKey=None):
     #### Instance State Codes
     #  0: pending
     # 16: running
@@ -337,84 +1805,91 @@ def WaitInstanceState(Ec2InstanceId, AwsRegion, Ec2InstanceStateCode, Ec2Desired
         return 99
     if (not Ec2InstanceId.startswith("i-")):
         return 99
+    if (WaitInstanceStateLoopInterval is None):
+        WaitInstanceStateLoopInterval = BuildSetting('WaitInterval') or 60
+    if (WaitInstanceStateTimeout is None):
+        WaitInstanceStateTimeout = BuildSetting('WaitTimeout') or 900
 
+    WaitInstanceStateStartTime = time.monotonic()
+    WaitInstanceStateIntervals = PollIntervals(WaitInstanceStateLoopInterval, ExpectedPhaseDuration(PhaseKey))
+    WaitInstanceStatePoller = GetStatusPoller(AwsRegion)
+    WaitInstanceStateDueTime = WaitInstanceStateStartTime
+    Ec2InstanceState = None
     WaitInstanceStateLoopTime = 0
-    while WaitInstanceStateLoopTime <= WaitInstanceStateTimeout:        
-        response = Ec2Client.describe_instance_status(
-            InstanceIds=[
-                Ec2InstanceId,
-            ],
-            DryRun=TestRun,
-            IncludeAllInstances=True
-        )
-        Ec2ResponseInstanceId = response['InstanceStatuses'][0]['InstanceId']
-        Ec2InstanceStateCode = response['InstanceStatuses'][0]['InstanceState']['Code']
-        Ec2InstanceStateName = response['InstanceStatuses'][0]['InstanceState']['Name']
+    while WaitInstanceStateLoopTime <= WaitInstanceStateTimeout:
+        Ec2InstanceState = WaitInstanceStatePoller.WaitState('instance', Ec2InstanceId, Ec2InstanceState, WaitInstanceStateDueTime)
+        Ec2InstanceStateCode, Ec2InstanceStateName = Ec2InstanceState or (None, 'not yet visible')
         if Ec2InstanceStateCode == Ec2DesiredInstanceStateCode:
-            LOGMSG('WaitInstanceState.Ec2InstanceId: {0}'.format(Ec2InstanceId),'DEBUG',2)
-            LOGMSG('WaitInstanceState.Ec2ResponseInstanceId: {0}'.format(Ec2ResponseInstanceId),'DEBUG',3)
-            LOGMSG('WaitInstanceState.Ec2StateCode: {0}'.format(Ec2InstanceStateCode),'DEBUG',2)
-            LOGMSG('WaitInstanceState.Ec2StateName: {0}'.format(Ec2InstanceStateName),'DEBUG',2)
+            LOGMSG('WaitInstanceState.Ec2InstanceId: {0}','DEBUG',2,Ec2InstanceId)
+            LOGMSG('WaitInstanceState.Ec2StateCode: {0}','DEBUG',2,Ec2InstanceStateCode)
+            LOGMSG('WaitInstanceState.Ec2StateName: {0}','DEBUG',2,Ec2InstanceStateName)
             LOGMSG('InstanceId {0} is {1}.'.format(Ec2InstanceId, Ec2InstanceStateName))
+            RecordPhaseDuration(PhaseKey, time.monotonic() - WaitInstanceStateStartTime)
             return 0
         else:
-            LOGMSG('WaitInstanceState.WaitInstanceStateLoopTime: {0}'.format(WaitInstanceStateLoopTime),'DEBUG',1)
-            LOGMSG('WaitInstanceState.WaitInstanceStateTimeout: {0}'.format(WaitInstanceStateTimeout),'DEBUG',1)
-            LOGMSG('WaitInstanceState.Ec2InstanceId: {0}'.format(Ec2InstanceId),2)
-            LOGMSG('WaitInstanceState.Ec2ResponseInstanceId: {0}'.format(Ec2ResponseInstanceId),'DEBUG',3)
-            LOGMSG('WaitInstanceState.Ec2StateCode: {0}'.format(Ec2InstanceStateCode),'DEBUG',2)
-            LOGMSG('WaitInstanceState.Ec2StateName: {0}'.format(Ec2InstanceStateName),'DEBUG',2)
+            LOGMSG('WaitInstanceState.WaitInstanceStateLoopTime: {0}','DEBUG',1,WaitInstanceStateLoopTime)
+            LOGMSG('WaitInstanceState.WaitInstanceStateTimeout: {0}','DEBUG',1,WaitInstanceStateTimeout)
+            LOGMSG('WaitInstanceState.Ec2InstanceId: {0}','DEBUG',2,Ec2InstanceId)
+            LOGMSG('WaitInstanceState.Ec2StateCode: {0}','DEBUG',2,Ec2InstanceStateCode)
+            LOGMSG('WaitInstanceState.Ec2StateName: {0}','DEBUG',2,Ec2InstanceStateName)
             LOGMSG('InstanceId {0} is {1}.'.format(Ec2InstanceId, Ec2InstanceStateName))
-            LOGMSG('Waiting {0} seconds for instance state change...'.format(WaitInstanceStateLoopInterval))
-            time.sleep(WaitInstanceStateLoopInterval)
-            WaitInstanceStateLoopTime += WaitInstanceStateLoopInterval
+            WaitInstanceStateSleep = min(next(WaitInstanceStateIntervals), max(WaitInstanceStateTimeout - WaitInstanceStateLoopTime, 1))
+            LOGMSG('Waiting {0:.0f} seconds for instance state change...'.format(WaitInstanceStateSleep))
+            WaitInstanceStateDueTime = time.monotonic() + WaitInstanceStateSleep
+            WaitInstanceStateLoopTime = WaitInstanceStateDueTime - WaitInstanceStateStartTime
     else:
         LOGMSG('Timeout exceeded waiting for instance','ERROR')
-        sys.exit(3)
+        raise InstanceError('Timeout exceeded waiting for {0}'.format(Ec2InstanceId), 3)
     return 98
 
-def WaitAmiState(AwsAmiId, AwsRegion, DesiredAmiStateName='available', WaitAmiStateLoopInterval=30, WaitAmiStateTimeout=600, TestRun=False):
+def WaitAmiState(AwsAmiId, AwsRegion, DesiredAmiStateName='available', WaitAmiStateLoopInterval=None, WaitAmiStateTimeout=None, TestRun=False, PhaseKey=None):
     if (TestRun):
         return 99
     if (not AwsAmiId.startswith("ami-")):
         return 98
     else:
         LOGMSG('New AMI Id: {0}'.format(AwsAmiId))
+    if (WaitAmiStateLoopInterval is None):
+        WaitAmiStateLoopInterval = BuildSetting('WaitInterval') or 30
+    if (WaitAmiStateTimeout is None):
+        WaitAmiStateTimeout = BuildSetting('WaitTimeout') or 600
 
+    WaitAmiStateStartTime = time.monotonic()
+    WaitAmiStateIntervals = PollIntervals(WaitAmiStateLoopInterval, ExpectedPhaseDuration(PhaseKey))
+    WaitAmiStatePoller = GetStatusPoller(AwsRegion)
+    WaitAmiStateDueTime = WaitAmiStateStartTime
+    AmiStateName = None
     WaitAmiStateLoopTime = 0
     while WaitAmiStateLoopTime <= WaitAmiStateTimeout:
-        response = Ec2Client.describe_images(
-            ImageIds=[
-                AwsAmiId,
-            ],
-            DryRun=TestRun
-        )
-        ResponseAmiId = response['Images'][0]['ImageId']
+        AmiStateName = WaitAmiStatePoller.WaitState('image', AwsAmiId, AmiStateName, WaitAmiStateDueTime)
         DesiredAmiStateName="available"
-        AmiStateName = response['Images'][0]['State']
         if AmiStateName == DesiredAmiStateName:
-            LOGMSG('WaitAmiState.AwsAmiId: {0}'.format(AwsAmiId),'DEBUG',2)
-            LOGMSG('WaitAmiState.ResponseAmiId: {0}'.format(ResponseAmiId),'DEBUG',3)
-            LOGMSG('WaitAmiState.AmiStateName: {0}.'.format(AmiStateName),'DEBUG',2)
-            LOGMSG('Ami Id {0} is {1}.'.format(ResponseAmiId, AmiStateName))
+            LOGMSG('WaitAmiState.AwsAmiId: {0}','DEBUG',2,AwsAmiId)
+            LOGMSG('WaitAmiState.AmiStateName: {0}.','DEBUG',2,AmiStateName)
+            LOGMSG('Ami Id {0} is {1}.'.format(AwsAmiId, AmiStateName))
+            RecordPhaseDuration(PhaseKey, time.monotonic() - WaitAmiStateStartTime)
             return 0
+        elif AmiStateName in ('failed', 'error', 'invalid', 'deregistered'):
+            LOGMSG('Ami Id {0} is {1}.'.format(AwsAmiId, AmiStateName),'ERROR')
+            return 98
         else:
-            LOGMSG('WaitAmiState.WaitAmiStateLoopTime: {0}'.format(WaitAmiStateLoopTime),'DEBUG',1)
-            LOGMSG('WaitAmiState.WaitAmiStateTimeout: {0}'.format(WaitAmiStateTimeout),'DEBUG',1)
-            LOGMSG('WaitAmiState.AwsAmiId: {0}'.format(AwsAmiId),'DEBUG',2)
-            LOGMSG('WaitAmiState.ResponseAmiId: {0}'.format(ResponseAmiId),'DEBUG',3)
-            LOGMSG('WaitAmiState.AmiStateName: {0}.'.format(AmiStateName),'DEBUG',2)
-            LOGMSG('WaitAmiState.DesiredAmiStateName: {0}.'.format(DesiredAmiStateName),'DEBUG',2)
-            LOGMSG('Ami Id {0} is {1}.'.format(ResponseAmiId, AmiStateName))
-            LOGMSG('Waiting {0} seconds for Ami state change...'.format(WaitAmiStateLoopInterval))
-            time.sleep(WaitAmiStateLoopInterval)
-            WaitAmiStateLoopTime += WaitAmiStateLoopInterval
+            LOGMSG('WaitAmiState.WaitAmiStateLoopTime: {0}','DEBUG',1,WaitAmiStateLoopTime)
+            LOGMSG('WaitAmiState.WaitAmiStateTimeout: {0}','DEBUG',1,WaitAmiStateTimeout)
+            LOGMSG('WaitAmiState.AwsAmiId: {0}','DEBUG',2,AwsAmiId)
+            LOGMSG('WaitAmiState.AmiStateName: {0}.','DEBUG',2,AmiStateName)
+            LOGMSG('WaitAmiState.DesiredAmiStateName: {0}.','DEBUG',2,DesiredAmiStateName)
+            LOGMSG('Ami Id {0} is {1}.'.format(AwsAmiId, AmiStateName or 'not yet visible'))
+            WaitAmiStateSleep = min(next(WaitAmiStateIntervals), max(WaitAmiStateTimeout - WaitAmiStateLoopTime, 1))
+            LOGMSG('Waiting {0:.0f} seconds for Ami state change...'.format(WaitAmiStateSleep))
+            WaitAmiStateDueTime = time.monotonic() + WaitAmiStateSleep
+            WaitAmiStateLoopTime = WaitAmiStateDueTime - WaitAmiStateStartTime
     else:
         LOGMSG('Timeout exceeded waiting for Ami creation','ERROR')
-        sys.exit(5)
+        raise ImageError('Timeout exceeded waiting for {0}'.format(AwsAmiId), 5)
     return 98
 
-def Create_AMI(Ec2InstanceId,AmiName,AwsRegion=DefaultAwsRegion,LaunchPermissions=None,TestRun=False):
+def Create_AMI(Ec2InstanceId,AmiName,AwsRegion=DefaultAwsRegion,LaunchPermissions=None,TestRun=False,BakeDigest=None,NoReboot=True):
+    AmiFamily = AmiName
     AmiSuffix = Ec2InstanceId.split('-')
     AmiName = AmiName + " " + AmiSuffix[1]
     if (TestRun):
@@ -423,20 +1898,1053 @@ def Create_AMI(Ec2InstanceId,AmiName,AwsRegion=DefaultAwsRegion,LaunchPermission
         return 98
 
     try:
-        response = Ec2Client.create_image(
+        response = GetAwsClient('ec2',AwsRegion).create_image(
             Description='',
             DryRun=TestRun,
             InstanceId=Ec2InstanceId,
             Name=AmiName,
-            NoReboot=True,
+            NoReboot=NoReboot,
+            TagSpecifications=ImageTags('image', BakeDigest, AmiFamily),
         )
     except exceptions.ClientError as err:
         raise err
     NewAwsAmiId = response['ImageId']
-    LOGMSG('Create_AMI.NewAwsAmiId: {0}'.format(NewAwsAmiId),'DEBUG',2)
+    LOGMSG('Create_AMI.NewAwsAmiId: {0}','DEBUG',2,NewAwsAmiId)
     return NewAwsAmiId
 
+def ParseShareList(ShareList):
+    # Comma separated, or @file with one entry per line and # comments
+    if (ShareList.startswith('@')):
+        with open(ShareList[1:]) as ShareList_fh:
+            ShareEntries = [ShareLine.split('#')[0] for ShareLine in ShareList_fh]
+    else:
+        ShareEntries = ShareList.split(',')
+    return [ShareEntry.strip() for ShareEntry in ShareEntries if ShareEntry.strip() != '']
+
+def SharePermissions(LaunchPermissions=None):
+    # The launch permissions a new Ami should end up with, None to leave them alone
+    ShareAccounts = BuildSetting('ShareAccounts')
+    ShareOrganizationalUnits = BuildSetting('ShareOrganizationalUnits')
+    if (LaunchPermissions is None and len(ShareAccounts) == 0 and len(ShareOrganizationalUnits) == 0):
+        return None
+    DesiredPermissions = list(LaunchPermissions or [])
+    DesiredPermissions += [{'UserId': AccountId} for AccountId in ShareAccounts]
+    DesiredPermissions += [{'OrganizationalUnitArn': OrganizationalUnitArn} for OrganizationalUnitArn in ShareOrganizationalUnits]
+    PermissionKeys = set()
+    SharedPermissions = []
+    for Permission in DesiredPermissions:
+        if (PermissionKey(Permission) not in PermissionKeys):
+            PermissionKeys.add(PermissionKey(Permission))
+            SharedPermissions.append(Permission)
+    return SharedPermissions
+
+def PermissionKey(Permission):
+    return tuple(sorted(Permission.items()))
+
+def PermissionChanges(CurrentPermissions,DesiredPermissions):
+    # Returns [Add, Remove] taking CurrentPermissions to DesiredPermissions
+    CurrentKeys = set(PermissionKey(Permission) for Permission in CurrentPermissions)
+    DesiredKeys = set(PermissionKey(Permission) for Permission in DesiredPermissions)
+    return [
+        [Permission for Permission in DesiredPermissions if PermissionKey(Permission) not in CurrentKeys],
+        [Permission for Permission in CurrentPermissions if PermissionKey(Permission) not in DesiredKeys],
+    ]
+
+def Share_Resource(ResourceType,ResourceId,AwsRegion,DesiredPermissions):
+    # Changes of one Ami or snapshot are sent one batch at a time, concurrent
+    # modifications of the same attribute would race each other
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    if (ResourceType == 'image'):
+        CurrentPermissions = Ec2.describe_image_attribute(Attribute='launchPermission', ImageId=ResourceId)['LaunchPermissions']
+    else:
+        CurrentPermissions = Ec2.describe_snapshot_attribute(Attribute='createVolumePermission', SnapshotId=ResourceId)['CreateVolumePermissions']
+    AddPermissions, RemovePermissions = PermissionChanges(CurrentPermissions, DesiredPermissions)
+    LOGMSG('Share_Resource.{0}: {1} to add, {2} to remove','DEBUG',2,ResourceId, len(AddPermissions), len(RemovePermissions))
+    for ShareOperation, Permissions in (('Add', AddPermissions), ('Remove', RemovePermissions)):
+        for BatchStart in range(0, len(Permissions), UpdateAMI_ShareBatchSize):
+            PermissionBatch = {ShareOperation: Permissions[BatchStart:BatchStart + UpdateAMI_ShareBatchSize]}
+            if (ResourceType == 'image'):
+                response = Ec2.modify_image_attribute(Attribute='launchPermission', ImageId=ResourceId, LaunchPermission=PermissionBatch)
+            else:
+                response = Ec2.modify_snapshot_attribute(Attribute='createVolumePermission', SnapshotId=ResourceId, CreateVolumePermission=PermissionBatch)
+            LOGMSG('Share_Resource.{0}.{1}.response: {2}','DEBUG',4,ResourceId, ShareOperation, response)
+    return [len(AddPermissions), len(RemovePermissions)]
+
+def Share_AMI(AwsAmiId,AwsRegion,LaunchPermissions=None):
+    # Brings the Ami and its snapshots to exactly LaunchPermissions. Snapshots
+    # only take accounts and groups, they are what lets an account copy the Ami.
+    # Public snapshots expose the disk itself, they are left private unless the
+    # ShareSnapshotsPublic setting asks otherwise.
+    if (LaunchPermissions is None):
+        return {}
+    Image = GetAwsClient('ec2',AwsRegion).describe_images(ImageIds=[AwsAmiId])['Images'][0]
+    ShareResources = [['image', AwsAmiId, LaunchPermissions]]
+    SnapshotPermissions = [Permission for Permission in LaunchPermissions if 'UserId' in Permission or ('Group' in Permission and BuildSetting('ShareSnapshotsPublic'))]
+    if ({'Group': 'all'} in LaunchPermissions and not BuildSetting('ShareSnapshotsPublic')):
+        LOGMSG('Ami Id {0} is public, its snapshots are kept private'.format(AwsAmiId))
+    for BlockDeviceMapping in Image.get('BlockDeviceMappings', []):
+        if ('SnapshotId' in BlockDeviceMapping.get('Ebs', {})):
+            ShareResources.append(['snapshot', BlockDeviceMapping['Ebs']['SnapshotId'], SnapshotPermissions])
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(ShareResources), UpdateAMI_ShareMaxWorkers), thread_name_prefix='aws-ami-share') as ShareExecutor:
+        ShareFutures = [ShareExecutor.submit(BuildContextThread(Share_Resource), ResourceType, ResourceId, AwsRegion, DesiredPermissions) for ResourceType, ResourceId, DesiredPermissions in ShareResources]
+        ShareChanges = [ShareFuture.result() for ShareFuture in ShareFutures]
+    ShareOutcome = {'Added': sum(ShareChange[0] for ShareChange in ShareChanges), 'Removed': sum(ShareChange[1] for ShareChange in ShareChanges)}
+    LOGMSG('Shared Ami Id {0} in {1} with {2} principals and {3} snapshots: {4} permissions added, {5} removed'.format(AwsAmiId, AwsRegion, len(LaunchPermissions), len(ShareResources) - 1, ShareOutcome['Added'], ShareOutcome['Removed']))
+    return ShareOutcome
+
+def Copy_AMI(AwsAmiId,AmiName,SourceRegion,TargetRegion,BakeDigest=None):
+    LOGMSG('Copy_AMI.AwsAmiId: {0}','DEBUG',2,AwsAmiId)
+    LOGMSG('Copy_AMI.TargetRegion: {0}','DEBUG',2,TargetRegion)
+    try:
+        response = GetAwsClient('ec2',TargetRegion).copy_image(
+            Description='',
+            Name=AmiName,
+            SourceImageId=AwsAmiId,
+            SourceRegion=SourceRegion,
+            TagSpecifications=ImageTags('image', BakeDigest, AmiName.rsplit(' ', 1)[0]),
+        )
+    except exceptions.ClientError as err:
+        raise err
+    LOGMSG('Copying Ami Id {0} to {1} as {2}'.format(AwsAmiId, TargetRegion, response['ImageId']))
+    return response['ImageId']
+
+def Distribute_AMI(AwsAmiId,AmiName,SourceRegion,TargetRegions,LaunchPermissions=None,BakeDigest=None,UseBakeCache=True):
+    # Start every regional copy, then wait on all of them at once. Copies share
+    # the per-region status pollers with any other build running in the process.
+    def Distribute_AMI_Region(TargetRegion):
+        CopyAmiId = LookupBakeCache(BakeDigest, TargetRegion) if UseBakeCache else None
+        if (CopyAmiId is not None):
+            Share_AMI(CopyAmiId, TargetRegion, LaunchPermissions)
+            return CopyAmiId
+        CopyAmiId = Copy_AMI(AwsAmiId, AmiName, SourceRegion, TargetRegion, BakeDigest)
+        WaitAmiStateReturn = WaitAmiState(CopyAmiId, TargetRegion, WaitAmiStateTimeout=BuildSetting('WaitTimeout') or UpdateAMI_CopyTimeout, PhaseKey='ami-copied:{0}:{1}'.format(AmiName.rsplit(' ', 1)[0], TargetRegion))
+        if (WaitAmiStateReturn != 0):
+            return None
+        Share_AMI(CopyAmiId, TargetRegion, LaunchPermissions)
+        RecordBakeCache(BakeDigest, TargetRegion, CopyAmiId)
+        return CopyAmiId
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    AmiCopies = {}
+    with ThreadPoolExecutor(max_workers=len(TargetRegions), thread_name_prefix='aws-ami-copy') as CopyExecutor:
+        CopyFutures = dict((CopyExecutor.submit(BuildContextThread(Distribute_AMI_Region), TargetRegion), TargetRegion) for TargetRegion in TargetRegions)
+        for CopyFuture in as_completed(CopyFutures):
+            try:
+                AmiCopies[CopyFutures[CopyFuture]] = CopyFuture.result()
+            except exceptions.ClientError as err:
+                LOGMSG('Ami copy to {0} failed: {1}'.format(CopyFutures[CopyFuture], err),'ERROR')
+                AmiCopies[CopyFutures[CopyFuture]] = None
+    for TargetRegion in sorted(AmiCopies):
+        LOGMSG('Ami copy {0}: {1}'.format(TargetRegion, AmiCopies[TargetRegion]))
+    return AmiCopies
+
+def ComputeBakeDigest(AwsAmiId,AwsAmiName,Ec2UserData,InstanceType=UpdateAMI_InstanceType):
+    # Each family has its own cache entries, an image --gc removes from one family
+    # must not be what another family's bake was answered with
+    BakeInputs = json.dumps({
+        'SourceAmiId': AwsAmiId,
+        'AmiName': AwsAmiName,
+        'UserData': Ec2UserData,
+        'ShutdownCMD': BuildSetting('ShutdownCMD'),
+        'InstanceType': InstanceType,
+    }, sort_keys=True)
+    return hashlib.sha256(BakeInputs.encode('utf-8')).hexdigest()
+
+def ImageTags(ResourceType,BakeDigest,AmiFamily=None):
+    ResourceTags = []
+    if (BakeDigest is not None):
+        ResourceTags.append({'Key': UpdateAMI_BakeDigestTag, 'Value': BakeDigest})
+    if (AmiFamily is not None):
+        ResourceTags.append({'Key': UpdateAMI_FamilyTag, 'Value': AmiFamily})
+    if (len(ResourceTags) == 0):
+        return []
+    return [{'ResourceType': ResourceType, 'Tags': ResourceTags}, ]
+
+def LoadBakeCache():
+    try:
+        with open(UpdateAMI_BakeCacheFile) as BakeCache_fh:
+            return json.load(BakeCache_fh)
+    except (IOError, ValueError):
+        return {}
+
+def RecordBakeCache(BakeDigest,AwsRegion,AwsAmiId):
+    if (BakeDigest is None or CurrentBuilder().TestRun):
+        return 0
+    with BakeCacheLock:
+        BakeCache = LoadBakeCache()
+        BakeCache['{0}:{1}'.format(AwsRegion, BakeDigest)] = {'AmiId': AwsAmiId, 'Recorded': time.time(), }
+        try:
+            if (not os.path.isdir(UpdateAMI_StateDir)):
+                os.makedirs(UpdateAMI_StateDir)
+            with open(UpdateAMI_BakeCacheFile + '.tmp', 'w') as BakeCache_fh:
+                json.dump(BakeCache, BakeCache_fh)
+            os.rename(UpdateAMI_BakeCacheFile + '.tmp', UpdateAMI_BakeCacheFile)
+        except (IOError, OSError) as err:
+            LOGMSG('Unable to record bake cache: {0}','DEBUG',1,err)
+    return 0
+
+def LookupBakeCache(BakeDigest,AwsRegion):
+    # Returns the id of an available AMI already baked from the same inputs, or None.
+    # A fresh local index entry only costs a describe by id, otherwise fall back to
+    # searching our own images for the digest tag.
+    if (BakeDigest is None or not BuildSetting('BakeCache')):
+        return None
+    with BakeCacheLock:
+        BakeCacheEntry = LoadBakeCache().get('{0}:{1}'.format(AwsRegion, BakeDigest))
+    if (BakeCacheEntry is not None and time.time() - BakeCacheEntry['Recorded'] < UpdateAMI_BakeCacheTTL):
+        LOGMSG('LookupBakeCache.BakeCacheEntry: {0}','DEBUG',2,BakeCacheEntry)
+        ImageFilters = [{'Name': 'image-id', 'Values': [BakeCacheEntry['AmiId']]}, ]
+    else:
+        ImageFilters = [{'Name': 'tag:{0}'.format(UpdateAMI_BakeDigestTag), 'Values': [BakeDigest]}, ]
+    ImageFilters.append({'Name': 'state', 'Values': ['available']})
+    response = GetAwsClient('ec2',AwsRegion).describe_images(
+        Owners=['self'],
+        Filters=ImageFilters,
+    )
+    if (len(response['Images']) == 0):
+        LOGMSG('LookupBakeCache.{0}: no cached Ami for {1}','DEBUG',1,AwsRegion, BakeDigest)
+        return None
+    CachedAmi = sorted(response['Images'], key=lambda Image: Image['CreationDate'])[-1]
+    LOGMSG('Found cached Ami Id {0} ({1}) in {2} for unchanged build inputs'.format(CachedAmi['ImageId'], CachedAmi.get('Name'), AwsRegion))
+    RecordBakeCache(BakeDigest, AwsRegion, CachedAmi['ImageId'])
+    return CachedAmi['ImageId']
+
+def List_FamilyImages(AwsRegion,AmiFamilies=None):
+    # Returns {Family: [Image, ...]} of the images this tool made in AwsRegion
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    if (AmiFamilies is None):
+        ImageQueries = [[{'Name': 'tag-key', 'Values': [UpdateAMI_FamilyTag]}, ]]
+    else:
+        ImageQueries = [
+            [{'Name': 'tag:{0}'.format(UpdateAMI_FamilyTag), 'Values': list(AmiFamilies)}, ],
+            # Images from before the family tag, by name
+            [{'Name': 'name', 'Values': ['{0} *'.format(AmiFamily) for AmiFamily in AmiFamilies]}, ],
+        ]
+    FamilyImages = {}
+    ImageIds = set()
+    for ImageFilters in ImageQueries:
+        for response in Ec2.get_paginator('describe_images').paginate(Owners=['self'], Filters=ImageFilters):
+            for Image in response['Images']:
+                if (Image['ImageId'] in ImageIds):
+                    continue
+                ImageIds.add(Image['ImageId'])
+                AmiFamily = dict((Tag['Key'], Tag['Value']) for Tag in Image.get('Tags', [])).get(UpdateAMI_FamilyTag)
+                if (AmiFamily is None):
+                    AmiFamily, AmiSuffix = Image.get('Name', ' ').rsplit(' ', 1)
+                    if (AmiFamily not in AmiFamilies or len(AmiSuffix) == 0 or AmiSuffix.strip('0123456789abcdef') != ''):
+                        continue
+                FamilyImages.setdefault(AmiFamily, []).append(Image)
+    return FamilyImages
+
+def InUse_Images(AwsRegion):
+    # Image ids that instances still exist for or that launch templates launch
+    # by default or as their latest version
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    InUseImageIds = set()
+    for response in Ec2.get_paginator('describe_instances').paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']}, ]):
+        for Reservation in response['Reservations']:
+            for Instance in Reservation['Instances']:
+                InUseImageIds.add(Instance.get('ImageId'))
+    for response in Ec2.get_paginator('describe_launch_template_versions').paginate(Versions=['$Latest', '$Default']):
+        for LaunchTemplateVersion in response['LaunchTemplateVersions']:
+            InUseImageIds.add(LaunchTemplateVersion.get('LaunchTemplateData', {}).get('ImageId'))
+    InUseImageIds.discard(None)
+    LOGMSG('InUse_Images.{0}: {1}','DEBUG',2,AwsRegion, sorted(InUseImageIds))
+    return InUseImageIds
+
+def ImageSnapshotIds(Image):
+    return [BlockDeviceMapping['Ebs']['SnapshotId'] for BlockDeviceMapping in Image.get('BlockDeviceMappings', []) if 'SnapshotId' in BlockDeviceMapping.get('Ebs', {})]
+
+def Plan_Retention(AwsRegion,AmiFamilies,KeepLatest,KeepDays):
+    # Returns [[Image, KeepSnapshotIds], ...] of the images to remove in AwsRegion
+    FamilyImages = List_FamilyImages(AwsRegion, AmiFamilies)
+    if (len(FamilyImages) == 0):
+        return []
+    InUseImageIds = InUse_Images(AwsRegion)
+    import datetime
+    KeepAfter = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=KeepDays)
+    KeepImages = []
+    RemoveImages = []
+    for AmiFamily in sorted(FamilyImages):
+        AvailableCount = 0
+        FamilyRemoveCount = 0
+        for Image in sorted(FamilyImages[AmiFamily], key=lambda Image: Image['CreationDate'], reverse=True):
+            KeepReason = None
+            if (Image['State'] == 'available'):
+                AvailableCount += 1
+            if (Image['ImageId'] in InUseImageIds):
+                KeepReason = 'in use'
+            elif (Image['State'] in ('pending', 'transient')):
+                KeepReason = Image['State']
+            elif (Image['State'] == 'available' and AvailableCount <= KeepLatest):
+                KeepReason = 'latest'
+            elif (datetime.datetime.fromisoformat(Image['CreationDate'].replace('Z', '+00:00')) > KeepAfter):
+                KeepReason = 'recent'
+            LOGMSG('Plan_Retention.{0}.{1}: {2} {3} {4}','DEBUG',2,AwsRegion, AmiFamily, Image['ImageId'], Image['CreationDate'], KeepReason or 'remove')
+            if (KeepReason is None):
+                RemoveImages.append(Image)
+                FamilyRemoveCount += 1
+            else:
+                KeepImages.append(Image)
+        LOGMSG('Ami family {0} in {1}: keeping {2}, removing {3}'.format(AmiFamily, AwsRegion, len(FamilyImages[AmiFamily]) - FamilyRemoveCount, FamilyRemoveCount))
+    # A snapshot can back more than one image, only delete those no kept image uses
+    KeepSnapshotIds = set(SnapshotId for Image in KeepImages for SnapshotId in ImageSnapshotIds(Image))
+    return [[Image, KeepSnapshotIds] for Image in RemoveImages]
+
+def Remove_Image(Image,AwsRegion,KeepSnapshotIds,TestRun=False):
+    # Deregisters Image and deletes its snapshots, returns the deleted snapshot ids.
+    # An image that could not be deregistered raises, its snapshots are left alone.
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    try:
+        Ec2.deregister_image(ImageId=Image['ImageId'], DryRun=TestRun)
+    except exceptions.ClientError as err:
+        if (BotoExceptionHandling(err) != 0):
+            raise
+    SnapshotIds = []
+    for SnapshotId in [SnapshotId for SnapshotId in ImageSnapshotIds(Image) if SnapshotId not in KeepSnapshotIds]:
+        # The snapshot is released a moment after the image is deregistered
+        for SnapshotAttempt in range(UpdateAMI_GcSnapshotRetries):
+            try:
+                Ec2.delete_snapshot(SnapshotId=SnapshotId, DryRun=TestRun)
+                SnapshotIds.append(SnapshotId)
+                break
+            except exceptions.ClientError as err:
+                if (err.response['Error']['Code'] == 'InvalidSnapshot.InUse' and SnapshotAttempt < UpdateAMI_GcSnapshotRetries - 1):
+                    time.sleep(UpdateAMI_WaitMinInterval)
+                    continue
+                if (BotoExceptionHandling(err) == 0):
+                    SnapshotIds.append(SnapshotId)
+                else:
+                    LOGMSG('Unable to delete snapshot {0} of Ami Id {1} in {2}: {3}'.format(SnapshotId, Image['ImageId'], AwsRegion, err),'ERROR')
+                break
+    if (TestRun):
+        LOGMSG('TestRun: would deregister Ami Id {0} ({1}) in {2} and delete snapshots {3}'.format(Image['ImageId'], Image.get('Name'), AwsRegion, ', '.join(SnapshotIds) or 'none'))
+    else:
+        LOGMSG('Deregistered Ami Id {0} ({1}) in {2}, deleted snapshots {3}'.format(Image['ImageId'], Image.get('Name'), AwsRegion, ', '.join(SnapshotIds) or 'none'))
+    return SnapshotIds
+
+def CollectImages(AwsRegions,AmiFamilies=None,KeepLatest=UpdateAMI_GcKeepLatest,KeepDays=UpdateAMI_GcKeepDays):
+    # Regions are planned and images removed on one bounded pool of workers
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    TestRun = CurrentBuilder().TestRun
+    GcResults = []
+    with ThreadPoolExecutor(max_workers=UpdateAMI_GcMaxWorkers, thread_name_prefix='aws-ami-gc') as GcExecutor:
+        PlanFutures = dict((GcExecutor.submit(BuildContextThread(Plan_Retention), AwsRegion, AmiFamilies, KeepLatest, KeepDays), AwsRegion) for AwsRegion in AwsRegions)
+        RemoveFutures = {}
+        for PlanFuture in as_completed(PlanFutures):
+            for Image, KeepSnapshotIds in PlanFuture.result():
+                RemoveFutures[GcExecutor.submit(BuildContextThread(Remove_Image), Image, PlanFutures[PlanFuture], KeepSnapshotIds, TestRun)] = [PlanFutures[PlanFuture], Image]
+        for RemoveFuture in as_completed(RemoveFutures):
+            AwsRegion, Image = RemoveFutures[RemoveFuture]
+            GcResult = {'AwsRegion': AwsRegion, 'AmiId': Image['ImageId'], 'Name': Image.get('Name'), 'CreationDate': Image['CreationDate'], 'Status': 'TestRun' if TestRun else 'Removed', 'Snapshots': []}
+            try:
+                GcResult['Snapshots'] = RemoveFuture.result()
+            except exceptions.ClientError as err:
+                LOGMSG('Unable to remove Ami Id {0} in {1}: {2}'.format(Image['ImageId'], AwsRegion, err),'ERROR')
+                GcResult['Status'] = 'Failed'
+            GcResults.append(GcResult)
+    LOGMSG('Removed {0} Amis and {1} snapshots in {2}'.format(len([GcResult for GcResult in GcResults if GcResult['Status'] != 'Failed']), sum(len(GcResult['Snapshots']) for GcResult in GcResults), ', '.join(AwsRegions)))
+    return sorted(GcResults, key=lambda GcResult: (GcResult['AwsRegion'], GcResult['CreationDate']))
+
+def LiveBuild(BuildId,MinAge):
+    # A build is taken as live while its journal here is running and was written
+    # within MinAge, builds from other hosts only by the age of their instance
+    if (BuildId is None):
+        return False
+    JournalFile = os.path.join(UpdateAMI_BuildJournalDir, '{0}.json'.format(BuildId))
+    try:
+        JournalAge = time.time() - os.path.getmtime(JournalFile)
+        with open(JournalFile) as Journal_fh:
+            JournalStatus = json.load(Journal_fh).get('Status')
+    except (IOError, OSError, ValueError):
+        return False
+    return JournalStatus == 'running' and JournalAge < MinAge
+
+def Save_Ec2ConsoleLog(Ec2InstanceId,AwsRegion,BuildId=None):
+    # Appends the console of an instance about to be reaped to builds/<Build Id>.console.log
+    ConsoleLogFile = os.path.join(UpdateAMI_BuildJournalDir, '{0}.console.log'.format(BuildId or Ec2InstanceId))
+    try:
+        ConsoleOutput = GetAwsClient('ec2',AwsRegion).get_console_output(InstanceId=Ec2InstanceId, DryRun=False).get('Output', '')
+        if (not os.path.isdir(UpdateAMI_BuildJournalDir)):
+            os.makedirs(UpdateAMI_BuildJournalDir)
+        with open(ConsoleLogFile, 'a') as ConsoleLog_fh:
+            ConsoleLog_fh.write('##### Console of reaped InstanceId {0} at {1}\n'.format(Ec2InstanceId, Timestamp()))
+            ConsoleLog_fh.write(ConsoleOutput)
+    except (exceptions.ClientError, IOError, OSError) as err:
+        LOGMSG('Unable to save console of InstanceId {0}: {1}'.format(Ec2InstanceId, err),'ERROR')
+        return None
+    return ConsoleLogFile
+
+def Reap_Region(AwsRegion,MinAge,CaptureConsole=False,ForceInstanceIds=(),TestRun=False):
+    # Terminates the orphaned transient instances of AwsRegion, those in
+    # ForceInstanceIds regardless of age and owner. Returns one result per instance.
+    import datetime
+    Ec2 = GetAwsClient('ec2',AwsRegion)
+    ReapBefore = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=MinAge)
+    ReapResults = []
+    for response in Ec2.get_paginator('describe_instances').paginate(Filters=[
+            {'Name': 'tag:Name', 'Values': ['Aws-Ami-Update Transient Instance']},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']},
+        ]):
+        for Reservation in response['Reservations']:
+            for Instance in Reservation['Instances']:
+                InstanceTags = dict((Tag['Key'], Tag['Value']) for Tag in Instance.get('Tags', []))
+                # Warm builders from before the build id tag carry it as their claim
+                BuildId = InstanceTags.get(UpdateAMI_BuildIdTag) or InstanceTags.get(UpdateAMI_WarmClaimTag) or None
+                if (Instance['InstanceId'] not in ForceInstanceIds):
+                    if (Instance['LaunchTime'] > ReapBefore or LiveBuild(BuildId, MinAge)):
+                        LOGMSG('Reap_Region.{0}: keeping {1} of build {2} launched {3}','DEBUG',2,AwsRegion, Instance['InstanceId'], BuildId, Instance['LaunchTime'])
+                        continue
+                ReapResults.append({'AwsRegion': AwsRegion, 'InstanceId': Instance['InstanceId'], 'BuildId': BuildId, 'LaunchTime': Instance['LaunchTime'].isoformat(), 'State': Instance['State']['Name'], 'Status': 'TestRun' if TestRun else 'Terminated', 'ConsoleLog': None})
+    if (CaptureConsole):
+        for ReapResult in ReapResults:
+            ReapResult['ConsoleLog'] = Save_Ec2ConsoleLog(ReapResult['InstanceId'], AwsRegion, ReapResult['BuildId'])
+    for BatchStart in range(0, len(ReapResults), UpdateAMI_ReapBatchSize):
+        ReapBatch = ReapResults[BatchStart:BatchStart + UpdateAMI_ReapBatchSize]
+        try:
+            Ec2.terminate_instances(InstanceIds=[ReapResult['InstanceId'] for ReapResult in ReapBatch], DryRun=TestRun)
+        except exceptions.ClientError as err:
+            if (err.response['Error']['Code'] != 'DryRunOperation'):
+                LOGMSG('Unable to terminate {0} in {1}: {2}'.format(', '.join(ReapResult['InstanceId'] for ReapResult in ReapBatch), AwsRegion, err),'ERROR')
+                for ReapResult in ReapBatch:
+                    ReapResult['Status'] = 'Failed'
+    for ReapResult in ReapResults:
+        if (ReapResult['Status'] != 'Failed'):
+            LOGMSG('{0} orphaned transient InstanceId {1} ({2}) of build {3} in {4}, launched {5}'.format('TestRun: would terminate' if TestRun else 'Terminated', ReapResult['InstanceId'], ReapResult['State'], ReapResult['BuildId'], AwsRegion, ReapResult['LaunchTime']))
+    return ReapResults
+
+def ReapTransientInstances(AwsRegions=None,MinAge=UpdateAMI_ReapMinAge,CaptureConsole=False,ForceInstanceIds=()):
+    # Regions are reaped concurrently, all regions enabled for the account when none are given
+    from concurrent.futures import ThreadPoolExecutor
+    TestRun = CurrentBuilder().TestRun
+    if (AwsRegions is None):
+        AwsRegions = sorted(Region['RegionName'] for Region in GetAwsClient('ec2').describe_regions(AllRegions=False)['Regions'])
+    ReapResults = []
+    with ThreadPoolExecutor(max_workers=max(min(len(AwsRegions), UpdateAMI_ReapMaxWorkers), 1), thread_name_prefix='aws-ami-reap') as ReapExecutor:
+        ReapFutures = [[ReapExecutor.submit(BuildContextThread(Reap_Region), AwsRegion, MinAge, CaptureConsole, ForceInstanceIds, TestRun), AwsRegion] for AwsRegion in AwsRegions]
+        for ReapFuture, AwsRegion in ReapFutures:
+            try:
+                ReapResults.extend(ReapFuture.result())
+            except exceptions.ClientError as err:
+                LOGMSG('Unable to reap transient instances in {0}: {1}'.format(AwsRegion, err),'ERROR')
+                ReapResults.append({'AwsRegion': AwsRegion, 'InstanceId': None, 'BuildId': None, 'LaunchTime': None, 'State': None, 'Status': 'Failed', 'ConsoleLog': None})
+    LOGMSG('Reaped {0} orphaned transient instances in {1} regions'.format(len([ReapResult for ReapResult in ReapResults if ReapResult['Status'] != 'Failed']), len(AwsRegions)))
+    return ReapResults
+
+def ReapFailedBuild(Journal,Ec2InstanceId,AwsRegion):
+    # The builder of a failed build is terminated, its console kept, along with any
+    # orphans in the region. A build that already made its image stays resumable.
+    LOGMSG('Build {0} failed, terminating transient InstanceId {1}'.format(Journal['BuildId'], Ec2InstanceId),'ERROR')
+    try:
+        ReapResults = ReapTransientInstances([AwsRegion], UpdateAMI_ReapMinAge, True, [Ec2InstanceId])
+    except (AmiUpdateError, exceptions.ClientError) as err:
+        LOGMSG('Unable to terminate transient InstanceId {0}: {1}'.format(Ec2InstanceId, err),'ERROR')
+        return 1
+    if (any(ReapResult['InstanceId'] == Ec2InstanceId and ReapResult['Status'] == 'Terminated' for ReapResult in ReapResults)):
+        RecordBuildPhase(Journal, 'terminated', Parked=False, Reaped=True)
+    if ('image' not in Journal['Phases']):
+        Journal['Status'] = 'failed'
+        WriteBuildJournal(Journal)
+    return 0
+
+def Resolve_SourceAmi(SourceSpec,AwsRegion,KnownSource=None):
+    # Returns {'AmiId', ...} for an ami-, ssm: or name: source. KnownSource, the
+    # previous resolution of a name: source, narrows the lookup to newer images.
+    if (SourceSpec.startswith('ami-')):
+        return {'AmiId': SourceSpec}
+    if (SourceSpec.startswith('ssm:')):
+        try:
+            Parameter = GetAwsClient('ssm',AwsRegion).get_parameter(Name=SourceSpec[4:])['Parameter']
+        except exceptions.ClientError as err:
+            LOGMSG('Unable to read source parameter {0}: {1}'.format(SourceSpec[4:], err),'ERROR')
+            raise SourceAmiError('Unable to read source parameter {0}: {1}'.format(SourceSpec[4:], err))
+        if (not Parameter['Value'].startswith('ami-')):
+            raise SourceAmiError('Source parameter {0} does not hold an Ami id'.format(SourceSpec[4:]))
+        LOGMSG('Resolve_SourceAmi.{0}: {1} (version {2})','DEBUG',2,SourceSpec, Parameter['Value'], Parameter.get('Version'))
+        return {'AmiId': Parameter['Value'], 'Version': Parameter.get('Version')}
+    if (not SourceSpec.startswith('name:')):
+        raise BuildInputError('Invalid source {0}, use ami-, ssm: or name:'.format(SourceSpec))
+    import datetime
+    ImageFilters = [
+        {'Name': 'name', 'Values': [SourceSpec[5:]]},
+        {'Name': 'state', 'Values': ['available']},
+    ]
+    if (KnownSource is not None and 'CreationDate' in KnownSource):
+        KnownDay = datetime.date.fromisoformat(KnownSource['CreationDate'][:10])
+        LookbackDays = (datetime.datetime.now(datetime.timezone.utc).date() - KnownDay).days
+        if (0 <= LookbackDays < UpdateAMI_SourceLookbackDays):
+            ImageFilters.append({'Name': 'creation-date', 'Values': ['{0}T*'.format(KnownDay + datetime.timedelta(days=LookbackDay)) for LookbackDay in range(LookbackDays + 1)]})
+    SourceOwners = BuildSetting('SourceOwners')
+    Images = GetAwsClient('ec2',AwsRegion).describe_images(Owners=SourceOwners, Filters=ImageFilters)['Images']
+    LOGMSG('Resolve_SourceAmi.{0}: {1} images','DEBUG',2,SourceSpec, len(Images))
+    if (len(Images) == 0):
+        if (KnownSource is not None):
+            return KnownSource
+        LOGMSG('No available image named {0} owned by {1}'.format(SourceSpec[5:], ', '.join(SourceOwners)),'ERROR')
+        raise SourceAmiError('No available image named {0}'.format(SourceSpec[5:]))
+    NewestImage = sorted(Images, key=lambda Image: Image['CreationDate'])[-1]
+    if (KnownSource is not None and NewestImage['CreationDate'] < KnownSource.get('CreationDate', '')):
+        return KnownSource
+    return {'AmiId': NewestImage['ImageId'], 'Name': NewestImage.get('Name'), 'CreationDate': NewestImage['CreationDate']}
+
+def LoadWatchState():
+    try:
+        with open(UpdateAMI_WatchStateFile) as WatchState_fh:
+            return json.load(WatchState_fh)
+    except (IOError, ValueError):
+        return {}
+
+def RecordWatchState(WatchKey,WatchEntry):
+    if (CurrentBuilder().TestRun):
+        return 0
+    WatchState = LoadWatchState()
+    WatchState[WatchKey] = WatchEntry
+    try:
+        if (not os.path.isdir(UpdateAMI_StateDir)):
+            os.makedirs(UpdateAMI_StateDir)
+        with open(UpdateAMI_WatchStateFile + '.tmp', 'w') as WatchState_fh:
+            json.dump(WatchState, WatchState_fh, indent=2, sort_keys=True)
+        os.rename(UpdateAMI_WatchStateFile + '.tmp', UpdateAMI_WatchStateFile)
+    except (IOError, OSError) as err:
+        LOGMSG('Unable to record watch state: {0}'.format(err),'ERROR')
+        return 1
+    return 0
+
+def ParseTargetRegions(TargetRegionList,AwsRegion):
+    if (isinstance(TargetRegionList, str)):
+        TargetRegionList = TargetRegionList.split(',')
+    TargetRegions = []
+    for TargetRegion in TargetRegionList:
+        TargetRegion = TargetRegion.strip().lower()
+        if (TargetRegion == '' or TargetRegion == AwsRegion or TargetRegion in TargetRegions):
+            continue
+        if (not ValidateRegion(TargetRegion)):
+            LOGMSG('Invalid target region specified: {0}'.format(TargetRegion),'ERROR')
+            raise BuildInputError('Invalid target region {0}'.format(TargetRegion), 97)
+        TargetRegions.append(TargetRegion)
+    return TargetRegions
+
+def NewBuildJournal(BuildInputs):
+    Journal = {
+        'BuildId': '{0}-{1:06x}'.format(time.strftime('%Y%m%d%H%M%S'), random.getrandbits(24)),
+        'Inputs': BuildInputs,
+        'Phases': {},
+        'Status': 'running',
+    }
+    WriteBuildJournal(Journal)
+    return Journal
+
+def LoadBuildJournal(BuildId):
+    try:
+        with open(os.path.join(UpdateAMI_BuildJournalDir, '{0}.json'.format(BuildId))) as Journal_fh:
+            return json.load(Journal_fh)
+    except (IOError, ValueError) as err:
+        LOGMSG('Unable to load build journal {0}: {1}'.format(BuildId, err),'ERROR')
+        raise BuildInputError('Unable to load build journal {0}: {1}'.format(BuildId, err))
+
+def WriteBuildJournal(Journal):
+    # Journals are what a resumed build trusts, make each write atomic and durable
+    if (CurrentBuilder().TestRun):
+        return 0
+    JournalFile = os.path.join(UpdateAMI_BuildJournalDir, '{0}.json'.format(Journal['BuildId']))
+    with BuildJournalLock:
+        if (not os.path.isdir(UpdateAMI_BuildJournalDir)):
+            os.makedirs(UpdateAMI_BuildJournalDir)
+        with open(JournalFile + '.tmp', 'w') as Journal_fh:
+            json.dump(Journal, Journal_fh, indent=2, sort_keys=True)
+            Journal_fh.flush()
+            os.fsync(Journal_fh.fileno())
+        os.rename(JournalFile + '.tmp', JournalFile)
+    return 0
+
+def RecordBuildPhase(Journal,PhaseName,**PhaseOutcome):
+    LOGMSG('RecordBuildPhase.{0}.{1}: {2}','DEBUG',2,Journal['BuildId'], PhaseName, PhaseOutcome)
+    PhaseOutcome['Completed'] = time.time()
+    with BuildJournalLock:
+        Journal['Phases'][PhaseName] = PhaseOutcome
+        WriteBuildJournal(Journal)
+    return 0
+
+def RunBuildPhase(PhaseName,PhaseFunction,BuildId=None):
+    SetBuildPhase(PhaseName, BuildId)
+    PhaseStartTime = time.monotonic()
+    try:
+        PhaseOutcome = PhaseFunction()
+    finally:
+        SetBuildPhase(None)
+    PhaseOutcome['Duration'] = time.monotonic() - PhaseStartTime
+    return PhaseOutcome
+
+def PhaseDurations(Journal):
+    return dict((PhaseName, round(PhaseOutcome['Duration'], 3)) for PhaseName, PhaseOutcome in Journal['Phases'].items() if 'Duration' in PhaseOutcome)
+
+def WriteBuildResult(BuildResult):
+    if (UpdateAMI_ResultFile is None):
+        return 0
+    if (UpdateAMI_ResultFile == '-'):
+        # One line, so it can be picked out of the log on stdout
+        print(json.dumps(BuildResult, sort_keys=True))
+        sys.stdout.flush()
+        return 0
+    try:
+        with open(UpdateAMI_ResultFile + '.tmp', 'w') as Result_fh:
+            json.dump(BuildResult, Result_fh, indent=2, sort_keys=True)
+        os.replace(UpdateAMI_ResultFile + '.tmp', UpdateAMI_ResultFile)
+    except (IOError, OSError) as err:
+        LOGMSG('Unable to write build result {0}: {1}'.format(UpdateAMI_ResultFile, err),'ERROR')
+        return 1
+    return 0
+
+def RunPhaseGraph(PhaseGraph,Journal):
+    # PhaseGraph is a list of [PhaseName, [Dependencies], PhaseFunction]. A phase
+    # starts as soon as all of its dependencies are recorded in the journal and
+    # its returned outcome is recorded in turn; phases a resumed journal already
+    # holds are skipped. The first failure stops new phases from starting and is
+    # raised once the running ones have finished.
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    PendingPhases = dict((PhaseName, [PhaseDependencies, PhaseFunction]) for PhaseName, PhaseDependencies, PhaseFunction in PhaseGraph if PhaseName not in Journal['Phases'])
+    RunningPhases = {}
+    PhaseError = None
+    with ThreadPoolExecutor(max_workers=max(len(PendingPhases), 1), thread_name_prefix='aws-ami-phase') as PhaseExecutor:
+        while (len(PendingPhases) > 0 or len(RunningPhases) > 0):
+            if (PhaseError is None):
+                for PhaseName in sorted(PendingPhases):
+                    PhaseDependencies, PhaseFunction = PendingPhases[PhaseName]
+                    if (all(PhaseDependency in Journal['Phases'] for PhaseDependency in PhaseDependencies)):
+                        LOGMSG('RunPhaseGraph.{0}: starting','DEBUG',2,PhaseName)
+                        RunningPhases[PhaseExecutor.submit(BuildContextThread(RunBuildPhase), PhaseName, PhaseFunction, Journal['BuildId'])] = PhaseName
+                        del PendingPhases[PhaseName]
+            if (len(RunningPhases) == 0):
+                break
+            PhasesDone, PhasesNotDone = wait(RunningPhases, return_when=FIRST_COMPLETED)
+            for PhaseFuture in PhasesDone:
+                PhaseName = RunningPhases.pop(PhaseFuture)
+                try:
+                    PhaseOutcome = PhaseFuture.result()
+                except BaseException as err:
+                    # Pipeline steps raise AmiUpdateError on failure
+                    if (PhaseError is None):
+                        PhaseError = err
+                    continue
+                RecordBuildPhase(Journal, PhaseName, **PhaseOutcome)
+    if (PhaseError is not None):
+        raise PhaseError
+    if (len(PendingPhases) > 0):
+        LOGMSG('Unable to run build phases: {0}'.format(', '.join(sorted(PendingPhases))),'ERROR')
+        raise AmiUpdateError('Unable to run build phases: {0}'.format(', '.join(sorted(PendingPhases))), 99)
+    return 0
+
+def UpdateAMI(AwsAmiId,AwsAmiName,AwsRegion=DefaultAwsRegion,UserDataFile=UpdateAMI_UserDataFile,MirrorLaunchPermissions=False,PreserveLog=False,TargetRegions=(),BuildId=None,InstanceType=None,UseBakeCache=True):
+    #### Build phases, recorded in the build journal as they complete
+    # verify:     source Ami checked, launch permissions, bake digest and builder type
+    # launch:     transient instance id
+    # stopped:    userdata finished and the instance halted
+    # image:      new Ami id
+    # available:  new Ami is available
+    # shared:     launch permissions applied to the new Ami
+    # terminated: transient instance terminated
+    # copied:     regional copies of the new Ami
+    ####
+    AmiCopies = {}
+    TestRun = CurrentBuilder().TestRun
+    if (InstanceType is None):
+        InstanceType = BuildSetting('InstanceType')
+    WarmPool = BuildSetting('WarmPool')
+    CompletionSignal = BuildSetting('CompletionSignal')
+    ConsoleTail = BuildSetting('ConsoleTail')
+    # Failures are attributed to this build from here on, not to one run earlier on the thread
+    SetBuildPhase(None, BuildId)
+    if (isinstance(CompletionSignal, str) and BuildSetting('InstanceProfile') is None):
+        # Without a role the builder's aws cli cannot tag itself or send to the queue
+        LOGMSG('Completion signal {0} needs an instance profile for the builder'.format(CompletionSignal),'ERROR')
+        raise BuildInputError('Completion signal {0} needs an instance profile for the builder'.format(CompletionSignal))
+    if (BuildId is None):
+        Journal = NewBuildJournal({
+            'AwsAmiId': AwsAmiId,
+            'AwsAmiName': AwsAmiName,
+            'AwsRegion': AwsRegion,
+            'UserDataFile': UserDataFile,
+            'MirrorLaunchPermissions': MirrorLaunchPermissions,
+            'PreserveLog': PreserveLog,
+            'TargetRegions': list(TargetRegions),
+            'InstanceType': InstanceType,
+            'UseBakeCache': UseBakeCache,
+            'Settings': JournalBuildSettings(),
+        })
+    else:
+        Journal = LoadBuildJournal(BuildId)
+        LOGMSG('Resuming build {0}, completed phases: {1}'.format(BuildId, ', '.join(sorted(Journal['Phases'], key=lambda PhaseName: Journal['Phases'][PhaseName]['Completed'])) or 'none'))
+    JournalPhases = Journal['Phases']
+    # Bake durations are only recorded when this process saw the builder launch
+    LaunchedEarlier = 'launch' in JournalPhases
+    SetBuildPhase(None, Journal['BuildId'])
+    LOGMSG('Build Id: {0}'.format(Journal['BuildId']))
+    LOGMSG('Updating AWS Image Id: {0}'.format(AwsAmiId))
+    LOGMSG('New AMI Name: {0}'.format(AwsAmiName))
+    LOGMSG('UpdateAMI.AwsRegion: {0}','DEBUG',1,AwsRegion)
+
+    if ('launch' not in JournalPhases):
+        SetBuildPhase('verify')
+        PhaseStartTime = time.monotonic()
+        UpdateAMI_Ec2UserData, UserDataParts = ReadUserDataFile(UserDataFile, dict({'AmiName': AwsAmiName, 'SourceAmiId': AwsAmiId, 'AwsRegion': AwsRegion}, **BuildSetting('UserDataVars')))
+        if (CompletionSignal is not None):
+            UpdateAMI_Ec2UserData = CompletionSignalUserData(UpdateAMI_Ec2UserData, AwsRegion)
+        LOGMSG('Update execution will be as follows: >>>')
+        LOGBLOCK(UpdateAMI_Ec2UserData)
+        LOGMSG('<<<END')
+        for PartType, PartText in UserDataParts:
+            LOGMSG('Userdata {0} part: >>>'.format(PartType))
+            LOGBLOCK(PartText)
+            LOGMSG('<<<END')
+        # Warm builders run the script on every boot, not only the first
+        Ec2UserData = EncodeUserData(UpdateAMI_Ec2UserData, UserDataParts, WarmPool)
+        BakeDigest = ComputeBakeDigest(AwsAmiId, AwsAmiName, [UpdateAMI_Ec2UserData, UserDataParts], InstanceType)
+        LOGMSG('UpdateAMI.BakeDigest: {0}','DEBUG',1,BakeDigest)
+        CachedAmiId = None
+        if (UseBakeCache):
+            CachedAmiId = LookupBakeCache(BakeDigest, AwsRegion)
+        if (CachedAmiId is not None):
+            LOGMSG('Skipping rebuild, inputs unchanged since Ami Id {0}'.format(CachedAmiId))
+            # Sharing is brought up to date on the cached image and its copies
+            LaunchPermissions = None
+            if (MirrorLaunchPermissions):
+                LaunchPermissions = SourceLaunchPermissions(AwsAmiId, AwsRegion)
+            LaunchPermissions = SharePermissions(LaunchPermissions)
+            Share_AMI(CachedAmiId, AwsRegion, LaunchPermissions)
+            if (len(TargetRegions) > 0):
+                # Copies missing from a target region are made from the cached image
+                CachedAmiName = GetAwsClient('ec2',AwsRegion).describe_images(ImageIds=[CachedAmiId])['Images'][0]['Name']
+                AmiCopies = Distribute_AMI(CachedAmiId, CachedAmiName, AwsRegion, TargetRegions, LaunchPermissions, BakeDigest)
+            Journal['Status'] = 'cached'
+            WriteBuildJournal(Journal)
+            return {'Status':'Cached', 'BuildId':Journal['BuildId'], 'AmiId':CachedAmiId, 'InstanceId':None, 'Copies':AmiCopies, 'Phases':{'verify': round(time.monotonic() - PhaseStartTime, 3)}, }
+        BuilderInstanceType = InstanceType
+        if (InstanceType == 'auto'):
+            BuilderInstanceType = SelectInstanceType(AwsAmiId, AwsAmiName, AwsRegion)
+        VerifyAMIReturn,LaunchPermissions = Verify_AMI(AwsAmiId,AwsRegion,MirrorLaunchPermissions,BuilderInstanceType)
+        LaunchPermissions = SharePermissions(LaunchPermissions)
+        LOGMSG('UpdateAMI.LaunchPermissions: {0}','DEBUG',1,LaunchPermissions)
+        if(VerifyAMIReturn == 98):
+            LOGMSG('An unkown error occurred while verifying source Ami','ERROR')
+        if (VerifyAMIReturn != 0):
+            raise SourceAmiError('Unable to verify source Ami {0}'.format(AwsAmiId))
+        RecordBuildPhase(Journal, 'verify', LaunchPermissions=LaunchPermissions, BakeDigest=BakeDigest, InstanceType=BuilderInstanceType, Duration=time.monotonic() - PhaseStartTime)
+        SetBuildPhase('launch')
+        PhaseStartTime = time.monotonic()
+        WarmBuilder = None
+        if (WarmPool and not TestRun):
+            WarmBuilder = Find_WarmBuilder(AwsAmiId, AwsAmiName, AwsRegion, Journal['BuildId'])
+        if (WarmBuilder is not None):
+            if (Start_WarmBuilder(WarmBuilder[0], AwsRegion, Ec2UserData, WarmBuilder[1], BuilderInstanceType if WarmBuilder[2] != BuilderInstanceType else None) != 0):
+                LOGMSG('Warm builder {0} failed to start'.format(WarmBuilder[0]),'ERROR')
+                raise InstanceError('Warm builder {0} failed to start'.format(WarmBuilder[0]), 3)
+            RecordBuildPhase(Journal, 'launch', InstanceId=WarmBuilder[0], Generation=WarmBuilder[1] + 1, Duration=time.monotonic() - PhaseStartTime)
+        elif (WarmPool):
+            CreateEc2Return = Create_Ec2(AwsAmiId,AwsRegion,Ec2UserData,TestRun,[
+                {'Key': UpdateAMI_BuildIdTag, 'Value': Journal['BuildId']},
+                {'Key': UpdateAMI_FamilyTag, 'Value': AwsAmiName},
+                {'Key': UpdateAMI_WarmSourceTag, 'Value': AwsAmiId},
+                {'Key': UpdateAMI_WarmGenerationTag, 'Value': '1'},
+                {'Key': UpdateAMI_WarmClaimTag, 'Value': Journal['BuildId']},
+            ],BuilderInstanceType)
+        else:
+            CreateEc2Return = Create_Ec2(AwsAmiId,AwsRegion,Ec2UserData,TestRun,[{'Key': UpdateAMI_BuildIdTag, 'Value': Journal['BuildId']}, ],BuilderInstanceType)
+        if (WarmBuilder is None):
+            if (CreateEc2Return['Ec2InstanceState'] == str('1')):
+                LOGMSG('CreateEc2Return.TestRunComplete','DEBUG',1)
+                LOGMSG('Test Run Complete')
+                return {'Status':'TestRun', 'BuildId':Journal['BuildId'], 'AmiId':None, 'InstanceId':None, 'Copies':{}, 'Phases':PhaseDurations(Journal), }
+            LOGMSG('UpdateAMI.CreateEc2Return.Ec2InstanceState: {0}','DEBUG',1,CreateEc2Return['Ec2InstanceState'])
+            LOGMSG('UpdateAMI.CreateEc2Return.Ec2InstanceId: {0}','DEBUG',1,CreateEc2Return['Ec2InstanceId'])
+            RecordBuildPhase(Journal, 'launch', InstanceId=CreateEc2Return['Ec2InstanceId'], Generation=1, Duration=time.monotonic() - PhaseStartTime)
+    else:
+        LOGMSG('Reattaching to transient InstanceId {0}'.format(JournalPhases['launch']['InstanceId']))
+    SetBuildPhase(None)
+    Ec2InstanceId = JournalPhases['launch']['InstanceId']
+    LaunchPermissions = JournalPhases['verify']['LaunchPermissions']
+    BakeDigest = JournalPhases['verify']['BakeDigest']
+    BuilderInstanceType = JournalPhases['verify'].get('InstanceType', InstanceType)
+
+    ## Phases after launch run as a dependency graph, each as soon as its inputs exist
+    def UpdateAMI_Stopped():
+        WarmStart = JournalPhases['launch'].get('Generation', 1) > 1
+        if (ConsoleTail):
+            Tailer = ConsoleTailer(Ec2InstanceId, AwsRegion, Journal['BuildId']).Start()
+        try:
+            if (CompletionSignal is not None):
+                # The builder is left running, the image is taken with a clean reboot
+                WaitInstanceStateReturn = WaitCompletionSignal(Ec2InstanceId, AwsRegion)
+            else:
+                WaitInstanceStateReturn = WaitInstanceState(Ec2InstanceId, AwsRegion, None, PhaseKey='{0}:{1}'.format('instance-stopped-warm' if WarmStart else 'instance-stopped', AwsAmiName))
+        finally:
+            if (ConsoleTail):
+                Tailer.Stop()
+        LOGMSG('UpdateAMI.WaitInstanceStateReturn: {0}','DEBUG',1,WaitInstanceStateReturn)
+        if (WaitInstanceStateReturn != 0):
+            LOGMSG('An unkown error occurred, exiting','ERROR')
+            raise InstanceError('Instance {0} did not stop'.format(Ec2InstanceId), 3)
+        if (not LaunchedEarlier and BuilderInstanceType is not None):
+            RecordPhaseDuration(BakeProfileKey(AwsAmiName, BuilderInstanceType, WarmStart), time.time() - JournalPhases['launch']['Completed'])
+        if (CompletionSignal is not None):
+            return {'Signalled': True}
+        return {}
+
+    def UpdateAMI_Console():
+        Get_Ec2ConsoleLog(Ec2InstanceId, AwsRegion)
+        return {}
+
+    def UpdateAMI_Image():
+        CreateAmiReturn = Create_AMI(Ec2InstanceId, AwsAmiName, AwsRegion, LaunchPermissions, BakeDigest=BakeDigest, NoReboot=not JournalPhases['stopped'].get('Signalled', False))
+        LOGMSG('UpdateAMI.CreateAmiReturn: {0}','DEBUG',1,CreateAmiReturn)
+        if (CreateAmiReturn == 98):
+            LOGMSG('Ami creation failed with an unknown error','ERROR')
+            raise ImageError('Ami creation from {0} failed'.format(Ec2InstanceId), 4)
+        return {'AmiId': CreateAmiReturn}
+
+    def UpdateAMI_Shared():
+        ShareOutcome = Share_AMI(JournalPhases['image']['AmiId'], AwsRegion, LaunchPermissions)
+        return dict(ShareOutcome, LaunchPermissions=LaunchPermissions)
+
+    def UpdateAMI_Available():
+        WaitAmiStateReturn = WaitAmiState(JournalPhases['image']['AmiId'], AwsRegion, PhaseKey='ami-available:{0}'.format(AwsAmiName))
+        if (WaitAmiStateReturn != 0):
+            LOGMSG('Failed while waiting for Ami creation to complete','ERROR')
+            raise ImageError('Ami Id {0} did not become available'.format(JournalPhases['image']['AmiId']), 5)
+        RecordBakeCache(BakeDigest, AwsRegion, JournalPhases['image']['AmiId'])
+        LOGMSG('Ami creation completed successfully')
+        return {}
+
+    def UpdateAMI_Terminated():
+        ## Terminate Ec2 Instance, or keep it stopped as a warm builder
+        if (WarmPool and JournalPhases['launch']['Generation'] < BuildSetting('WarmMaxGenerations')):
+            Park_WarmBuilder(Ec2InstanceId, AwsRegion, JournalPhases['image']['AmiId'], JournalPhases['stopped'].get('Signalled', False))
+            return {'Parked': True}
+        TerminateEc2Return = Terminate_Ec2(Ec2InstanceId, AwsRegion, False, TestRun)
+        LOGMSG('UpdateAMI.TerminateEc2Return.Ec2InstanceId: {0}','DEBUG',2,TerminateEc2Return['Ec2InstanceId'])
+        LOGMSG('UpdateAMI.TerminateEc2Return.Ec2InstanceState: {0}','DEBUG',2,TerminateEc2Return['Ec2InstanceState'])
+        return {'Parked': False}
+
+    def UpdateAMI_TerminateConfirmed():
+        if (JournalPhases['terminated']['Parked']):
+            return {}
+        WaitInstanceStateReturn = WaitInstanceState(Ec2InstanceId, AwsRegion, None, 48, 15, 300)
+        LOGMSG('UpdateAMI.TerminateEc2.WaitInstanceStateReturn: {0}','DEBUG',2,WaitInstanceStateReturn)
+        if (WaitInstanceStateReturn != 0):
+            LOGMSG('An unkown error occurred, exiting','ERROR')
+            raise InstanceError('Instance {0} did not terminate'.format(Ec2InstanceId), 7)
+        LOGMSG('Transient Ec2 Instance Terminated')
+        return {}
+
+    def UpdateAMI_Copied():
+        ## Copy Ami to target regions
+        AmiCopies = Distribute_AMI(JournalPhases['image']['AmiId'], '{0} {1}'.format(AwsAmiName, Ec2InstanceId.split('-')[1]), AwsRegion, TargetRegions, LaunchPermissions, BakeDigest, UseBakeCache)
+        if (None in AmiCopies.values()):
+            LOGMSG('Ami copy failed for regions: {0}'.format(', '.join(sorted(CopyRegion for CopyRegion in AmiCopies if AmiCopies[CopyRegion] is None))),'ERROR')
+            raise ImageError('Ami copy failed for regions: {0}'.format(', '.join(sorted(CopyRegion for CopyRegion in AmiCopies if AmiCopies[CopyRegion] is None))), 9)
+        return {'Copies': AmiCopies}
+
+    PhaseGraph = [
+        ['stopped', [], UpdateAMI_Stopped],
+        ['image', ['stopped'], UpdateAMI_Image],
+        # Snapshots to share are only complete once the image is available
+        ['shared', ['available'], UpdateAMI_Shared],
+        ['available', ['image'], UpdateAMI_Available],
+    ]
+    # The instance can only go once the image is safely available and its console captured
+    TerminateDependencies = ['available']
+    if (PreserveLog):
+        PhaseGraph.append(['console', ['stopped'], UpdateAMI_Console])
+        TerminateDependencies.append('console')
+    PhaseGraph.append(['terminated', TerminateDependencies, UpdateAMI_Terminated])
+    if (BuildSetting('WaitTerminate')):
+        PhaseGraph.append(['terminate-confirmed', ['terminated'], UpdateAMI_TerminateConfirmed])
+    if (len(TargetRegions) > 0):
+        PhaseGraph.append(['copied', ['available', 'shared'], UpdateAMI_Copied])
+    try:
+        RunPhaseGraph(PhaseGraph, Journal)
+    except Exception:
+        if (BuildSetting('ReapOnFailure') and 'terminated' not in JournalPhases):
+            ReapFailedBuild(Journal, Ec2InstanceId, AwsRegion)
+        raise
+
+    Journal['Status'] = 'complete'
+    WriteBuildJournal(Journal)
+    LOGMSG('Phase durations: {0}'.format(', '.join('{0} {1:.0f}s'.format(PhaseName, PhaseDuration) for PhaseName, PhaseDuration in sorted(PhaseDurations(Journal).items(), key=lambda Phase: JournalPhases[Phase[0]]['Completed']))))
+    return {'Status':'Complete', 'BuildId':Journal['BuildId'], 'AmiId':JournalPhases['image']['AmiId'], 'InstanceId':Ec2InstanceId, 'Copies':JournalPhases.get('copied', {}).get('Copies', {}), 'Phases':PhaseDurations(Journal), }
+
+def ReadManifest(ManifestFile):
+    #### Manifest format (YAML or JSON)
+    # defaults:                      optional, applied to every image entry
+    #   region: us-west-2
+    #   userdata-file: userdata.txt
+    # images:                        or a bare list of image entries
+    #   - ami-id: ami-14c5486b
+    #     name: base-centos7
+    #     region: us-east-1
+    #     userdata-file: centos7.txt   or a list of fragments
+    #     mirror-launchpermissions: true
+    #     target-regions: [us-west-2, eu-west-1]
+    #     instance-type: c5.large    or auto
+    ####
+    try:
+        with open(ManifestFile) as Manifest_fh:
+            ManifestText = Manifest_fh.read()
+    except IOError as err:
+        LOGMSG('Unable to read manifest {0}: {1}'.format(ManifestFile, err),'ERROR')
+        raise BuildInputError('Unable to read manifest {0}: {1}'.format(ManifestFile, err))
+    if (ManifestFile.endswith('.json')):
+        Manifest = json.loads(ManifestText)
+    else:
+        try:
+            import yaml
+        except ImportError:
+            LOGMSG('PyYAML is required for YAML manifests, use a .json manifest instead.','ERROR')
+            raise BuildInputError('PyYAML is required for YAML manifests')
+        Manifest = yaml.safe_load(ManifestText)
+    ManifestDefaults = {}
+    if (isinstance(Manifest, dict)):
+        ManifestDefaults = Manifest.get('defaults') or {}
+        Manifest = Manifest.get('images') or []
+    if (not isinstance(Manifest, list) or len(Manifest) == 0):
+        LOGMSG('Manifest {0} does not list any images.'.format(ManifestFile),'ERROR')
+        raise BuildInputError('Manifest {0} does not list any images'.format(ManifestFile))
+
+    ManifestEntries = []
+    for ManifestIndex, ManifestEntry in enumerate(Manifest):
+        Entry = dict(ManifestDefaults)
+        Entry.update(ManifestEntry)
+        BatchEntry = {
+            'AwsAmiId': Entry.get('ami-id'),
+            'AwsAmiName': Entry.get('name'),
+            'AwsRegion': str(Entry.get('region', DefaultAwsRegion)).lower(),
+            'UserDataFile': Entry.get('userdata-file', UpdateAMI_UserDataFile),
+            'MirrorLaunchPermissions': bool(Entry.get('mirror-launchpermissions', False)),
+            'InstanceType': Entry.get('instance-type'),
+        }
+        if (not ValidateRegion(BatchEntry['AwsRegion'])):
+            LOGMSG('Manifest entry {0}: invalid region {1}'.format(ManifestIndex, BatchEntry['AwsRegion']),'ERROR')
+            raise BuildInputError('Manifest entry {0}: invalid region {1}'.format(ManifestIndex, BatchEntry['AwsRegion']), 97)
+        BatchEntry['TargetRegions'] = ParseTargetRegions(Entry.get('target-regions', []), BatchEntry['AwsRegion'])
+        LOGMSG('ReadManifest.BatchEntry[{0}]: {1}','DEBUG',2,ManifestIndex, BatchEntry)
+        if (BatchEntry['AwsAmiId'] is None or not BatchEntry['AwsAmiId'].startswith("ami-")):
+            LOGMSG('Manifest entry {0}: invalid or missing ami-id'.format(ManifestIndex),'ERROR')
+            raise BuildInputError('Manifest entry {0}: invalid or missing ami-id'.format(ManifestIndex))
+        if (BatchEntry['AwsAmiName'] is None):
+            LOGMSG('Manifest entry {0}: name is required'.format(ManifestIndex),'ERROR')
+            raise BuildInputError('Manifest entry {0}: name is required'.format(ManifestIndex))
+        if (BatchEntry['InstanceType'] is not None and not ValidateInstanceType(BatchEntry['InstanceType'])):
+            LOGMSG('Manifest entry {0}: invalid instance type {1}'.format(ManifestIndex, BatchEntry['InstanceType']),'ERROR')
+            raise BuildInputError('Manifest entry {0}: invalid instance type {1}'.format(ManifestIndex, BatchEntry['InstanceType']))
+        for UserDataFragment in UserDataFileList(BatchEntry['UserDataFile']):
+            if (not os.path.isfile(UserDataFragment)):
+                LOGMSG('Manifest entry {0}: userdata file {1} not found'.format(ManifestIndex, UserDataFragment),'ERROR')
+                raise BuildInputError('Manifest entry {0}: userdata file {1} not found'.format(ManifestIndex, UserDataFragment))
+        ManifestEntries.append(BatchEntry)
+    return ManifestEntries
+
+def UpdateAMI_BatchWorker(BatchEntry,PreserveLog=False):
+    BatchStartTime = time.monotonic()
+    BatchResult = dict(BatchEntry)
+    try:
+        UpdateAMIReturn = UpdateAMI(BatchEntry['AwsAmiId'], BatchEntry['AwsAmiName'], BatchEntry['AwsRegion'], BatchEntry['UserDataFile'], BatchEntry['MirrorLaunchPermissions'], PreserveLog, BatchEntry['TargetRegions'], InstanceType=BatchEntry.get('InstanceType'))
+        BatchResult.update(UpdateAMIReturn)
+        BatchResult['ExitCode'] = 0
+    except AmiUpdateError as err:
+        # Contain a failed build to its own entry
+        BatchResult.update({'Status':'Failed', 'BuildId':err.BuildId, 'AmiId':None, 'ExitCode':err.ExitCode})
+    except Exception as err:
+        LOGMSG('{0} ({1}): {2}'.format(BatchEntry['AwsAmiName'], BatchEntry['AwsAmiId'], err),'ERROR')
+        BatchResult.update({'Status':'Failed', 'BuildId':getattr(BuildContext, 'BuildId', None), 'AmiId':None, 'ExitCode':99})
+    BatchResult['Elapsed'] = time.monotonic() - BatchStartTime
+    return BatchResult
+
+def RunBatch(BatchEntries,MaxWorkers=UpdateAMI_BatchMaxWorkers,PreserveLog=False):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    LOGMSG('Starting batch of {0} images with {1} workers'.format(len(BatchEntries), MaxWorkers))
+    # Results are kept in manifest order for reporting
+    BatchResults = [None] * len(BatchEntries)
+    with ThreadPoolExecutor(max_workers=MaxWorkers, thread_name_prefix='aws-ami-update') as BatchExecutor:
+        BatchFutures = {}
+        for BatchIndex, BatchEntry in enumerate(BatchEntries):
+            BatchFutures[BatchExecutor.submit(BuildContextThread(UpdateAMI_BatchWorker), BatchEntry, PreserveLog)] = BatchIndex
+        for BatchFuture in as_completed(BatchFutures):
+            BatchResult = BatchFuture.result()
+            LOGMSG('Batch entry {0} ({1}) finished: {2}'.format(BatchResult['AwsAmiName'], BatchResult['AwsRegion'], BatchResult['Status']))
+            BatchResults[BatchFutures[BatchFuture]] = BatchResult
+    ShowBatchResults(BatchResults)
+    BatchFailures = [BatchResult for BatchResult in BatchResults if BatchResult['Status'] == 'Failed']
+    WriteBuildResult({'Status': 'Failed' if BatchFailures else 'Complete', 'Builds': BatchResults})
+    return BatchResults
+
+def ShowBatchResults(BatchResults):
+    ResultFormat = '{0:<30} {1:<22} {2:<15} {3:<9} {4:<22} {5:>8}'
+    LOGMSG('Batch results: >>>')
+    LOGBLOCK(ResultFormat.format('Name', 'Source Ami Id', 'Region', 'Status', 'New Ami Id', 'Elapsed'))
+    for BatchResult in BatchResults:
+        LOGBLOCK(ResultFormat.format(BatchResult['AwsAmiName'], BatchResult['AwsAmiId'], BatchResult['AwsRegion'], BatchResult['Status'], str(BatchResult['AmiId'] or '-'), '{0:.0f}s'.format(BatchResult['Elapsed'])))
+    LOGMSG('<<<END')
+    return 0
+
+def WatchSource(SourceSpec,BuildInputs,WatchInterval=UpdateAMI_WatchInterval,MaxAge=UpdateAMI_WatchMaxAge,MaxCycles=None):
+    # The builder, its clients and its caches are kept across cycles, and so is
+    # what each cycle found, in UpdateAMI_WatchStateFile for a restarted watch
+    WatchKey = '{0}:{1}:{2}'.format(BuildInputs['AwsRegion'], BuildInputs['AwsAmiName'], SourceSpec)
+    WatchEntry = LoadWatchState().get(WatchKey, {})
+    LOGMSG('Watching {0} for {1} in {2} every {3}s, last baked from {4}'.format(SourceSpec, BuildInputs['AwsAmiName'], BuildInputs['AwsRegion'], WatchInterval, WatchEntry.get('Source', {}).get('AmiId', 'none')))
+    WatchCycle = 0
+    while (not WatchStopped.is_set() and (MaxCycles is None or WatchCycle < MaxCycles)):
+        WatchCycle += 1
+        CycleStartTime = time.monotonic()
+        try:
+            Source = Resolve_SourceAmi(SourceSpec, BuildInputs['AwsRegion'], WatchEntry.get('Source'))
+            RebuildReason = None
+            if (Source['AmiId'] != WatchEntry.get('Source', {}).get('AmiId')):
+                RebuildReason = 'source is now {0}'.format(Source['AmiId'])
+            elif (MaxAge > 0 and time.time() - WatchEntry.get('Built', 0) > MaxAge):
+                RebuildReason = 'last bake is older than {0:g}h'.format(MaxAge / 3600.0)
+            if (RebuildReason is not None and WatchEntry.get('Failed', {}).get('AmiId') == Source['AmiId'] and time.time() - WatchEntry['Failed']['At'] < UpdateAMI_WatchRetryDelay):
+                LOGMSG('WatchSource.{0}: bake from {1} failed at {2}, not retrying yet','DEBUG',1,WatchKey, Source['AmiId'], WatchEntry['Failed']['At'])
+                RebuildReason = None
+            if (RebuildReason is not None):
+                LOGMSG('Baking {0} from {1}: {2}'.format(BuildInputs['AwsAmiName'], Source['AmiId'], RebuildReason))
+                BuildResult = {'AwsAmiId': Source['AmiId'], 'AwsAmiName': BuildInputs['AwsAmiName'], 'AwsRegion': BuildInputs['AwsRegion'], 'Reason': RebuildReason}
+                try:
+                    # An age rebuild has unchanged inputs, it must not be answered from the bake cache
+                    BuildResult.update(UpdateAMI(Source['AmiId'], UseBakeCache=Source['AmiId'] != WatchEntry.get('Source', {}).get('AmiId'), **BuildInputs))
+                except Exception as err:
+                    # Any failure of the bake holds off retrying this source for UpdateAMI_WatchRetryDelay
+                    if (not isinstance(err, AmiUpdateError)):
+                        LOGMSG('Bake of {0} from {1} failed: {2}'.format(BuildInputs['AwsAmiName'], Source['AmiId'], err),'ERROR')
+                    BuildResult.update({'Status': 'Failed', 'BuildId': getattr(err, 'BuildId', getattr(BuildContext, 'BuildId', None)), 'AmiId': None, 'ExitCode': getattr(err, 'ExitCode', 1)})
+                    WatchEntry['Failed'] = {'AmiId': Source['AmiId'], 'At': time.time()}
+                    RecordWatchState(WatchKey, WatchEntry)
+                WriteBuildResult(BuildResult)
+                if (BuildResult['Status'] in ('Complete', 'Cached')):
+                    WatchEntry = {'Source': Source, 'Built': time.time() if BuildResult['Status'] == 'Complete' else WatchEntry.get('Built', time.time()), 'AmiId': BuildResult['AmiId'], 'BuildId': BuildResult['BuildId']}
+                    RecordWatchState(WatchKey, WatchEntry)
+            else:
+                LOGMSG('WatchSource.{0}: unchanged, {1}','DEBUG',1,WatchKey, Source['AmiId'])
+        except (AmiUpdateError, exceptions.ClientError) as err:
+            # Lookup failures are retried on the next cycle
+            LOGMSG('Watch of {0} failed: {1}'.format(SourceSpec, err),'ERROR')
+        finally:
+            SetBuildPhase(None, None)
+        if (MaxCycles is None or WatchCycle < MaxCycles):
+            WatchStopped.wait(max(WatchInterval - (time.monotonic() - CycleStartTime), 0))
+    LOGMSG('Stopped watching {0} after {1} checks'.format(SourceSpec, WatchCycle))
+    return WatchEntry
+
 def main(argv):
+    # The command line is a thin wrapper over AmiBuilder, exiting with the
+    # ExitCode of whatever failure the builder raised
+    try:
+        return CommandLine(argv)
+    except AmiUpdateError as err:
+        sys.exit(err.ExitCode)
+
+def CommandLine(argv):
     # Set Defaults annd Read in Arguments
     AwsRegion = DefaultAwsRegion
     AwsAmiId = None
@@ -448,11 +2956,21 @@ def main(argv):
     SecretAccessKey = None
     MirrorLaunchPermissions = False
     PreserveLog = False
+    ManifestFile = None
+    BatchMaxWorkers = UpdateAMI_BatchMaxWorkers
+    TargetRegionList = []
+    ResumeBuildId = None
+    BuilderTestRun = False
+    GcMode = False
+    ReapMode = False
+    SourceSpec = None
+    WatchMode = False
+    BuildSettings = {}
 
     try:
         if (len(argv) == 0):
             show_usage()
-        opts, args = getopt.getopt(argv,"hvtdmc:p:u:r:a:n:",["help","version","testrun","debug","mirror-launchpermissions","log-instance-console","config=","profile-name=","userdata-file=","no-shutdown","region=","ami-id=","ami-name=","access-key-id=","secret-access-key=",])
+        opts, args = getopt.getopt(argv,"hvtdmc:p:u:r:a:n:l:i:",["help","version","testrun","debug","mirror-launchpermissions","log-instance-console","config=","profile-name=","userdata-file=","no-shutdown","region=","ami-id=","ami-name=","access-key-id=","secret-access-key=","manifest=","max-workers=","wait-interval=","wait-timeout=","target-regions=","no-cache","resume=","warm-pool","warm-max-generations=","wait-terminate","api-metrics=","result-file=","log-file=","log-format=","tail-console","console-done-marker=","console-fail-marker=","completion-signal=","instance-profile=","instance-type=","max-bake-cost=","share-accounts=","share-ous=","share-snapshots-public","gc","keep-latest=","keep-days=","reap","reap-age=","keep-failed","source=","source-owners=","watch","watch-interval=","max-age=","userdata-var=",])
     except getopt.GetoptError as opterr:
         LOGMSG(opterr,'ERROR')
         show_usage()
@@ -462,8 +2980,7 @@ def main(argv):
         if opt in ("-v", "--version"):
             show_version()
         elif opt in ("-t", "--testrun"):
-            global TestRun
-            TestRun = True
+            BuilderTestRun = True
             LOGMSG("TestRun mode: Enabled")
         elif opt in ("-d", "--debug"):
             global DEBUG, DebugLevel
@@ -472,8 +2989,7 @@ def main(argv):
             if (DebugLevel == 1):
                 LOGMSG("Debug mode: Enabled")
         elif opt == '--no-shutdown':
-            global UpdateAMI_ShutdownCMD
-            UpdateAMI_ShutdownCMD = ""
+            BuildSettings['ShutdownCMD'] = ""
         elif opt in ("-m", "--mirror-launchpermissions"):
             MirrorLaunchPermissions=True
         elif opt == '--log-instance-console':
@@ -498,105 +3014,256 @@ def main(argv):
         elif opt in ("-u", "--userdata-file"):
             ##Read Userdata file into UserDataFile
             UserDataFile = arg
+        elif opt == '--userdata-var':
+            if (re.match(r'[A-Za-z_][A-Za-z0-9_]*=', arg) is None):
+                LOGMSG('Invalid userdata variable specified, use <name>=<value>','ERROR')
+                show_usage()
+            BuildSettings.setdefault('UserDataVars', {})[arg.split('=', 1)[0]] = arg.split('=', 1)[1]
+        elif opt in ("-i", "--instance-type"):
+            if (not ValidateInstanceType(arg.lower())):
+                LOGMSG('Invalid instance type specified','ERROR')
+                show_usage()
+            BuildSettings['InstanceType'] = arg.lower()
+        elif opt == '--max-bake-cost':
+            try:
+                MaxBakeCost = float(arg)
+            except ValueError:
+                MaxBakeCost = 0
+            if (MaxBakeCost <= 0):
+                LOGMSG('Invalid max bake cost specified','ERROR')
+                show_usage()
+            BuildSettings['MaxBakeCost'] = MaxBakeCost
+        elif opt in ('--share-accounts', '--share-ous'):
+            try:
+                ShareEntries = ParseShareList(arg)
+            except IOError as err:
+                LOGMSG('Unable to read {0} list {1}: {2}'.format(opt, arg, err),'ERROR')
+                sys.exit(1)
+            if (opt == '--share-accounts'):
+                if (not all(ShareEntry.isdigit() and len(ShareEntry) == 12 for ShareEntry in ShareEntries)):
+                    LOGMSG('Invalid account id in {0}'.format(arg),'ERROR')
+                    show_usage()
+                BuildSettings['ShareAccounts'] = ShareEntries
+            else:
+                if (not all(ShareEntry.startswith('arn:aws') and ':ou/' in ShareEntry for ShareEntry in ShareEntries)):
+                    LOGMSG('Invalid organizational unit arn in {0}'.format(arg),'ERROR')
+                    show_usage()
+                BuildSettings['ShareOrganizationalUnits'] = ShareEntries
+        elif opt == '--share-snapshots-public':
+            BuildSettings['ShareSnapshotsPublic'] = True
+        elif opt == '--gc':
+            GcMode = True
+        elif opt in ('--keep-latest', '--keep-days'):
+            if (not arg.isdigit()):
+                LOGMSG('Invalid {0} specified'.format(opt),'ERROR')
+                show_usage()
+            global UpdateAMI_GcKeepLatest, UpdateAMI_GcKeepDays
+            if (opt == '--keep-latest'):
+                UpdateAMI_GcKeepLatest = int(arg)
+            else:
+                UpdateAMI_GcKeepDays = int(arg)
+        elif opt == '--source':
+            if (not arg.startswith(('ami-', 'ssm:', 'name:'))):
+                LOGMSG('Invalid source specified, use ssm:<parameter> or name:<pattern>','ERROR')
+                show_usage()
+            SourceSpec = arg
+        elif opt == '--source-owners':
+            BuildSettings['SourceOwners'] = [SourceOwner.strip() for SourceOwner in arg.split(',') if SourceOwner.strip() != '']
+        elif opt == '--watch':
+            WatchMode = True
+        elif opt in ('--watch-interval', '--max-age'):
+            if (not arg.isdigit() or (opt == '--watch-interval' and int(arg) < 1)):
+                LOGMSG('Invalid {0} specified'.format(opt),'ERROR')
+                show_usage()
+            global UpdateAMI_WatchInterval, UpdateAMI_WatchMaxAge
+            if (opt == '--watch-interval'):
+                UpdateAMI_WatchInterval = int(arg)
+            else:
+                UpdateAMI_WatchMaxAge = int(arg) * 3600
+        elif opt == '--reap':
+            ReapMode = True
+        elif opt == '--reap-age':
+            if (not arg.isdigit()):
+                LOGMSG('Invalid reap age specified','ERROR')
+                show_usage()
+            global UpdateAMI_ReapMinAge
+            UpdateAMI_ReapMinAge = int(arg) * 3600
+        elif opt == '--keep-failed':
+            BuildSettings['ReapOnFailure'] = False
         elif opt == '--access-key-id':
             AccessKeyId = arg
         elif opt == '--secret-access-key':
             SecretAccessKey = arg
-    if(AwsAmiId is None):
-        print('Ami Id is required.\n')
-        show_usage()
-    if (AwsAmiName is None):
-        print('Ami Name is required.\n')
+        elif opt in ('-l', '--log-file'):
+            global LogOutput
+            try:
+                LogOutput = LogFileWriter(arg)
+            except (IOError, OSError) as err:
+                LOGMSG('Unable to open log file {0}: {1}'.format(arg, err),'ERROR')
+                sys.exit(1)
+        elif opt == '--log-format':
+            if (arg not in ('text', 'json')):
+                LOGMSG('Invalid log format specified','ERROR')
+                show_usage()
+            global UpdateAMI_LogFormat
+            UpdateAMI_LogFormat = arg
+        elif opt == '--completion-signal':
+            if (arg != 'tag' and not arg.startswith('https://sqs.')):
+                LOGMSG('Invalid completion signal specified','ERROR')
+                show_usage()
+            BuildSettings['CompletionSignal'] = arg
+        elif opt == '--instance-profile':
+            if (len(arg) == 0):
+                LOGMSG('Invalid instance profile specified','ERROR')
+                show_usage()
+            BuildSettings['InstanceProfile'] = arg
+        elif opt == '--tail-console':
+            BuildSettings['ConsoleTail'] = True
+        elif opt in ('--console-done-marker', '--console-fail-marker'):
+            if (len(arg) == 0):
+                LOGMSG('Invalid {0} specified'.format(opt),'ERROR')
+                show_usage()
+            if (opt == '--console-done-marker'):
+                BuildSettings['ConsoleDoneMarker'] = arg
+            else:
+                BuildSettings['ConsoleFailMarker'] = arg
+        elif opt == '--result-file':
+            global UpdateAMI_ResultFile
+            UpdateAMI_ResultFile = arg
+        elif opt == '--api-metrics':
+            global UpdateAMI_ApiMetricsFile
+            UpdateAMI_ApiMetricsFile = arg
+        elif opt == '--wait-terminate':
+            BuildSettings['WaitTerminate'] = True
+        elif opt == '--warm-pool':
+            BuildSettings['WarmPool'] = True
+        elif opt == '--warm-max-generations':
+            if (not arg.isdigit() or int(arg) < 1):
+                LOGMSG('Invalid warm max generations specified','ERROR')
+                show_usage()
+            BuildSettings['WarmMaxGenerations'] = int(arg)
+        elif opt == '--resume':
+            ResumeBuildId = arg
+        elif opt == '--no-cache':
+            BuildSettings['BakeCache'] = False
+        elif opt == '--target-regions':
+            TargetRegionList = arg
+        elif opt == '--manifest':
+            ManifestFile = arg
+        elif opt == '--max-workers':
+            if (not arg.isdigit() or int(arg) < 1):
+                LOGMSG('Invalid max workers specified','ERROR')
+                show_usage()
+            BatchMaxWorkers = int(arg)
+        elif opt in ('--wait-interval', '--wait-timeout'):
+            if (not arg.isdigit() or int(arg) < 1):
+                LOGMSG('Invalid {0} specified'.format(opt),'ERROR')
+                show_usage()
+            if (opt == '--wait-interval'):
+                BuildSettings['WaitInterval'] = int(arg)
+            else:
+                BuildSettings['WaitTimeout'] = int(arg)
+    if ('CompletionSignal' in BuildSettings and 'InstanceProfile' not in BuildSettings):
+        LOGMSG('--completion-signal requires --instance-profile for the builder to report with','ERROR')
         show_usage()
+    if (ManifestFile is not None):
+        BatchEntries = ReadManifest(ManifestFile)
+    elif (ResumeBuildId is not None):
+        ResumeJournal = LoadBuildJournal(ResumeBuildId)
+        if (ResumeJournal['Status'] != 'running'):
+            LOGMSG('Build {0} is already {1}'.format(ResumeBuildId, ResumeJournal['Status']))
+            return 0
+        AwsRegion = ResumeJournal['Inputs']['AwsRegion']
+    elif (ReapMode):
+        # Every region enabled for the account is reaped, there is nothing to check
+        pass
+    elif (GcMode and AwsAmiId is None):
+        TargetRegions = ParseTargetRegions(TargetRegionList, AwsRegion)
+    else:
+        if(AwsAmiId is None and SourceSpec is None):
+            print('Ami Id is required.\n')
+            show_usage()
+        if(AwsAmiId is not None and not AwsAmiId.startswith("ami-")):
+            LOGMSG('Invalid AMI id, AMI Ids begin with ami- prefix.','ERROR')
+            show_usage()
+        if (AwsAmiName is None):
+            print('Ami Name is required.\n')
+            show_usage()
+        if (WatchMode and SourceSpec is None):
+            # A fixed source is only rebaked once --max-age has passed
+            SourceSpec = AwsAmiId
+        TargetRegions = ParseTargetRegions(TargetRegionList, AwsRegion)
     
-    global AwsSession, Ec2Client
-    AwsSession,Ec2Client = InitAwsSession(AwsConfigFile, ProfileName, AwsRegion, AccessKeyId, SecretAccessKey)
+    Builder = AmiBuilder(ProfileName, AwsRegion, AwsConfigFile, AccessKeyId, SecretAccessKey, BuilderTestRun, **BuildSettings)
     # Begin main
-    LOGMSG('Updating AWS Image Id: {0}'.format(AwsAmiId))
-    LOGMSG('New AMI Name: {0}'.format(AwsAmiName))
-    LOGMSG('main.AwsRegion: {0}'.format(AwsRegion),'DEBUG',1)
-    UpdateAMI_Ec2UserData = ReadUserDataFile(UserDataFile)
-    LOGMSG('Update execution will be as follows: >>>')
-    print(UpdateAMI_Ec2UserData)
-    LOGMSG('<<<END')
-    VerifyAMIReturn,LaunchPermissions = Verify_AMI(AwsAmiId,AwsRegion,MirrorLaunchPermissions)
-    LOGMSG('main.LaunchPermissions: {0}'.format(LaunchPermissions),'DEBUG',1)
-    if(VerifyAMIReturn == 98):
-        LOGMSG('An unkown error occurred while verifying source Ami','ERROR')
-        sys.exit(1)
-    if (VerifyAMIReturn != 0):
-        sys.exit(1)
-    CreateEc2Return = Create_Ec2(AwsAmiId,AwsRegion,UpdateAMI_Ec2UserData,TestRun)
-    if (CreateEc2Return['Ec2InstanceState'] == str('1')):
-        LOGMSG('CreateEc2Return.TestRunComplete','DEBUG',1)
-        LOGMSG('Test Run Complete')
-        sys.exit(0)
-    LOGMSG('main.CreateEc2Return.Ec2InstanceState: {0}'.format(CreateEc2Return['Ec2InstanceState']),'DEBUG',1)
-    LOGMSG('main.CreateEc2Return.Ec2InstanceId: {0}'.format(CreateEc2Return['Ec2InstanceId']),'DEBUG',1)
-    WaitInstanceStateReturn = WaitInstanceState(CreateEc2Return['Ec2InstanceId'], AwsRegion, CreateEc2Return['Ec2InstanceState'])
-    LOGMSG('main.WaitInstanceStateReturn: {0}'.format(WaitInstanceStateReturn),'DEBUG',1)
-    if WaitInstanceStateReturn == 99:
-        LOGMSG('main.WaitInstanceStateReturn.TestRunComplete','DEBUG',1)
-        LOGMSG("Test Run Complete")
-        sys.exit(0)
-    elif WaitInstanceStateReturn == 98:
-        LOGMSG('An unkown error occurred, exiting','ERROR')
-        sys.exit(3)
-    ## CreateAMI
-    CreateAmiReturn = Create_AMI(CreateEc2Return['Ec2InstanceId'], AwsAmiName, AwsRegion, LaunchPermissions)
-    LOGMSG('main.CreateAmiReturn: {0}'.format(CreateAmiReturn),1)
-    if (CreateAmiReturn == 98):
-        LOGMSG('Ami creation failed with an unknown error','ERROR')
-        sys.exit(4)
-    NewAwsAmiId = CreateAmiReturn
-    WaitAmiStateReturn = WaitAmiState(NewAwsAmiId, AwsRegion)
-    if (WaitAmiStateReturn == 99):
-        LOGMSG('main.WaitAmiStateReturn.Testcomplete','DEBUG',1)
-        sys.exit(0)
-    elif (WaitAmiStateReturn == 98):
-        LOGMSG('Failed while waiting for Ami creation to complete','ERROR')
-        sys.exit(5)
-    elif (WaitAmiStateReturn == 0):
-        if (LaunchPermissions is not None and len(LaunchPermissions) >= 1):
-            try:
-                response = Ec2Client.modify_image_attribute(
-                    Attribute='launchPermission',
-                    ImageId=NewAwsAmiId,
-                    LaunchPermission={
-                        'Add': LaunchPermissions,
-                    },
-                    OperationType='add',
-                )
-            except exceptions.ClientError as err:
-                raise err
-            LOGMSG('main.Create_AMI.modify_image_attribute.response: {0}'.format(response),'DEBUG',4)
-    
-        LOGMSG('Ami creation completed successfully')
-        
-        ## Terminate Ec2 Instance
-        TerminateEc2Return = Terminate_Ec2(CreateEc2Return['Ec2InstanceId'], AwsRegion, PreserveLog, TestRun)
-        if (TerminateEc2Return['Ec2InstanceState'] == str('1')):
-            LOGMSG('TerminateEc2Return.TestRunComplete')
-            LOGMSG('Test Run Complete')
-            sys.exit(0)
-        LOGMSG('main.TerminateEc2Return.Ec2InstanceId: {0}'.format(TerminateEc2Return['Ec2InstanceId']),'DEBUG',2)
-        LOGMSG('main.TerminateEc2Return.Ec2InstanceState: {0}'.format(TerminateEc2Return['Ec2InstanceState']),'DEBUG',2)
-        WaitInstanceStateReturn = WaitInstanceState(TerminateEc2Return['Ec2InstanceId'], AwsRegion, TerminateEc2Return['Ec2InstanceState'], 48, 15, 300)
-        LOGMSG('main.TerminateEc2.WaitInstanceStateReturn: {0}'.format(WaitInstanceStateReturn),'DEBUG',2)
-        if WaitInstanceStateReturn == 99:
-            LOGMSG('WaitInstanceStateReturn.TestRunComplete','DEBUG',1)
-            LOGMSG('Test Run Complete')
-            sys.exit(0)
-        elif WaitInstanceStateReturn == 98:
-            LOGMSG('An unkown error occurred, exiting','ERROR')
-            sys.exit(7)
-        elif WaitInstanceStateReturn == 0:
-            LOGMSG('Transient Ec2 Instance Terminated')
-
+    if (ManifestFile is not None):
+        BatchFailures = len([BatchResult for BatchResult in Builder.BuildBatch(BatchEntries, BatchMaxWorkers, PreserveLog) if BatchResult['Status'] == 'Failed'])
+        if (BatchFailures > 0):
+            LOGMSG('{0} of {1} batch entries failed'.format(BatchFailures, len(BatchEntries)),'ERROR')
+            sys.exit(8)
+        return 0
+    if (ReapMode and ResumeBuildId is None):
+        ReapResults = Builder.ReapInstances(None, UpdateAMI_ReapMinAge, PreserveLog)
+        ReapFailures = [ReapResult for ReapResult in ReapResults if ReapResult['Status'] == 'Failed']
+        WriteBuildResult({'Status': 'Failed' if ReapFailures else 'Complete', 'Reaped': ReapResults})
+        if (len(ReapFailures) > 0):
+            LOGMSG('{0} of {1} transient instances or regions could not be reaped'.format(len(ReapFailures), len(ReapResults)),'ERROR')
+            sys.exit(13)
+        return 0
+    if (GcMode and AwsAmiId is None and ResumeBuildId is None):
+        GcResults = Builder.CollectGarbage([AwsAmiName] if AwsAmiName is not None else None, [AwsRegion] + TargetRegions, UpdateAMI_GcKeepLatest, UpdateAMI_GcKeepDays)
+        GcFailures = [GcResult for GcResult in GcResults if GcResult['Status'] == 'Failed']
+        WriteBuildResult({'Status': 'Failed' if GcFailures else 'Complete', 'Removed': GcResults})
+        if (len(GcFailures) > 0):
+            LOGMSG('{0} of {1} Amis could not be removed'.format(len(GcFailures), len(GcResults)),'ERROR')
+            sys.exit(12)
+        return 0
+    if (WatchMode and ResumeBuildId is None):
+        # SIGTERM lets a running bake finish before the watch stops
+        import signal
+        signal.signal(signal.SIGTERM, lambda SignalNumber, Frame: WatchStopped.set())
+        try:
+            Builder.Watch(SourceSpec, AwsAmiName, UserDataFile, MirrorLaunchPermissions, PreserveLog, TargetRegions, AwsRegion, None, UpdateAMI_WatchInterval, UpdateAMI_WatchMaxAge)
+        except KeyboardInterrupt:
+            LOGMSG('Watch interrupted')
+        return 0
+    if (ResumeBuildId is None and AwsAmiId is None):
+        AwsAmiId = Builder.ResolveSource(SourceSpec, AwsRegion)
+        LOGMSG('Source {0} resolves to Ami Id {1}'.format(SourceSpec, AwsAmiId))
+    if (ResumeBuildId is not None):
+        BuildInputs = ResumeJournal['Inputs']
     else:
-        LOGMSG('Unknown error occurred while waiting for Ami creation.','ERROR')
-        sys.exit(5)
-    
+        BuildInputs = {
+            'AwsAmiId': AwsAmiId,
+            'AwsAmiName': AwsAmiName,
+            'AwsRegion': AwsRegion,
+            'UserDataFile': UserDataFile,
+            'MirrorLaunchPermissions': MirrorLaunchPermissions,
+            'PreserveLog': PreserveLog,
+            'TargetRegions': TargetRegions,
+        }
+    BuildResult = {'AwsAmiId': BuildInputs['AwsAmiId'], 'AwsAmiName': BuildInputs['AwsAmiName'], 'AwsRegion': BuildInputs['AwsRegion']}
+    BuildStartTime = time.monotonic()
+    try:
+        if (ResumeBuildId is not None):
+            BuildResult.update(Builder.Resume(ResumeBuildId, **BuildSettings))
+        else:
+            BuildResult.update(Builder.Build(**BuildInputs))
+        BuildResult['ExitCode'] = 0
+    except AmiUpdateError as err:
+        BuildResult.update({'Status':'Failed', 'BuildId':err.BuildId or ResumeBuildId, 'AmiId':None, 'ExitCode':err.ExitCode})
+        raise
+    except BaseException:
+        BuildResult.update({'Status':'Failed', 'BuildId':getattr(BuildContext, 'BuildId', None) or ResumeBuildId, 'AmiId':None, 'ExitCode':1})
+        raise
+    finally:
+        BuildResult['Elapsed'] = round(time.monotonic() - BuildStartTime, 3)
+        WriteBuildResult(BuildResult)
+    if (GcMode):
+        # The image just made is the newest of its family and always kept
+        GcResults = Builder.CollectGarbage([BuildInputs['AwsAmiName']], [BuildInputs['AwsRegion']] + list(BuildInputs['TargetRegions']), max(UpdateAMI_GcKeepLatest, 1), UpdateAMI_GcKeepDays)
+        if ('Failed' in [GcResult['Status'] for GcResult in GcResults]):
+            sys.exit(12)
     return 0
 ################################################## 
 ### End Function Definitions
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+# Runs the full aws-ami-update.py pipeline, main() included, against a simulated
+# EC2/IAM backend and reports end-to-end time, time lost to poll granularity,
+# API calls per build and peak memory, for one build and for concurrent builds.
+#
+# The simulation answers requests from the botocore before-send event, so the
+# real clients, retries, rate limiter and metrics hooks all run but nothing
+# leaves the machine. Simulated durations are multiplied by --time-scale, and so
+# are the script's own poll intervals and timeouts; reported times are scaled
+# back up to simulated seconds. botocore's retry backoff is not scaled, runs
+# with throttling therefore overstate the cost of a retry.
+import os, sys, getopt, json, random, tempfile, threading, time, tracemalloc, importlib.util
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+ScriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'aws-ami-update.py')
+
+def show_usage():
+    print("""
+Usage: simulate.py [options]
+  -h --help                             Show this help
+  -b --builds=<count>                   Builds in the concurrent scenario                                   [Default: 8]
+  -s --time-scale=<factor>              Real seconds per simulated second                                   [Default: 0.02]
+     --boot-delay=<seconds>             Simulated userdata run time until the builder stops                 [Default: 300]
+     --image-delay=<seconds>            Simulated time for a new image to become available                  [Default: 240]
+     --latency-ms=<milliseconds>        Simulated API latency per request                                   [Default: 80]
+     --throttle-rate=<fraction>         Fraction of API requests answered with RequestLimitExceeded         [Default: 0]
+  -j --json=<file>                      Append results as a JSON line to track them across commits
+""")
+    sys.exit(411)
+
+class RawBody(object):
+    def __init__(self,Body):
+        self.Body = Body
+
+    def stream(self,**kwargs):
+        yield self.Body
+
+class SimulatedAws(object):
+    # Just enough EC2 and IAM for the pipeline. Instances stop BootDelay after
+    # they start, images become available ImageDelay after they are created.
+    # Every answer that first reports a resource in its final state records how
+    # long after the transition it was asked, which is the poll granularity loss.
+    def __init__(self,TimeScale,BootDelay,ImageDelay,Latency,ThrottleRate):
+        import botocore.session
+        from botocore.awsrequest import AWSResponse
+        self.AWSResponse = AWSResponse
+        self.TimeScale = TimeScale
+        self.BootDelay = BootDelay * TimeScale
+        self.ImageDelay = ImageDelay * TimeScale
+        self.Latency = Latency * TimeScale
+        self.ThrottleRate = ThrottleRate
+        self.ServiceModels = dict((ServiceName, botocore.session.get_session().get_service_model(ServiceName)) for ServiceName in ('ec2', 'iam'))
+        self.Lock = threading.Lock()
+        self.ResourceIds = iter(range(0x10000000, 0x7fffffff))
+        self.Instances = {}
+        self.Images = {}
+        self.Calls = {}
+        self.Throttled = 0
+        self.PollLoss = []
+
+    def NewId(self,Prefix):
+        return '{0}-{1:08x}{2:09x}'.format(Prefix, next(self.ResourceIds), random.getrandbits(36))
+
+    def AddImage(self,AwsRegion,ImageName):
+        with self.Lock:
+            ImageId = self.NewId('ami')
+            self.Images[ImageId] = {'Region': AwsRegion, 'Name': ImageName, 'Created': time.monotonic() - self.ImageDelay, 'Tags': [], 'Observed': True}
+        return ImageId
+
+    def Send(self,request=None,event_name=None,**kwargs):
+        ServiceName, OperationName = event_name.split('.')[1:3]
+        ServiceName = 'iam' if ServiceName == 'iam' else 'ec2'
+        AwsRegion = urlparse(request.url).netloc.split('.')[1] if ServiceName == 'ec2' else 'us-east-1'
+        Params = parse_qs(request.body.decode('utf-8') if isinstance(request.body, bytes) else (request.body or ''))
+        Params = dict((ParamName, ParamValues[0]) for ParamName, ParamValues in Params.items())
+        time.sleep(self.Latency)
+        with self.Lock:
+            self.Calls[OperationName] = self.Calls.get(OperationName, 0) + 1
+            if (random.random() < self.ThrottleRate):
+                self.Throttled += 1
+                return self.Error(ServiceName, 503, 'RequestLimitExceeded', 'Request limit exceeded.')
+            if (Params.get('DryRun') == 'true'):
+                return self.Error(ServiceName, 412, 'DryRunOperation', 'Request would have succeeded, but DryRun flag is set.')
+            OperationHandler = getattr(self, '{0}_{1}'.format(ServiceName.capitalize(), OperationName), None)
+            if (OperationHandler is None):
+                return self.Error(ServiceName, 400, 'UnsupportedOperation', '{0} is not simulated'.format(OperationName))
+            OperationResult = OperationHandler(AwsRegion, Params)
+        if (isinstance(OperationResult, self.AWSResponse)):
+            return OperationResult
+        return self.Respond(ServiceName, OperationName, OperationResult)
+
+    def Respond(self,ServiceName,OperationName,OperationResult):
+        OutputShape = self.ServiceModels[ServiceName].operation_model(OperationName).output_shape
+        ResponseBody = ''
+        if (OutputShape is not None):
+            ResponseBody = ''.join(self.ToXml(MemberShape, OperationResult[MemberName], MemberShape.serialization.get('name', MemberName)) for MemberName, MemberShape in OutputShape.members.items() if MemberName in OperationResult)
+        if (ServiceName == 'ec2'):
+            ResponseBody = '<{0}Response xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><requestId>simulated</requestId>{1}</{0}Response>'.format(OperationName, ResponseBody)
+        else:
+            ResponseBody = '<{0}Response><{0}Result>{1}</{0}Result><ResponseMetadata><RequestId>simulated</RequestId></ResponseMetadata></{0}Response>'.format(OperationName, ResponseBody)
+        return self.AWSResponse('https://simulated', 200, {}, RawBody(ResponseBody.encode('utf-8')))
+
+    def Error(self,ServiceName,StatusCode,ErrorCode,ErrorMessage):
+        if (ServiceName == 'ec2'):
+            ResponseBody = '<Response><Errors><Error><Code>{0}</Code><Message>{1}</Message></Error></Errors><RequestID>simulated</RequestID></Response>'.format(ErrorCode, escape(ErrorMessage))
+        else:
+            ResponseBody = '<ErrorResponse><Error><Type>Sender</Type><Code>{0}</Code><Message>{1}</Message></Error><RequestId>simulated</RequestId></ErrorResponse>'.format(ErrorCode, escape(ErrorMessage))
+        return self.AWSResponse('https://simulated', StatusCode, {}, RawBody(ResponseBody.encode('utf-8')))
+
+    def ToXml(self,Shape,Value,ElementName):
+        if (Shape.type_name == 'structure'):
+            ElementBody = ''.join(self.ToXml(MemberShape, Value[MemberName], MemberShape.serialization.get('name', MemberName)) for MemberName, MemberShape in Shape.members.items() if MemberName in Value)
+        elif (Shape.type_name == 'list'):
+            ElementBody = ''.join(self.ToXml(Shape.member, ListValue, Shape.member.serialization.get('name', 'member')) for ListValue in Value)
+        elif (Shape.type_name == 'boolean'):
+            ElementBody = 'true' if Value else 'false'
+        elif (Shape.type_name == 'timestamp'):
+            ElementBody = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(Value))
+        else:
+            ElementBody = escape(str(Value))
+        return '<{0}>{1}</{0}>'.format(ElementName, ElementBody)
+
+    ## Request parameters arrive flattened, i.e. Filter.1.Value.2
+    def ParamList(self,Params,Prefix):
+        ParamValues = []
+        while ('{0}.{1}'.format(Prefix, len(ParamValues) + 1) in Params):
+            ParamValues.append(Params['{0}.{1}'.format(Prefix, len(ParamValues) + 1)])
+        return ParamValues
+
+    def ParamFilters(self,Params):
+        Filters = {}
+        FilterIndex = 1
+        while ('Filter.{0}.Name'.format(FilterIndex) in Params):
+            Filters[Params['Filter.{0}.Name'.format(FilterIndex)]] = self.ParamList(Params, 'Filter.{0}.Value'.format(FilterIndex))
+            FilterIndex += 1
+        return Filters
+
+    def ParamTags(self,Params,Prefix):
+        Tags = []
+        while ('{0}.{1}.Key'.format(Prefix, len(Tags) + 1) in Params):
+            Tags.append({'Key': Params['{0}.{1}.Key'.format(Prefix, len(Tags) + 1)], 'Value': Params.get('{0}.{1}.Value'.format(Prefix, len(Tags) + 1), '')})
+        return Tags
+
+    def TagsMatch(self,Tags,Filters):
+        for FilterName, FilterValues in Filters.items():
+            if (FilterName.startswith('tag:') and not any(Tag['Key'] == FilterName[4:] and Tag['Value'] in FilterValues for Tag in Tags)):
+                return False
+            if (FilterName == 'tag-key' and not any(Tag['Key'] in FilterValues for Tag in Tags)):
+                return False
+        return True
+
+    def InstanceState(self,InstanceId):
+        Instance = self.Instances[InstanceId]
+        Now = time.monotonic()
+        if (Instance['Terminated'] is not None):
+            return (48, 'terminated') if Now - Instance['Terminated'] > self.Latency * 10 else (32, 'shutting-down')
+        if (Now >= Instance['Stops']):
+            if (not Instance['Observed']):
+                Instance['Observed'] = True
+                self.PollLoss.append(Now - Instance['Stops'])
+            return (80, 'stopped')
+        return (16, 'running') if Now - Instance['Started'] > self.Latency * 10 else (0, 'pending')
+
+    def ImageState(self,ImageId):
+        Image = self.Images[ImageId]
+        Now = time.monotonic()
+        if (Now - Image['Created'] >= self.ImageDelay):
+            if (not Image['Observed']):
+                Image['Observed'] = True
+                self.PollLoss.append(Now - Image['Created'] - self.ImageDelay)
+            return 'available'
+        return 'pending'
+
+    def Iam_GetUser(self,AwsRegion,Params):
+        return {'User': {'UserName': 'simulated', 'UserId': 'AIDASIMULATED', 'Arn': 'arn:aws:iam::123456789012:user/simulated', 'Path': '/', 'CreateDate': time.time()}}
+
+    def Ec2_DescribeAccountAttributes(self,AwsRegion,Params):
+        return {'AccountAttributes': []}
+
+    def Ec2_DescribeImageAttribute(self,AwsRegion,Params):
+        return {'ImageId': Params['ImageId'], 'LaunchPermissions': [{'UserId': '210987654321'}]}
+
+    def Ec2_RunInstances(self,AwsRegion,Params):
+        InstanceId = self.NewId('i')
+        self.Instances[InstanceId] = {'Region': AwsRegion, 'Started': time.monotonic(), 'Stops': time.monotonic() + self.BootDelay, 'Terminated': None, 'Observed': False, 'Tags': self.ParamTags(Params, 'TagSpecification.1.Tag')}
+        return {'Instances': [self.InstanceDescription(InstanceId)]}
+
+    def InstanceDescription(self,InstanceId):
+        Ec2InstanceStateCode, Ec2InstanceStateName = self.InstanceState(InstanceId)
+        return {'InstanceId': InstanceId, 'State': {'Code': Ec2InstanceStateCode, 'Name': Ec2InstanceStateName}, 'VpcId': 'vpc-simulated', 'SubnetId': 'subnet-simulated', 'LaunchTime': self.Instances[InstanceId]['Started'] - time.monotonic() + time.time(), 'Tags': self.Instances[InstanceId]['Tags']}
+
+    def Ec2_DescribeInstances(self,AwsRegion,Params):
+        Filters = self.ParamFilters(Params)
+        InstanceIds = self.ParamList(Params, 'InstanceId') or Filters.get('instance-id')
+        Instances = []
+        for InstanceId in sorted(self.Instances):
+            if (self.Instances[InstanceId]['Region'] != AwsRegion or (InstanceIds and InstanceId not in InstanceIds) or not self.TagsMatch(self.Instances[InstanceId]['Tags'], Filters)):
+                continue
+            InstanceDescription = self.InstanceDescription(InstanceId)
+            if ('instance-state-name' in Filters and InstanceDescription['State']['Name'] not in Filters['instance-state-name']):
+                continue
+            Instances.append(InstanceDescription)
+        return {'Reservations': [{'ReservationId': 'r-simulated', 'Instances': Instances}] if Instances else []}
+
+    def Ec2_StartInstances(self,AwsRegion,Params):
+        for InstanceId in self.ParamList(Params, 'InstanceId'):
+            self.Instances[InstanceId].update({'Started': time.monotonic(), 'Stops': time.monotonic() + self.BootDelay, 'Observed': False})
+        return {'StartingInstances': []}
+
+    def Ec2_ModifyInstanceAttribute(self,AwsRegion,Params):
+        return {}
+
+    def Ec2_TerminateInstances(self,AwsRegion,Params):
+        TerminatingInstances = []
+        for InstanceId in self.ParamList(Params, 'InstanceId'):
+            PreviousCode, PreviousName = self.InstanceState(InstanceId)
+            self.Instances[InstanceId]['Terminated'] = time.monotonic()
+            TerminatingInstances.append({'InstanceId': InstanceId, 'CurrentState': {'Code': 32, 'Name': 'shutting-down'}, 'PreviousState': {'Code': PreviousCode, 'Name': PreviousName}})
+        return {'TerminatingInstances': TerminatingInstances}
+
+    def Ec2_GetConsoleOutput(self,AwsRegion,Params):
+        return {'InstanceId': Params['InstanceId'], 'Output': 'Simulated console\n', 'Timestamp': time.time()}
+
+    def Ec2_CreateTags(self,AwsRegion,Params):
+        for ResourceId in self.ParamList(Params, 'ResourceId'):
+            Resource = self.Instances.get(ResourceId) or self.Images.get(ResourceId)
+            for Tag in self.ParamTags(Params, 'Tag'):
+                Resource['Tags'] = [ResourceTag for ResourceTag in Resource['Tags'] if ResourceTag['Key'] != Tag['Key']] + [Tag]
+        return {}
+
+    def Ec2_DescribeTags(self,AwsRegion,Params):
+        Filters = self.ParamFilters(Params)
+        Tags = []
+        for ResourceId in Filters.get('resource-id', []):
+            Resource = self.Instances.get(ResourceId) or self.Images.get(ResourceId) or {'Tags': []}
+            Tags.extend({'ResourceId': ResourceId, 'ResourceType': 'instance', 'Key': Tag['Key'], 'Value': Tag['Value']} for Tag in Resource['Tags'] if Tag['Key'] in Filters.get('key', [Tag['Key']]))
+        return {'Tags': Tags}
+
+    def Ec2_CreateImage(self,AwsRegion,Params):
+        ImageId = self.NewId('ami')
+        self.Images[ImageId] = {'Region': AwsRegion, 'Name': Params['Name'], 'Created': time.monotonic(), 'Tags': self.ParamTags(Params, 'TagSpecification.1.Tag'), 'Observed': False}
+        return {'ImageId': ImageId}
+
+    def Ec2_CopyImage(self,AwsRegion,Params):
+        return self.Ec2_CreateImage(AwsRegion, Params)
+
+    def Ec2_ModifyImageAttribute(self,AwsRegion,Params):
+        return {}
+
+    def Ec2_DescribeImages(self,AwsRegion,Params):
+        Filters = self.ParamFilters(Params)
+        ImageIds = self.ParamList(Params, 'ImageId') or Filters.get('image-id')
+        Images = []
+        for ImageId in sorted(self.Images):
+            Image = self.Images[ImageId]
+            if (Image['Region'] != AwsRegion or (ImageIds and ImageId not in ImageIds) or not self.TagsMatch(Image['Tags'], Filters)):
+                continue
+            ImageState = self.ImageState(ImageId)
+            if ('state' in Filters and ImageState not in Filters['state']):
+                continue
+            Images.append({'ImageId': ImageId, 'Name': Image['Name'], 'State': ImageState, 'CreationDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(Image['Created'] - time.monotonic() + time.time())), 'Tags': Image['Tags']})
+        return {'Images': Images}
+
+def LoadScript(StateDir):
+    # A fresh copy of the script per scenario, with its own state directory
+    os.environ['HOME'] = StateDir
+    ScriptSpec = importlib.util.spec_from_file_location('aws_ami_update_{0}'.format(os.path.basename(StateDir)), ScriptFile)
+    Script = importlib.util.module_from_spec(ScriptSpec)
+    ScriptSpec.loader.exec_module(Script)
+    return Script
+
+def RunScenario(ScenarioName,Builds,Options):
+    StateDir = tempfile.mkdtemp(prefix='aws-ami-update-bench-')
+    Script = LoadScript(StateDir)
+    TimeScale = Options['TimeScale']
+    Backend = SimulatedAws(TimeScale, Options['BootDelay'], Options['ImageDelay'], Options['LatencyMs'] / 1000.0, Options['ThrottleRate'])
+    Script.ImportAwsSdk()
+    class SimulatedSession(Script.boto3.Session):
+        def __init__(self,*args,**kwargs):
+            super(SimulatedSession, self).__init__(*args, **kwargs)
+            self.events.register('before-send', Backend.Send)
+    Script.boto3 = type('SimulatedBoto3', (object,), {'Session': SimulatedSession})
+    # The script's own intervals and limits run on the same scaled clock
+    Script.UpdateAMI_WaitInterval = 60 * TimeScale
+    Script.UpdateAMI_WaitTimeout = 3 * (Options['BootDelay'] + Options['ImageDelay']) * TimeScale
+    Script.UpdateAMI_WaitMinInterval *= TimeScale
+    Script.UpdateAMI_PollCoalesceWindow *= TimeScale
+    for RateLimit in Script.UpdateAMI_ApiRateLimits.values():
+        RateLimit[0] = RateLimit[0] / TimeScale
+
+    UserDataFile = os.path.join(StateDir, 'userdata.txt')
+    with open(UserDataFile, 'w') as UserData_fh:
+        UserData_fh.write('yum -y update\n')
+    SourceAmiId = Backend.AddImage('us-east-1', 'simulated-source')
+    ScriptArgs = ['-l', os.devnull, '--no-cache', '-u', UserDataFile]
+    if (Builds == 1):
+        ScriptArgs += ['-a', SourceAmiId, '-n', 'bench-single', '-m']
+    else:
+        ManifestFile = os.path.join(StateDir, 'manifest.json')
+        with open(ManifestFile, 'w') as Manifest_fh:
+            json.dump({'defaults': {'ami-id': SourceAmiId, 'userdata-file': UserDataFile, 'mirror-launchpermissions': True}, 'images': [{'name': 'bench-{0}'.format(BuildIndex)} for BuildIndex in range(Builds)]}, Manifest_fh)
+        ScriptArgs += ['--manifest={0}'.format(ManifestFile), '--max-workers={0}'.format(Builds)]
+
+    tracemalloc.start()
+    StartTime = time.monotonic()
+    try:
+        ExitCode = Script.main(ScriptArgs)
+    except SystemExit as err:
+        ExitCode = err.code
+    Elapsed = time.monotonic() - StartTime
+    PeakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    ApiCalls = sum(Backend.Calls.values())
+    # Every build stops one builder and waits for one image
+    CriticalPath = (Options['BootDelay'] + Options['ImageDelay'])
+    return {
+        'Scenario': ScenarioName,
+        'Builds': Builds,
+        'ExitCode': ExitCode,
+        'ElapsedSeconds': round(Elapsed / TimeScale, 1),
+        'OverheadSeconds': round(Elapsed / TimeScale - CriticalPath, 1),
+        'PollLossSeconds': round(sum(Backend.PollLoss) / TimeScale / Builds, 1),
+        'ApiCallsPerBuild': round(ApiCalls / float(Builds), 1),
+        'ThrottledRequests': Backend.Throttled,
+        'PeakMemoryKiB': PeakMemory // 1024,
+        'Calls': dict(sorted(Backend.Calls.items())),
+    }
+
+def main(argv):
+    Options = {'Builds': 8, 'TimeScale': 0.02, 'BootDelay': 300, 'ImageDelay': 240, 'LatencyMs': 80, 'ThrottleRate': 0.0, }
+    JsonFile = None
+    try:
+        opts, args = getopt.getopt(argv,"hb:s:j:",["help","builds=","time-scale=","boot-delay=","image-delay=","latency-ms=","throttle-rate=","json=",])
+    except getopt.GetoptError as opterr:
+        print(opterr)
+        show_usage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            show_usage()
+        elif opt in ("-b", "--builds"):
+            Options['Builds'] = int(arg)
+        elif opt in ("-s", "--time-scale"):
+            Options['TimeScale'] = float(arg)
+        elif opt == "--boot-delay":
+            Options['BootDelay'] = float(arg)
+        elif opt == "--image-delay":
+            Options['ImageDelay'] = float(arg)
+        elif opt == "--latency-ms":
+            Options['LatencyMs'] = float(arg)
+        elif opt == "--throttle-rate":
+            Options['ThrottleRate'] = float(arg)
+        elif opt in ("-j", "--json"):
+            JsonFile = arg
+
+    # Simulated credentials and no config, so nothing is looked up off the machine
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'AKIASIMULATED', 'AWS_SECRET_ACCESS_KEY': 'simulated', 'AWS_CONFIG_FILE': os.devnull, 'AWS_SHARED_CREDENTIALS_FILE': os.devnull, 'AWS_EC2_METADATA_DISABLED': 'true', })
+    os.environ.pop('AWS_PROFILE', None)
+    Results = {'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'Python': sys.version.split()[0], 'Options': Options, 'Scenarios': [], }
+    print('Simulated critical path per build: {0:.0f}s (boot {1:.0f}s + image {2:.0f}s), time scale {3}'.format(Options['BootDelay'] + Options['ImageDelay'], Options['BootDelay'], Options['ImageDelay'], Options['TimeScale']))
+    print('{0:<12} {1:>6} {2:>9} {3:>10} {4:>10} {5:>10} {6:>10} {7:>9}'.format('Scenario', 'Builds', 'Elapsed s', 'Overhead s', 'Poll loss', 'Calls/bld', 'Throttled', 'Peak KiB'))
+    Failures = []
+    for ScenarioName, Builds in [['single', 1], ['concurrent', Options['Builds']]]:
+        Scenario = RunScenario(ScenarioName, Builds, Options)
+        Results['Scenarios'].append(Scenario)
+        print('{0:<12} {1:>6} {2:>9.1f} {3:>10.1f} {4:>10.1f} {5:>10.1f} {6:>10} {7:>9}'.format(Scenario['Scenario'], Scenario['Builds'], Scenario['ElapsedSeconds'], Scenario['OverheadSeconds'], Scenario['PollLossSeconds'], Scenario['ApiCallsPerBuild'], Scenario['ThrottledRequests'], Scenario['PeakMemoryKiB']))
+        if (Scenario['ExitCode'] not in (0, None)):
+            Failures.append('{0}: pipeline exited with {1}'.format(ScenarioName, Scenario['ExitCode']))
+    if (JsonFile is not None):
+        with open(JsonFile, 'a') as Json_fh:
+            Json_fh.write(json.dumps(Results, sort_keys=True) + '\n')
+    for Failure in Failures:
+        print('FAIL: {0}'.format(Failure))
+    return len(Failures)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
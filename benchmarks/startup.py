@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# Cold start latency of the aws-ami-update.py fast paths: --help, --version and
+# argument validation failures. None of them may import the AWS SDK.
+import os, sys, getopt, json, subprocess, time
+
+ScriptFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'aws-ami-update.py')
+FastPaths = [
+    ['help', ['--help']],
+    ['version', ['--version']],
+    ['invalid-region', ['-r', 'nowhere-1', '-a', 'ami-14c5486b', '-n', 'startup-bench']],
+    ['missing-name', ['-a', 'ami-14c5486b']],
+]
+# Runs the script in process and reports whether any AWS SDK module got imported
+SdkProbe = """
+import runpy, sys
+sys.argv = {0!r}
+try:
+    runpy.run_path({1!r}, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(repr(sorted(Module for Module in sys.modules if Module.split('.')[0] in ('boto3', 'botocore'))))
+"""
+
+def show_usage():
+    print("""
+Usage: startup.py [options]
+  -h --help                             Show this help
+  -n --runs=<count>                     Cold starts measured per fast path                                  [Default: 20]
+  -m --max-ms=<milliseconds>            Fail when a median cold start exceeds this budget                   [Default: 250]
+  -j --json=<file>                      Append results as a JSON line to track them across commits
+""")
+    sys.exit(411)
+
+def ColdStart(ScriptArgs):
+    StartTime = time.monotonic()
+    subprocess.run([sys.executable, ScriptFile] + ScriptArgs, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.monotonic() - StartTime) * 1000
+
+def InterpreterStart():
+    StartTime = time.monotonic()
+    subprocess.run([sys.executable, '-c', 'pass'])
+    return (time.monotonic() - StartTime) * 1000
+
+def SdkModules(ScriptArgs):
+    Probe = subprocess.run([sys.executable, '-c', SdkProbe.format([ScriptFile] + ScriptArgs, ScriptFile)], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    return Probe.stderr.strip().splitlines()[-1]
+
+def main(argv):
+    Runs = 20
+    MaxMs = 250
+    JsonFile = None
+    try:
+        opts, args = getopt.getopt(argv,"hn:m:j:",["help","runs=","max-ms=","json=",])
+    except getopt.GetoptError as opterr:
+        print(opterr)
+        show_usage()
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            show_usage()
+        elif opt in ("-n", "--runs"):
+            Runs = int(arg)
+        elif opt in ("-m", "--max-ms"):
+            MaxMs = float(arg)
+        elif opt in ("-j", "--json"):
+            JsonFile = arg
+
+    # Interpreter startup alone, for reference
+    InterpreterMs = sorted(InterpreterStart() for Run in range(Runs))[Runs // 2]
+    Results = {'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'Python': sys.version.split()[0], 'Runs': Runs, 'InterpreterMs': round(InterpreterMs, 1), 'Paths': {}, }
+    Failures = []
+    print('Interpreter startup median: {0:.1f}ms'.format(InterpreterMs))
+    print('{0:<16} {1:>10} {2:>10} {3:>10}  {4}'.format('Path', 'Median ms', 'P90 ms', 'Max ms', 'SDK modules'))
+    for PathName, ScriptArgs in FastPaths:
+        Timings = sorted(ColdStart(ScriptArgs) for Run in range(Runs))
+        MedianMs = Timings[len(Timings) // 2]
+        P90Ms = Timings[min(len(Timings) - 1, int(len(Timings) * 0.9))]
+        ImportedSdk = SdkModules(ScriptArgs)
+        Results['Paths'][PathName] = {'MedianMs': round(MedianMs, 1), 'P90Ms': round(P90Ms, 1), 'MaxMs': round(Timings[-1], 1), 'SdkModules': ImportedSdk, }
+        print('{0:<16} {1:>10.1f} {2:>10.1f} {3:>10.1f}  {4}'.format(PathName, MedianMs, P90Ms, Timings[-1], ImportedSdk))
+        if (MedianMs > MaxMs):
+            Failures.append('{0}: median {1:.1f}ms exceeds {2:.0f}ms budget'.format(PathName, MedianMs, MaxMs))
+        if (ImportedSdk != '[]'):
+            Failures.append('{0}: imported {1}'.format(PathName, ImportedSdk))
+    if (JsonFile is not None):
+        with open(JsonFile, 'a') as Json_fh:
+            Json_fh.write(json.dumps(Results, sort_keys=True) + '\n')
+    for Failure in Failures:
+        print('FAIL: {0}'.format(Failure))
+    return len(Failures)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))